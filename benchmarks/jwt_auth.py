@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''Benchmarks requests per second with JWT authentication
+
+Starts a ThreadingHTTPServer with AuthJWTHTTPRequestHandler (users in
+memory) and requests an endpoint which requires authentication, with
+a valid JWT, from a number of client threads. This is repeated for
+HS256 and RS256, with no caching, with the verified JWT cache
+(_jwt_cache_size) and with the user cache (_user_cache_ttl) too.
+'''
+
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import AuthJWTHTTPRequestHandler
+
+
+class Handler(AuthJWTHTTPRequestHandler):
+    _endpoints = endpoints.Endpoint(whoami={})
+    _secrets = ['/whoami']
+
+    def do_whoami(self):
+        self.send_as_json(
+            {'username': self.get_current_session().user.username})
+
+    def log_message(self, *args):
+        pass
+
+
+def write_rsa_key(path):
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend())
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()))
+
+
+def client(port, token, count, errors):
+    for i in range(count):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/whoami',
+                     headers={'Authorization': 'Bearer ' + token})
+        resp = conn.getresponse()
+        resp.read()
+        if resp.status != 200:
+            errors.append(resp.status)
+        conn.close()
+
+
+def run(port, token, requests, threads):
+    errors = []
+    workers = [threading.Thread(
+        target=client, args=(port, token, requests // threads, errors))
+        for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    if errors:
+        raise RuntimeError('{} requests failed, e.g. {}'.format(
+            len(errors), errors[0]))
+    return (requests // threads) * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--requests', type=int, default=5000)
+    parser.add_argument('-t', '--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    user = Handler.create_user('bench', 'Passw0rd!', roles=[])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        keyfile = os.path.join(tmpdir, 'key.pem')
+        write_rsa_key(keyfile)
+        for algorithm in ('HS256', 'RS256'):
+            for jwt_cache, user_cache in ((0, 0), (1024, 0),
+                                          (1024, 10)):
+                Handler._jwt_cache_size = jwt_cache
+                Handler._user_cache_ttl = user_cache
+                if algorithm.startswith('HS'):
+                    Handler.set_JWT_keys('secret', algorithm=algorithm)
+                else:
+                    Handler.set_JWT_keys(
+                        None, algorithm=algorithm, privkey=keyfile)
+                Handler.forget_user(user.username)
+                token = Handler._get_new_jwt(user)
+                if not isinstance(token, str):
+                    token = token.decode('utf-8')
+                rate = run(port, token, args.requests, args.threads)
+                print('{} jwt_cache_size={:<5} user_cache_ttl={:<3} '
+                      '{:7.0f} req/s'.format(
+                          algorithm, jwt_cache, user_cache, rate))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
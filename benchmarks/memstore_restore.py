@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''Benchmarks saving and restoring the in-memory session store
+
+Creates a MemoryStore with the given number of sessions (spread among
+a number of users), saves a snapshot and restores it into a new store,
+as done at startup with --session-snapshot.
+'''
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mixnmatchttp.handlers.authenticator.api import User, Session
+from mixnmatchttp.handlers.authenticator.storage import MemoryStore
+from mixnmatchttp.utils import curr_timestamp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--sessions', type=int, default=1000000)
+    parser.add_argument('-u', '--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    expiry = curr_timestamp(to_utc=True) + 3600
+    users = [User(username='user{}'.format(i), password='x' * 60,
+                  roles=['user'])
+             for i in range(args.users)]
+    store = MemoryStore()
+    for user in users:
+        store.add_user(user)
+    start = time.time()
+    for i in range(args.sessions):
+        store.add_session(Session(
+            user=users[i % args.users], token='{:032x}'.format(i),
+            expiry=expiry))
+    print('Created {} sessions in {:.2f}s'.format(
+        len(store), time.time() - start))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'snapshot')
+        start = time.time()
+        store.save(path)
+        print('Saved snapshot ({:.1f} MB) in {:.2f}s'.format(
+            os.path.getsize(path) / 1e6, time.time() - start))
+        del store
+
+        restored = MemoryStore()
+        start = time.time()
+        nusers, nsessions = restored.restore(path)
+        print('Restored {} users and {} sessions in {:.2f}s'.format(
+            nusers, nsessions, time.time() - start))
+    print('Max RSS: {:.0f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    main()
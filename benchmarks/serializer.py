@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''Benchmarks object_to_dict against the recursive implementation
+
+Serializes every user and session of an in-memory database with
+object_to_dict (compiled ObjectSerializer) and with the recursive
+implementation it replaced (kept in tests/serializer_helpers.py), for
+a few values of max_depth.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mixnmatchttp.db import DBConnection, object_to_dict
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, \
+    DBUser, DBSession
+from tests.serializer_helpers import populate, reference_object_to_dict
+
+
+def timeit(func, objs, repeat, **kargs):
+    start = time.time()
+    for i in range(repeat):
+        for obj in objs:
+            func(obj, **kargs)
+    return (time.time() - start) / (repeat * len(objs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--users', type=int, default=200)
+    parser.add_argument('-s', '--sessions', type=int, default=5,
+                        help='Sessions per user')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db = DBConnection(DBBase, 'sqlite://').session()
+    populate(db, users=args.users, sessions=args.sessions)
+    for cls in (DBUser, DBSession):
+        objs = db.query(cls).all()
+        # load relationships once, so only serialization is timed
+        for obj in objs:
+            reference_object_to_dict(obj)
+        for max_depth in (None, 1, 2):
+            old = timeit(reference_object_to_dict, objs, args.repeat,
+                         max_depth=max_depth)
+            new = timeit(object_to_dict, objs, args.repeat,
+                         max_depth=max_depth)
+            print('{:<10} max_depth={:<4} recursive: {:7.1f}us  '
+                  'serializer: {:7.1f}us  ({:.1f}x)'.format(
+                      cls.__name__, str(max_depth), old * 1e6,
+                      new * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
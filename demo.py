@@ -87,6 +87,8 @@ class MyHandler(BaseHTTPRequestHandler):
                          '${interval}s.</h1>'),
             },
             'page': 'simplehtml',
+            # keep the pages for the last 16 intervals
+            'memo': 16,
         },
         debug={
             'fields': {
@@ -96,6 +98,13 @@ class MyHandler(BaseHTTPRequestHandler):
             'page': 'simpletxt',
         },
     )
+    # let browsers cache scripts for an hour
+    _cache_policies = DictNoClobber(
+        scripts={
+            'path': r'\.js$',
+            'max_age': 3600,
+        },
+    )
 
     def do_refreshme(self):
         interval = self.ep.args
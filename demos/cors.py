@@ -6,12 +6,21 @@ from mixnmatchttp.handlers import BaseHTTPRequestHandler, \
     AuthCookieHTTPRequestHandler, CachingHTTPRequestHandler, \
     ProxyingHTTPRequestHandler
 from mixnmatchttp.handlers.authenticator.api import User
+from mixnmatchttp.utils import DictNoClobber
 
 
 class CORSHTTPSServer(AuthCookieHTTPRequestHandler,
                       CachingHTTPRequestHandler,
                       ProxyingHTTPRequestHandler):
     enable_directory_listing = True
+    _cache_policies = DictNoClobber(
+        jquery={
+            'path': r'/jquery-[0-9\.]+(\.min)?\.js$',
+            'public': True,
+            'max_age': 31536000,
+            'immutable': True,
+        },
+    )
 
     def no_cache(self):
         return (not re.search('/jquery-[0-9\.]+(\.min)?\.js',
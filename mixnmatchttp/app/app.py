@@ -25,6 +25,7 @@ try:
 except ImportError:
     pass
 
+from ..cache import ResponseCache, AssetManifest
 from ..servers import ThreadingHTTPServer
 from ..utils import randstr, is_str
 try:
@@ -178,6 +179,18 @@ class App(object):
                     help=('The algorithm used to encode JWTs. '
                           'Default is HS256 is no private key is '
                           'given, otherwise RS256.'))
+            if auth_type == 'signed_cookie':
+                self.parser_groups['auth'].add_argument(
+                    '--cookie-key', dest='cookie_keys',
+                    metavar='PASSWORD', nargs='+',
+                    help=('Secrets used to sign session cookies. The '
+                          'first one signs new cookies; cookies '
+                          'signed with any of them are accepted, so '
+                          'keys can be rotated. If none is given, '
+                          'a random one is generated (meaning all '
+                          'cookies become invalid upon restart). If '
+                          '"-" is supplied, then it is read from '
+                          'stdin.'))
             self.parser_groups['auth'].add_argument(
                 '--userfile', dest='userfile', metavar='FILE',
                 help=('File containing one username:password[:roles] '
@@ -200,6 +213,18 @@ class App(object):
                 help=('The passwords in userfile are hashed. This is '
                       'the default, but can be used to override '
                       'configuration file setting.'))
+            self.parser_groups['auth'].add_argument(
+                '--session-snapshot', dest='session_snapshot',
+                metavar='FILE',
+                help=('File to periodically save users and sessions '
+                      'to (and at shutdown). They are restored from '
+                      'it at startup, so users stay logged in across '
+                      'restarts. Only for in-memory storage.'))
+            self.parser_groups['auth'].add_argument(
+                '--session-snapshot-interval',
+                dest='session_snapshot_interval', metavar='SECONDS',
+                type=int, default=60,
+                help='How often to save --session-snapshot.')
             self.parser_groups['auth'].add_argument(
                 '--hash-type', dest='userfile_hash_type', nargs='?',
                 const=None, default=None,
@@ -226,7 +251,10 @@ class App(object):
             cors_origin_parser.add_argument(
                 '--allowed-origins', dest='cors_origins',
                 default=['*'], metavar='Origin', nargs='*',
-                help='Allowed origins for CORS requests.')
+                help=('Allowed origins for CORS requests. An origin '
+                      'of the form /REGEX/ allows all origins '
+                      'matching the regular expression. A requesting '
+                      'origin which is allowed is echoed back.'))
             cors_origin_parser.add_argument(
                 '--allow-any-origin', dest='cors_origins',
                 action='store_const', const=['{ECHO}'],
@@ -256,6 +284,11 @@ class App(object):
                 help=('Do not allow sending credentials with CORS '
                       'requests. This is the default, but can be '
                       'used to override configuration file setting.'))
+            self.parser_groups['cors'].add_argument(
+                '--cors-max-age', dest='cors_max_age',
+                type=int, metavar='SECONDS',
+                help=('How long browsers may cache the response to '
+                      'a preflight request.'))
 
         if db_bases:
             self.parser_groups['db'] = self.parser.add_argument_group(
@@ -267,6 +300,51 @@ class App(object):
                     metavar=('dialect://[username:password@]'
                              'host/database'),
                     help='URL of the {} database.'.format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-replica-dburls'.format(n),
+                    dest='{}_replica_dburls'.format(n),
+                    default=[], nargs='*',
+                    metavar=('dialect://[username:password@]'
+                             'host/database'),
+                    help=('URLs of read replicas of the {} '
+                          'database.').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-pool-size'.format(n),
+                    dest='{}_pool_size'.format(n),
+                    type=int, metavar='N',
+                    help=('Number of connections kept open to the {} '
+                          'database (and each replica).').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-max-overflow'.format(n),
+                    dest='{}_max_overflow'.format(n),
+                    type=int, metavar='N',
+                    help=('Number of connections to the {} database '
+                          'allowed in addition to the pool size; '
+                          '-1 for no limit.').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-pool-timeout'.format(n),
+                    dest='{}_pool_timeout'.format(n),
+                    type=float, metavar='SECONDS',
+                    help=('Seconds to wait for a free connection to '
+                          'the {} database.').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-pool-recycle'.format(n),
+                    dest='{}_pool_recycle'.format(n),
+                    type=int, metavar='SECONDS',
+                    help=('Reconnect to the {} database when a '
+                          'connection is older than this.').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-pool-pre-ping'.format(n),
+                    dest='{}_pool_pre_ping'.format(n),
+                    default=False, action='store_true',
+                    help=('Test connections to the {} database '
+                          'before using them.').format(n))
+                self.parser_groups['db'].add_argument(
+                    '--{}-pool-prewarm'.format(n),
+                    dest='{}_pool_prewarm'.format(n),
+                    default=False, action='store_true',
+                    help=('Open the pooled connections to the {} '
+                          'database at startup.').format(n))
 
         if self.proto == 'http':
             self.parser_groups['http'] = self.parser.add_argument_group(
@@ -275,6 +353,30 @@ class App(object):
                 '-H', '--headers', dest='headers',
                 default=[], metavar='Header: Value', nargs='*',
                 help='Additional headers to include in the response.')
+            self.parser_groups['http'].add_argument(
+                '--response-cache-size', dest='response_cache_size',
+                type=int, metavar='BYTES',
+                help=('Maximum size of the server-side cache for '
+                      'endpoints with a cache attribute. Least '
+                      'recently used responses are evicted.'))
+            self.parser_groups['http'].add_argument(
+                '--auto-etag', dest='auto_etag',
+                default=False, action='store_true',
+                help=('Send weak ETags for static files and rendered '
+                      'responses, and reply with 304 Not Modified '
+                      'when the client has the current one.'))
+            self.parser_groups['http'].add_argument(
+                '--fingerprint-assets', dest='fingerprint_assets',
+                metavar='EXT', nargs='*',
+                help=('Hash static files under the root at startup '
+                      'and serve them also under names which include '
+                      'the hash (e.g. app.3f2a9c1e0b4d.js), with '
+                      'a Cache-Control for caching them forever. The '
+                      'mapping is served at /asset-manifest.json and '
+                      'kept up to date when files change. Optionally '
+                      'give the file extensions to include; the '
+                      'default is common script, style, image and '
+                      'font extensions.'))
 
         self.parser_groups['server'] = self.parser.add_argument_group(
             'Logging and process options')
@@ -498,13 +600,18 @@ class App(object):
 
     def _prepare_for_start(self):
         def send_custom_headers(reqself):
-            for h in self.conf.headers:
-                reqself.send_header(*re.split(': *', h, maxsplit=1))
+            for h, v in custom_headers:
+                reqself.send_header(h, v)
             if self.conf.cors:
                 self._send_cors_headers(reqself)
             return super(
                 self.reqhandler, reqself).send_custom_headers()
 
+        custom_headers = [re.split(': *', h, maxsplit=1)
+                          for h in self.conf.headers]
+        if self.conf.cors:
+            self._compile_cors()
+
         #### Preliminary checks and directory creation
         if self.conf.logdir is None and self.conf.daemonize:
             self.conf.logdir = '/var/log/{}'.format(self.name)
@@ -525,21 +632,41 @@ class App(object):
         if self.conf.userfile is not None \
                 and not self.conf.add_users:
             ensure_exists(self.conf.userfile, is_file=True)
+        # check session snapshot
+        if self.conf.session_snapshot is not None:
+            if not hasattr(self.reqhandler, 'restore_snapshot'):
+                exit('--session-snapshot is only supported with '
+                     'in-memory storage.')
+            # the working directory is changed before serving
+            self.conf.session_snapshot = os.path.abspath(
+                self.conf.session_snapshot)
+            make_dirs(self.conf.session_snapshot, is_file=True)
         for n in self.db_bases.keys():
             url = getattr(self.conf, '{}_dburl'.format(n))
             if not url:
                 exit(('You must specify the {name}_dburl '
                       'configuration option or the --{name}-dburl '
                       'command-line option.').format(name=n))
+            for u in [url] + getattr(
+                    self.conf, '{}_replica_dburls'.format(n)):
+                if not parse_db_url(u):
+                    exit('Invalid database URL: {}'.format(u))
             conn = parse_db_url(url)
-            if not conn:
-                exit('Invalid database URL: {}'.format(url))
             if conn['dialect'] == 'sqlite' and \
                     conn['database'] not in [':memory:', None]:
                 make_dirs(conn['database'], is_file=True)
 
         #### Create the new request handler class
-        attrs = {'send_custom_headers': send_custom_headers}
+        attrs = {'send_custom_headers': send_custom_headers,
+                 'fast_preflight': bool(self.conf.cors)}
+        if self.proto == 'http':
+            attrs['response_cache'] = ResponseCache(
+                max_size=self.conf.response_cache_size)
+            attrs['auto_etag'] = self.conf.auto_etag
+            if self.conf.fingerprint_assets is not None:
+                attrs['assets'] = AssetManifest(
+                    root=self.conf.root,
+                    extensions=self.conf.fingerprint_assets)
         if self.auth_type is not None:
             attrs.update({
                 '_is_SSL': self.conf.ssl,
@@ -608,6 +735,15 @@ class App(object):
                 algorithm=self.conf.jwt_algo,
                 privkey=self.conf.jwt_priv_key)
 
+        #### Cookie signing keys
+        if self.auth_type == 'signed_cookie':
+            if not self.conf.cookie_keys:
+                self.conf.cookie_keys = [randstr(32)]
+            self.conf.cookie_keys = [
+                read_line('Enter cookie key') if k == '-' else k
+                for k in self.conf.cookie_keys]
+            self.reqhandler.set_cookie_keys(*self.conf.cookie_keys)
+
         #### Set class options from conf
         if self.user_conf_key is not None:
             setattr(self.reqhandler, self.user_conf_key, self.conf)
@@ -654,14 +790,53 @@ class App(object):
             base = d['base']
             url = getattr(self.conf, '{}_dburl'.format(n))
             session_kargs = d.get('session_args', {})
-            engine_kargs = d.get('engine_args', {})
+            engine_kargs = dict(d.get('engine_args', {}))
+            for k in ['pool_size',
+                      'max_overflow',
+                      'pool_timeout',
+                      'pool_recycle']:
+                value = getattr(self.conf, '{}_{}'.format(n, k))
+                if value is not None:
+                    engine_kargs[k] = value
+            if getattr(self.conf, '{}_pool_pre_ping'.format(n)):
+                engine_kargs['pool_pre_ping'] = True
             cache = d.get('cache', False)
-            DBConnection(base,
-                         url,
-                         session_kargs=session_kargs,
-                         engine_kargs=engine_kargs)
+            query_cache = d.get('query_cache', 0)
+            dbconn = DBConnection(base,
+                                  url,
+                                  session_kargs=session_kargs,
+                                  engine_kargs=engine_kargs)
+            replica_urls = getattr(self.conf,
+                                   '{}_replica_dburls'.format(n))
+            if replica_urls:
+                dbconn.enable_replicas(
+                    replica_urls,
+                    engine_kargs=engine_kargs,
+                    **d.get('replica_args', {}))
+            query_monitor = d.get('query_monitor', False)
+            if query_monitor:  # True or QueryMonitor arguments
+                if query_monitor is True:
+                    query_monitor = {}
+                dbconn.enable_query_monitor(**query_monitor)
+            # True or SQLiteWriter arguments, ignored for other DBs
+            sqlite_writer = d.get('sqlite_writer', False)
+            if sqlite_writer and dbconn.engine.dialect.name == 'sqlite':
+                if sqlite_writer is True:
+                    sqlite_writer = {}
+                dbconn.enable_sqlite_writer(**sqlite_writer)
             if cache:  # ETag support
                 self.reqhandler.enable_client_cache(n, base)
+            if d.get('change_feed', 0):  # number of events kept
+                self.reqhandler.enable_change_feed(
+                    n, base, size=d['change_feed'])
+            if query_cache:  # filter_results cache size
+                dbconn.enable_query_cache(
+                    size=query_cache,
+                    ttl=d.get('query_cache_ttl', None))
+            if getattr(self.conf, '{}_pool_prewarm'.format(n)):
+                self._log_event(
+                    'Opened {} connections to the {} database'.format(
+                        dbconn.prewarm(), n))
 
         #### Load users
         if self.conf.userfile is not None:
@@ -671,6 +846,23 @@ class App(object):
             if self._delete_tmp_userfile:
                 os.remove(self.conf.userfile)
 
+        #### Restore sessions
+        # Users loaded above take precedence over saved ones
+        if self.conf.session_snapshot is not None:
+            try:
+                nusers, nsessions = self.reqhandler.restore_snapshot(
+                    self.conf.session_snapshot)
+            except ValueError as e:
+                # do not overwrite it with snapshots
+                exit('Cannot restore sessions from {}: {}'.format(
+                    self.conf.session_snapshot, e))
+            self._log_event(
+                'Restored {} users and {} sessions from {}'.format(
+                    nusers, nsessions, self.conf.session_snapshot))
+            self.reqhandler.start_snapshots(
+                self.conf.session_snapshot,
+                interval=self.conf.session_snapshot_interval)
+
         #### Create the server
         # This has to be done after daemonization because it binds to
         # the listening port at creation time
@@ -758,42 +950,98 @@ class App(object):
         else:
             for p in self.reqhandler.pollers.values():
                 p.close()
+        for f in getattr(self.reqhandler, 'change_feeds', {}).values():
+            f.close()
         self.server.shutdown()
+        # commit the sessions queued by the last requests
+        for d in self.db_bases.values():
+            writer = DBConnection.get(d['base']).sqlite_writer
+            if writer is not None:
+                writer.stop()
+        if self.conf.session_snapshot is not None:
+            try:
+                self.reqhandler.stop_snapshots(
+                    self.conf.session_snapshot)
+            except Exception as e:
+                # still stop cleanly, the last snapshot is kept
+                self._log_event('Cannot save sessions to {}: {}'.format(
+                    self.conf.session_snapshot, e))
         self._log_event('Stopped server on {}'.format(self.url))
         if self.access_log is not None:
             self.access_log.close()
         self.doneEvent.set()
 
-    def _send_cors_headers(self, reqself):
+    def _compile_cors(self):
+        '''Precomputes the CORS headers and origin allow-list
+
+        Called once from _prepare_for_start, _send_cors_headers uses
+        the result for every request.
+        '''
+
         def get_cors(what):
             res = getattr(self.conf, 'cors_{}'.format(what))
             if isinstance(res, list):
                 return ', '.join(res)
             return res
 
-        cors_origins = get_cors('origins')
-        if cors_origins is not None:
-            cors_origins = urllib.parse.unquote_plus(
-                cors_origins)
-        if cors_origins == '{ECHO}':
-            cors_origins = reqself.headers.get('Origin')
-            if not cors_origins:
-                cors_origins = '*'
-        cors_headers = get_cors('headers')
-        cors_methods = get_cors('methods')
-        cors_creds = get_cors('creds')
-        if cors_origins:
-            reqself.send_header('Access-Control-Allow-Origin',
-                                cors_origins)
-        if cors_headers:
-            reqself.send_header('Access-Control-Allow-Headers',
-                                cors_headers)
-        if cors_methods:
-            reqself.send_header('Access-Control-Allow-Methods',
-                                cors_methods)
-        if cors_creds:
-            reqself.send_header('Access-Control-Allow-Credentials',
-                                'true')
+        self._cors_headers = []
+        for header, what in [
+                ('Access-Control-Allow-Headers', 'headers'),
+                ('Access-Control-Allow-Methods', 'methods')]:
+            value = get_cors(what)
+            if value:
+                self._cors_headers.append((header, value))
+        if self.conf.cors_creds:
+            self._cors_headers.append(
+                ('Access-Control-Allow-Credentials', 'true'))
+        self._cors_preflight_headers = []
+        if self.conf.cors_max_age is not None:
+            self._cors_preflight_headers.append(
+                ('Access-Control-Max-Age', str(self.conf.cors_max_age)))
+
+        origins = self.conf.cors_origins
+        if not isinstance(origins, list):
+            origins = [origins] if origins else []
+        origins = [urllib.parse.unquote_plus(o) for o in origins]
+        self._cors_echo = '{ECHO}' in origins
+        regexes = []
+        plain = []
+        for o in origins:
+            if len(o) > 1 and o[0] == o[-1] == '/':
+                regexes.append(o[1:-1])
+            elif o != '{ECHO}':
+                plain.append(o)
+        origins = plain
+        self._cors_origin_set = set(origins)
+        self._cors_origin_regex = None
+        if regexes:
+            self._cors_origin_regex = re.compile(
+                '(?:{})$'.format('|'.join(regexes)))
+        # sent for origins which are not allowed, as before
+        self._cors_default_origin = ', '.join(origins) or None
+        # whether the response depends on the request's Origin
+        self._cors_vary = self._cors_echo or len(origins) > 1 \
+            or bool(regexes)
+
+    def _send_cors_headers(self, reqself):
+        origin = reqself.headers.get('Origin')
+        if self._cors_echo:
+            allowed = origin or '*'
+        elif origin and (origin in self._cors_origin_set or (
+                self._cors_origin_regex is not None
+                and self._cors_origin_regex.match(origin))):
+            allowed = origin
+        else:
+            allowed = self._cors_default_origin
+        if allowed:
+            reqself.send_header('Access-Control-Allow-Origin', allowed)
+        if self._cors_vary:
+            reqself.send_header('Vary', 'Origin')
+        for header, value in self._cors_headers:
+            reqself.send_header(header, value)
+        if reqself.command == 'OPTIONS':
+            for header, value in self._cors_preflight_headers:
+                reqself.send_header(header, value)
 
     def _get_pid(self, break_stale=False):
         if self.pidlockfile is None:
@@ -1 +1,2 @@
-from .cache import Cache
+from .cache import Cache, ResponseCache
+from .assets import AssetManifest
@@ -0,0 +1,193 @@
+from .._py2 import *
+
+import logging
+import os
+import re
+import time
+import hashlib
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class AssetManifest(object):
+    '''Content-hashed (fingerprinted) names for static files
+
+    Maps the URL path of each file under root (with a leading /) to
+    one which includes a hash of its content, e.g. /js/app.js to
+    /js/app.3f2a9c1e0b4d.js. Since a change in content changes the
+    URL, responses for fingerprinted URLs can be cached forever.
+    - Only files with one of the given extensions are included;
+      hidden files and directories are skipped.
+    - refresh rescans root, at most every interval seconds, from a
+      daemon thread, so that requests never wait for it; only files
+      whose size or modification time changed are hashed again.
+      root is scanned synchronously only when created.
+    - update rehashes a single file, e.g. one found to have changed
+      before the next rescan.
+    '''
+
+    hash_length = 12
+    extensions = {'.js', '.mjs', '.css', '.map', '.png', '.jpg',
+                  '.jpeg', '.gif', '.svg', '.ico', '.webp', '.avif',
+                  '.woff', '.woff2', '.ttf', '.otf', '.eot'}
+
+    def __init__(self, root='.', extensions=None, interval=2):
+        self.root = root
+        if extensions:
+            self.extensions = set(
+                e.lower() if e.startswith('.') else '.' + e.lower()
+                for e in extensions)
+        self.interval = interval
+        self.__files = {}  # URL path: (mtime, size, digest)
+        self.__lock = threading.Lock()
+        self.__checked = 0
+        self.__pattern = re.compile(
+            '^(.*)\\.([0-9a-f]{{{}}})(\\.[^./]+)$'.format(
+                self.hash_length))
+        self.refresh(force=True)
+
+    @property
+    def manifest(self):
+        '''A dictionary of URL paths to fingerprinted URL paths'''
+
+        return {p: self.__fingerprinted(p, f[2])
+                for p, f in self.__files.items()}
+
+    def url(self, path):
+        '''Returns the fingerprinted URL path, or path if not an asset'''
+
+        try:
+            return self.__fingerprinted(path, self.__files[path][2])
+        except KeyError:
+            return path
+
+    def resolve(self, path):
+        '''Returns (URL path, is_current) for a fingerprinted path
+
+        is_current is False if the hash is not the one of the current
+        content. Returns None if path is not fingerprinted.
+        '''
+
+        m = self.__pattern.match(path)
+        if m is None:
+            return None
+        original = m.group(1) + m.group(3)
+        try:
+            digest = self.__files[original][2]
+        except KeyError:
+            return None
+        return (original, digest == m.group(2))
+
+    def is_current(self, path, st):
+        '''Returns True if the stat result matches the scanned file
+
+        Use it before serving a fingerprinted file, since the file
+        may have changed after the last refresh.
+        '''
+
+        try:
+            return self.__files[path][:2] == (st.st_mtime, st.st_size)
+        except KeyError:
+            return False
+
+    def refresh(self, force=False):
+        '''Rescans root if it hasn't been in the last interval seconds
+
+        The rescan is done in a daemon thread and this returns
+        straight away, also if a rescan is already running. If force
+        is True, rescans now, in this thread.
+        '''
+
+        if force:
+            with self.__lock:
+                self.__rescan()
+            return
+        if time.time() - self.__checked < self.interval:
+            return
+        if not self.__lock.acquire(False):
+            return
+        # so that other requests don't start a thread meanwhile
+        self.__checked = time.time()
+
+        def run():
+            try:
+                self.__rescan()
+            except Exception as e:
+                logger.error('Cannot rescan {}: {}'.format(
+                    self.root, e))
+            finally:
+                self.__lock.release()
+
+        thread = threading.Thread(target=run, name='AssetManifest')
+        thread.daemon = True
+        thread.start()
+
+    def update(self, path):
+        '''Rehashes the file at the URL path, or drops it if gone
+
+        Waits for a running rescan, which would otherwise overwrite
+        the change.
+        '''
+
+        fullpath = os.path.join(self.root, *path[1:].split('/'))
+        with self.__lock:
+            try:
+                st = os.stat(fullpath)
+                entry = (st.st_mtime, st.st_size, self.__hash(fullpath))
+            except (IOError, OSError):
+                entry = None
+            files = dict(self.__files)
+            if entry is None:
+                files.pop(path, None)
+            else:
+                files[path] = entry
+            self.__files = files
+
+    def __rescan(self):
+        self.__checked = time.time()
+        self.__files = self.__scan()
+
+    def __scan(self):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.') or os.path.splitext(
+                        name)[1].lower() not in self.extensions:
+                    continue
+                fullpath = os.path.join(dirpath, name)
+                path = '/' + os.path.relpath(
+                    fullpath, self.root).replace(os.sep, '/')
+                try:
+                    st = os.stat(fullpath)
+                except OSError:
+                    continue
+                old = self.__files.get(path)
+                if old is not None and old[:2] == (
+                        st.st_mtime, st.st_size):
+                    files[path] = old
+                    continue
+                try:
+                    digest = self.__hash(fullpath)
+                except (IOError, OSError) as e:
+                    logger.warning('Cannot hash {}: {}'.format(
+                        fullpath, e))
+                    continue
+                if old is not None:
+                    logger.info('Asset {} changed'.format(path))
+                files[path] = (st.st_mtime, st.st_size, digest)
+        return files
+
+    def __hash(self, fullpath):
+        h = hashlib.sha256()
+        with open(fullpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+        return h.hexdigest()[:self.hash_length]
+
+    @staticmethod
+    def __fingerprinted(path, digest):
+        base, ext = os.path.splitext(path)
+        return '{}.{}{}'.format(base, digest, ext)
@@ -4,6 +4,9 @@
 from .._py2 import *
 
 import logging
+import threading
+import time
+from collections import OrderedDict
 
 from .exc import CacheMemoryError, CacheOverwriteError, \
     PageNotCachedError, PageClearedError
@@ -84,3 +87,96 @@ class Cache(object):
     @property
     def size(self):
         return self.__size
+
+class ResponseCache(object):
+    '''A thread-safe, size-bounded cache of rendered responses
+
+    Used for endpoints with a $cache attribute, see
+    BaseHTTPRequestHandler. Each entry is a dictionary with the
+    following items:
+        - code: the HTTP status code
+        - headers: a list of (name, value) tuples
+        - data: the body
+        - gzip: the gzip compressed body, or None
+    Entries expire after their TTL (if given), or as soon as the tag
+    they were saved with differs from the one they are requested with.
+    When max_size (total bytes of bodies) would be exceeded, the
+    least recently used entries are evicted.
+    '''
+
+    __max_size = 16 * 1024 * 1024
+
+    def __init__(self, max_size=None):
+        if max_size is not None:
+            self.__max_size = max_size
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, tag=None):
+        '''Returns the entry for key or None if missing or stale'''
+
+        with self.__lock:
+            try:
+                expires, etag, entry = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if (expires is not None and expires <= time.time()) \
+                    or etag != tag:
+                logger.debug('Cached response for {} is stale'.format(
+                    key))
+                self.__remove(key)
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def save(self, key, entry, ttl=None, tag=None):
+        '''Saves the entry, returns False if it is too large'''
+
+        size = self.__entry_size(entry)
+        if size > self.max_size:
+            logger.debug(
+                'Response for {} is too large to cache'.format(key))
+            return False
+        expires = None if ttl is None else time.time() + ttl
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            while self.__size + size > self.max_size:
+                self.__remove(next(iter(self.__entries)))
+            self.__entries[key] = (expires, tag, entry)
+            self.__size += size
+        logger.debug('Cached response for {}; cache size is {}'.format(
+            key, self.size))
+        return True
+
+    def clear(self):
+        '''Removes all entries'''
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def __remove(self, key):
+        self.__size -= self.__entry_size(self.__entries.pop(key)[2])
+        assert self.__size >= 0
+
+    @staticmethod
+    def __entry_size(entry):
+        return len(entry['data']) + len(entry['gzip'] or b'')
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    @property
+    def size(self):
+        return self.__size
+
+    def __len__(self):
+        return len(self.__entries)
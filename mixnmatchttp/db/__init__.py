@@ -1,4 +1,6 @@
 from .utils import DBConnection, is_base, is_mapper, parse_db_url, \
-    filter_results, object_to_dict, object_from_dict, \
-    bulk_objects_from_dicts, delete_from_dict, \
-    update_from_dict, bulk_update_from_dicts
+    filter_results, QueryCache, SQLiteWriter, ReplicaSet, \
+    QueryMonitor, MeteredQueuePool, paginate_query, object_to_dict, \
+    ObjectSerializer, object_from_dict, bulk_objects_from_dicts, \
+    BatchLookup, delete_from_dict, update_from_dict, \
+    bulk_update_from_dicts
@@ -10,6 +10,9 @@ class ObjectExistsError(ObjectConversionError):
 class ObjectNotFoundError(ObjectConversionError):
     pass
 
+class InvalidQueryError(_InvalidRequestError, ValueError):
+    pass
+
 class ServerDBError(_ServerError):
     pass
 
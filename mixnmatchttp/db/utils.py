@@ -2,21 +2,37 @@ from .._py2 import *
 
 import logging
 from contextlib import contextmanager
+from collections import OrderedDict
 import re
 import os.path
-
-from sqlalchemy import create_engine, inspect, and_, event
-from sqlalchemy.exc import DatabaseError
-from sqlalchemy.orm.exc import UnmappedClassError
+import pickle
+import hashlib
+import threading
+import time
+import queue
+
+from sqlalchemy import create_engine, inspect, and_, or_, event, \
+    Table, MetaData, Column, String
+from sqlalchemy.exc import DatabaseError, \
+    TimeoutError as PoolTimeoutError
+from sqlalchemy.orm.exc import UnmappedClassError, \
+    NoResultFound, MultipleResultsFound
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
 from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import Session, \
-    scoped_session, sessionmaker, joinedload
-from sqlalchemy.orm.util import class_mapper
+    scoped_session, sessionmaker, joinedload, load_only, Load
+from sqlalchemy.orm.properties import ColumnProperty, \
+    RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.orm.util import class_mapper, object_mapper
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.sql import Select
 
 from .exc import ObjectConversionError, ObjectNotFoundError, \
-    ObjectExistsError, ServerDBError, MetadataMistmatchError
+    ObjectExistsError, InvalidQueryError, ServerDBError, \
+    MetadataMistmatchError
 from .is_db_sane import is_db_sane
 from ..utils import is_seq_like, is_map_like, is_time_like, \
     date_from_timestamp
@@ -32,6 +48,8 @@ class DBConnection:
     '''
 
     __instances = {}  # by DB engine
+    # remove_session warns about sessions holding more objects
+    max_identity_map = 10000
 
     def __init__(self,
                  base,
@@ -62,14 +80,33 @@ class DBConnection:
             engine = self._create_engine(url, engine_kargs)
         self.__class__.__instances[engine] = self
         self.__engine = engine
-        self.__session = scoped_session(sessionmaker(
-            bind=engine, **session_kargs))
+        self.__session_stats = {
+            'created': 0,
+            'removed': 0,
+            'last_identity_map': 0,
+            'max_identity_map': 0,
+            'oversized': 0}
+        self.__stats_lock = threading.Lock()
+        self.__sqlite_writer = None
+        self.__replicas = None
+        self.__query_monitor = None
+        session_kargs = dict(session_kargs)
+        session_kargs.setdefault('class_', _RoutingSession)
+        # the sessionmaker counts the sessions it creates
+        self.__session = scoped_session(_CountingSessionMaker(
+            self.__session_created, bind=engine, **session_kargs))
+        session_cls = self.__session.session_factory.class_
+        if issubclass(session_cls, _RoutingSession):
+            session_cls._dbconn = self
         self.__base.metadata.bind = engine
+        self.__inspector = None
+        self.__inspector_lock = threading.Lock()
         self._create_db(engine_kargs)
         self._ensure_is_sane()
-        self.__inspector = Inspector.from_engine(engine)
         self.__maps = {}
         self.__listeners = {}
+        self.__query_cache = None
+        self.__change_callbacks = []
 
     @property
     def base(self):
@@ -93,8 +130,13 @@ class DBConnection:
 
     @property
     def inspector(self):
-        '''Inspector from the engine'''
+        '''Inspector from the engine, created on first use'''
 
+        if self.__inspector is None:
+            with self.__inspector_lock:
+                if self.__inspector is None:
+                    self.__inspector = Inspector.from_engine(
+                        self.engine)
         return self.__inspector
 
     @property
@@ -118,6 +160,68 @@ class DBConnection:
 
         return self.__listeners
 
+    @property
+    def query_cache(self):
+        '''QueryCache used by filter_results, or None'''
+
+        return self.__query_cache
+
+    @property
+    def sqlite_writer(self):
+        '''SQLiteWriter if enabled, or None'''
+
+        return self.__sqlite_writer
+
+    @property
+    def replicas(self):
+        '''ReplicaSet if enabled, or None'''
+
+        return self.__replicas
+
+    @property
+    def query_monitor(self):
+        '''QueryMonitor if enabled, or None'''
+
+        return self.__query_monitor
+
+    @property
+    def pool_stats(self):
+        '''Statistics of the connection pools, see MeteredQueuePool
+
+        A dictionary keyed by primary, sqlite_reader and replica<N>
+        (from 1), of each engine which uses a MeteredQueuePool.
+        '''
+
+        engines = [('primary', self.engine)]
+        if self.__sqlite_writer is not None:
+            engines.append(('sqlite_reader', self.__sqlite_writer.reader))
+        if self.__replicas is not None:
+            engines += [('replica{}'.format(i), e) for i, e in
+                        enumerate(self.__replicas.engines, 1)]
+        return {name: engine.pool.stats() for name, engine in engines
+                if isinstance(engine.pool, MeteredQueuePool)}
+
+    @property
+    def session_stats(self):
+        '''Counters for detecting leaked sessions
+
+        A dictionary with:
+        - created, removed: number of thread-local sessions created and
+          removed via remove_session
+        - open: sessions which have not been removed; with
+          request-scoped sessions this should not exceed the number of
+          threads serving requests
+        - last_identity_map, max_identity_map: number of objects in
+          the last and the largest removed session
+        - oversized: number of removed sessions which held more than
+          max_identity_map objects
+        '''
+
+        with self.__stats_lock:
+            stats = dict(self.__session_stats)
+        stats['open'] = stats['created'] - stats['removed']
+        return stats
+
     @classmethod
     def get(cls, key):
         '''key is an engine, session or a declarative base'''
@@ -141,6 +245,94 @@ class DBConnection:
         except KeyError:
             return None
 
+    @classmethod
+    def begin_monitoring(cls, label=None):
+        '''Starts a request for every QueryMonitor (see end_monitoring)
+
+        - label identifies the request in the log, e.g. the endpoint
+        '''
+
+        for dconn in set(cls.__instances.values()):
+            if dconn.query_monitor is not None:
+                dconn.query_monitor.begin(label)
+
+    @classmethod
+    def end_monitoring(cls):
+        '''Ends the request started by begin_monitoring
+
+        Returns a dictionary of URL--(number of queries, time) for
+        every DBConnection with a QueryMonitor.
+        '''
+
+        stats = {}
+        for dconn in set(cls.__instances.values()):
+            if dconn.query_monitor is not None:
+                result = dconn.query_monitor.end()
+                if result is not None:
+                    stats[dconn.url] = result
+        return stats
+
+    @classmethod
+    def all_stats(cls):
+        '''Returns the statistics of every DBConnection
+
+        A dictionary keyed by URL (with the password masked), each
+        value a dictionary with pool_stats, session_stats and, if
+        enabled, the QueryMonitor's stats as query_stats (otherwise
+        None).
+        '''
+
+        stats = {}
+        for dconn in set(cls.__instances.values()):
+            monitor = dconn.query_monitor
+            stats[repr(dconn.engine.url)] = {
+                'pool_stats': dconn.pool_stats,
+                'session_stats': dconn.session_stats,
+                'query_stats': (monitor.stats()
+                                if monitor is not None else None),
+            }
+        return stats
+
+    @classmethod
+    def remove_all_sessions(cls):
+        '''Calls remove_session on every DBConnection'''
+
+        for dconn in set(cls.__instances.values()):
+            dconn.remove_session()
+
+    def remove_session(self):
+        '''Closes and discards the current thread's session
+
+        The next call to session() creates a new one, so objects and
+        session settings do not carry over to the next request handled
+        by this thread. Does nothing if the thread has no session.
+        '''
+
+        registry = self.__session.registry
+        if not registry.has():
+            return
+        size = len(registry().identity_map)
+        self.__session.remove()
+        with self.__stats_lock:
+            stats = self.__session_stats
+            stats['removed'] += 1
+            stats['last_identity_map'] = size
+            if size > stats['max_identity_map']:
+                stats['max_identity_map'] = size
+            if self.max_identity_map and size > self.max_identity_map:
+                stats['oversized'] += 1
+                oversized = True
+            else:
+                oversized = False
+        if oversized:
+            logger.warning(
+                'Session for {} held {} objects'.format(
+                    self.url, size))
+
+    def __session_created(self, session):
+        with self.__stats_lock:
+            self.__session_stats['created'] += 1
+
     def listen(self, event_name, handler):
         '''Register a handler for an event
 
@@ -159,6 +351,216 @@ class DBConnection:
         def listener(*args):
             return handler(*args)
 
+    def track_changes(self, callback):
+        '''Calls callback(changes) after each commit changing rows
+
+        changes is a dictionary with table names as keys. Each value
+        is either a dictionary of primary key--operation ('insert',
+        'update' or 'delete'), or None if the rows are not known (bulk
+        updates and deletes, association tables). Primary keys are
+        strings, with the values of composite keys joined by /. Rows
+        referred to by changed relationships or foreign keys are
+        included as updated. Changes made by raw SQL or other processes are not noticed.
+        '''
+
+        self.__change_callbacks.append(callback)
+        if len(self.__change_callbacks) > 1:
+            return
+
+        def record(changes, mapper, obj=None, op='update', pk=None):
+            if obj is not None:
+                pk = mapper.primary_key_from_instance(obj)
+            if pk is not None:
+                pk = '/'.join(str(v) for v in pk)
+            for t in _mapper_tables(mapper):
+                rows = changes.setdefault(t, {})
+                if rows is None:
+                    continue
+                if pk is None:
+                    changes[t] = None
+                elif op == 'delete' or pk not in rows:
+                    rows[pk] = op
+
+        def before_flush(session, flush_context, instances):
+            # rows referred to by changed foreign keys changed too,
+            # and they may not be loaded; the flush overwrites the old
+            # keys with those of the objects set on relationships
+            changes = session.info.setdefault('changes', {})
+            for obj in list(session.dirty) + list(session.deleted):
+                mapper = object_mapper(obj)
+                state = inspect(obj)
+                for rel in mapper.relationships:
+                    if rel.direction is not MANYTOONE:
+                        continue
+                    local = dict(
+                        (r, mapper.get_property_by_column(l).key)
+                        for l, r in rel.local_remote_pairs)
+                    if any(c not in local for c in rel.mapper.primary_key):
+                        continue
+                    keys = [local[c] for c in rel.mapper.primary_key]
+                    if obj not in session.deleted and not (
+                            state.attrs[rel.key].history.has_changes()
+                            or any(state.attrs[k].history.has_changes()
+                                   for k in keys)):
+                        continue
+                    for values in (state.committed_state, state.dict):
+                        pk = [values.get(k, state.dict.get(k))
+                              for k in keys]
+                        if None not in pk:
+                            record(changes, rel.mapper, pk=pk)
+
+        def after_flush(session, flush_context):
+            # new, dirty and deleted still hold the pre-flush state
+            # but new objects have their primary keys
+            changes = session.info.setdefault('changes', {})
+            for obj in session.new:
+                record(changes, object_mapper(obj), obj, 'insert')
+            for obj in session.deleted:
+                record(changes, object_mapper(obj), obj, 'delete')
+            for obj in list(session.new) + list(session.dirty):
+                if obj in session.dirty and not session.is_modified(obj):
+                    continue
+                mapper = object_mapper(obj)
+                if obj in session.dirty:
+                    record(changes, mapper, obj)
+                # a relationship may have changed on this side only,
+                # so the objects on the other side changed too
+                state = inspect(obj)
+                for rel in mapper.relationships:
+                    hist = state.attrs[rel.key].history
+                    if not hist.has_changes():
+                        continue
+                    for o in (hist.added or []) + (hist.deleted or []):
+                        if o is not None:
+                            record(changes, rel.mapper, o)
+                    if rel.secondary is not None:
+                        changes[rel.secondary.name] = None
+
+        def after_bulk(context):
+            record(context.session.info.setdefault('changes', {}),
+                   context.mapper)
+
+        def after_commit(session):
+            changes = session.info.pop('changes', None)
+            if not changes:
+                return
+            writer = self.__sqlite_writer
+            if writer is None or not writer.defer(changes):
+                self._announce_changes(changes)
+
+        def after_rollback(session):
+            session.info.pop('changes', None)
+
+        self.listen('before_flush', before_flush)
+        self.listen('after_flush', after_flush)
+        self.listen('after_bulk_update', after_bulk)
+        self.listen('after_bulk_delete', after_bulk)
+        self.listen('after_commit', after_commit)
+        self.listen('after_rollback', after_rollback)
+
+    def _announce_changes(self, changes):
+        logger.debug('DB changed: {}'.format(list(changes.keys())))
+        for cb in self.__change_callbacks:
+            cb(changes)
+
+    def enable_sqlite_writer(self, **kargs):
+        '''Serializes commits through an SQLiteWriter
+
+        Only for SQLite databases in a file; enables WAL. kargs are
+        passed to SQLiteWriter. Returns the SQLiteWriter.
+        '''
+
+        if self.__sqlite_writer is not None:
+            return self.__sqlite_writer
+        dbname = self.engine.url.database
+        if self.engine.dialect.name != 'sqlite' \
+                or dbname in (None, '', ':memory:'):
+            raise ValueError(
+                'SQLiteWriter needs an SQLite database in a file')
+        if not issubclass(self.__session.session_factory.class_,
+                          _RoutingSession):
+            raise ValueError(
+                'SQLiteWriter needs the default session class')
+        self.__sqlite_writer = SQLiteWriter(self, **kargs)
+        if self.__query_monitor is not None:
+            for engine in self.__sqlite_writer.engines:
+                self.__query_monitor.attach(engine)
+        self.__sqlite_writer.start()
+        return self.__sqlite_writer
+
+    def enable_replicas(self, urls, **kargs):
+        '''Routes reads of read-only sessions to replicas
+
+        kargs are passed to ReplicaSet. The replicas must have the
+        same schema as the primary. Returns the ReplicaSet.
+        '''
+
+        if not issubclass(self.__session.session_factory.class_,
+                          _RoutingSession):
+            raise ValueError(
+                'ReplicaSet needs the default session class')
+        self.__replicas = ReplicaSet(urls, **kargs)
+        if self.__query_monitor is not None:
+            for engine in self.__replicas.engines:
+                self.__query_monitor.attach(engine)
+        return self.__replicas
+
+    def prewarm(self, count=None):
+        '''Opens pooled connections ahead of the first requests
+
+        Checks out count connections (by default the pool size) at
+        once from every engine with a QueuePool, and returns them to
+        the pool. Returns the number of connections opened.
+        '''
+
+        opened = 0
+        for engine in self.__engines():
+            if not isinstance(engine.pool, QueuePool):
+                continue
+            conns = []
+            try:
+                for i in range(count or engine.pool.size()):
+                    conns.append(engine.connect())
+            finally:
+                opened += len(conns)
+                for conn in conns:
+                    conn.close()
+        return opened
+
+    def enable_query_monitor(self, **kargs):
+        '''Instruments all engines with a QueryMonitor
+
+        kargs are passed to QueryMonitor. Returns the QueryMonitor.
+        '''
+
+        if self.__query_monitor is None:
+            self.__query_monitor = QueryMonitor(**kargs)
+            for engine in self.__engines():
+                self.__query_monitor.attach(engine)
+        return self.__query_monitor
+
+    def __engines(self):
+        engines = [self.engine]
+        if self.__sqlite_writer is not None:
+            engines += self.__sqlite_writer.engines
+        if self.__replicas is not None:
+            engines += self.__replicas.engines
+        return engines
+
+    def enable_query_cache(self, size=1024, ttl=None):
+        '''Caches the results of filter_results (see QueryCache)
+
+        Committed sessions invalidate entries which depend on the
+        tables they changed (see track_changes). Give a ttl in seconds
+        if changes by other processes matter.
+        Returns the QueryCache.
+        '''
+
+        if self.__query_cache is None:
+            self.__query_cache = QueryCache(size=size, ttl=ttl)
+            self.track_changes(self.__query_cache.invalidate)
+        return self.__query_cache
+
     def populate_maps(self, cls):
         tbl = cls.__tablename__
         if tbl in self.maps:
@@ -214,20 +616,27 @@ class DBConnection:
         if self.url.startswith('sqlite'):
             if dbname is not None and os.path.isfile(dbname):
                 exists = True
+        elif self._schema_is_current():
+            # the fingerprint is saved in the database once its tables
+            # have been checked, no need to inspect the server
+            exists = True
         else:
             baseurl = self.url
             if dbname:
                 baseurl = baseurl.replace('/{}'.format(dbname), '')
             engine = create_engine(baseurl, **engine_kargs)
-            insp = Inspector.from_engine(engine)
-            if dbname in insp.get_schema_names():
-                exists = True
-            else:
-                logger.debug('Creating database')
-                with engine.connect() as connection:
-                    # TODO detect error
-                    connection.execute(
-                        'CREATE DATABASE {}'.format(dbname))
+            try:
+                insp = Inspector.from_engine(engine)
+                if dbname in insp.get_schema_names():
+                    exists = True
+                else:
+                    logger.debug('Creating database')
+                    with engine.connect() as connection:
+                        # TODO detect error
+                        connection.execute(
+                            'CREATE DATABASE {}'.format(dbname))
+            finally:
+                engine.dispose()
         if not exists:
             logger.debug('Creating tables')
             self.base.metadata.create_all(self.engine)
@@ -240,15 +649,23 @@ class DBConnection:
         return None
 
     def _create_engine(self, url, engine_kargs):
-        engine = create_engine(url, **engine_kargs)
-        return engine
+        return _new_engine(url, engine_kargs)
 
     def _ensure_is_sane(self):
         '''Checks the database for consistency
 
         The database must exist.
+        Reflecting all tables is slow on large databases, so once the
+        check passes, a fingerprint of the metadata is saved in the
+        database (see _schema_table); the check is skipped while it
+        matches, i.e. until the models change. Changes to the
+        database made outside of the models are not noticed then.
         '''
 
+        if self._schema_is_current():
+            logger.debug('Schema fingerprint matches, not checking')
+            return
+
         with self.session_context() as session:
             if not is_db_sane(self.base, session):
                 error = MetadataMistmatchError(
@@ -258,17 +675,60 @@ class DBConnection:
                 logger.error(str(error))
                 raise error
 
+        key = self.__schema_key()
+        try:
+            _schema_table.create(self.engine, checkfirst=True)
+            with self.engine.begin() as conn:
+                conn.execute(_schema_table.delete().where(
+                    _schema_table.c.base == key))
+                conn.execute(_schema_table.insert().values(
+                    base=key,
+                    fingerprint=_schema_fingerprint(self.base.metadata)))
+        except DatabaseError as e:
+            logger.warning(
+                'Could not save the schema fingerprint: {}'.format(e))
+
+    def _schema_is_current(self):
+        '''Returns True if the saved schema fingerprint matches
+
+        See _ensure_is_sane. Returns False if the database or the
+        fingerprint table does not exist.
+        '''
+
+        try:
+            with self.engine.connect() as conn:
+                stored = conn.execute(
+                    _schema_table.select().where(
+                        _schema_table.c.base
+                        == self.__schema_key())).first()
+        except DatabaseError:
+            return False  # no database or no table yet
+        return stored is not None and stored.fingerprint \
+            == _schema_fingerprint(self.base.metadata)
+
+    def __schema_key(self):
+        return '{}.{}'.format(self.base.__module__, self.base.__name__)
+
     @contextmanager
     def session_context(self,
                         reraise=True,
                         commit_at_end=True,
                         close_at_end=True,
+                        info={},
                         **kargs):
-        '''Creates a context with an open SQLAlchemy session.'''
+        '''Creates a context with an open SQLAlchemy session.
+
+        - info is merged into session.info for the duration of the
+          context; e.g. read_only and client for ReplicaSet
+        - Any additional keyword arguments are set as attributes of
+          the session
+        '''
 
         session = self.session()
         for k, v in kargs.items():
             setattr(session, k, v)
+        saved = {k: session.info[k] for k in info if k in session.info}
+        session.info.update(info)
         try:
             yield session
             if commit_at_end:
@@ -279,11 +739,123 @@ class DBConnection:
             if reraise:
                 raise
         finally:
+            for k in info:
+                session.info.pop(k, None)
+            session.info.update(saved)
             if close_at_end:
                 #  session.expunge_all()
                 session.close()
 
 
+class MeteredQueuePool(QueuePool):
+    '''QueuePool which keeps checkout statistics, see stats'''
+
+    def __init__(self, *args, **kargs):
+        super().__init__(*args, **kargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.__lock = threading.Lock()
+
+    def connect(self):
+        return self.__timed(super().connect)
+
+    def unique_connection(self):
+        return self.__timed(super().unique_connection)
+
+    def __timed(self, checkout):
+        start = time.time()
+        timeout = False
+        try:
+            return checkout()
+        except PoolTimeoutError:
+            timeout = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self.__lock:
+                self.checkouts += 1
+                self.timeouts += timeout
+                self.wait_time += elapsed
+                if elapsed > self.max_wait:
+                    self.max_wait = elapsed
+
+    def stats(self):
+        '''Returns a dictionary with:
+
+        - size, max_overflow: as configured; a negative max_overflow
+          means no limit
+        - checked_out: connections currently in use
+        - utilization: checked_out over size plus max_overflow, or
+          None if there is no limit
+        - checkouts, timeouts: number of checkouts and of those which
+          timed out waiting for a connection
+        - wait_time, max_wait: total and maximum seconds spent
+          checking out, including connecting
+        '''
+
+        checked_out = self.checkedout()
+        capacity = None
+        if self._max_overflow >= 0:
+            capacity = self.size() + self._max_overflow
+        with self.__lock:
+            return {
+                'size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_out': checked_out,
+                'utilization': (checked_out / capacity
+                                if capacity else None),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+            }
+
+def _new_engine(url, engine_kargs):
+    '''Creates an engine, with a MeteredQueuePool where possible
+
+    SQLite databases in a file use NullPool by default; they get a
+    MeteredQueuePool only if pool_size, max_overflow or pool_timeout
+    is given.
+    '''
+
+    kargs = dict(engine_kargs)
+    if 'poolclass' not in kargs and 'pool' not in kargs:
+        url_obj = make_url(url)
+        pool_cls = url_obj.get_dialect().get_pool_class(url_obj)
+        sqlite_file = url_obj.get_backend_name() == 'sqlite' \
+            and url_obj.database not in (None, '', ':memory:')
+        sized = any(k in kargs for k in
+                    ('pool_size', 'max_overflow', 'pool_timeout'))
+        if issubclass(pool_cls, QueuePool) or (sqlite_file and sized):
+            kargs['poolclass'] = MeteredQueuePool
+            if sqlite_file:
+                connect_args = {'check_same_thread': False}
+                connect_args.update(kargs.get('connect_args', {}))
+                kargs['connect_args'] = connect_args
+    return create_engine(url, **kargs)
+
+# bookkeeping for DBConnection._ensure_is_sane
+_schema_table = Table(
+    'mixnmatchttp_schema', MetaData(),
+    Column('base', String(255), primary_key=True),
+    Column('fingerprint', String(64), nullable=False))
+
+def _schema_fingerprint(metadata):
+    '''Returns a hash of the tables and columns in metadata'''
+
+    digest = hashlib.sha256()
+    for table in sorted(metadata.tables.values(),
+                        key=lambda t: t.fullname):
+        digest.update(repr(table.fullname).encode('utf-8'))
+        for c in table.columns:
+            digest.update(repr((c.name,
+                                repr(c.type),
+                                c.primary_key,
+                                c.nullable)).encode('utf-8'))
+    return digest.hexdigest()
+
 def parse_db_url(url):
     '''Returns a dictionary
 
@@ -320,7 +892,9 @@ def filter_results(db,
                    fparams,
                    expect_one=False,
                    load=[],
-                   joining=and_):
+                   options=[],
+                   joining=and_,
+                   cache=True):
     '''Returns the filtered result of a query on the given class
 
     - db is a database session
@@ -333,8 +907,16 @@ def filter_results(db,
       all()
     - load is a list of attributes (as names) which should be loaded
       eagerly
+    - options is a list of additional loader options (e.g.
+      joinedload, selectinload, load_only, lazyload) to apply to the
+      query; use it to control relationship loading per call site
     - joining is an expression operator determining how to join
       clauses
+    - If cache is True and the query cache of the connection has been
+      enabled (see DBConnection.enable_query_cache), then results are
+      taken from or saved to it. It is bypassed while the session has
+      uncommitted changes, so that these are seen. Loader options
+      built on each call still hit the cache if they are equal.
     '''
 
     def get_attrs(attrnames):
@@ -346,20 +928,803 @@ def filter_results(db,
             else getattr(cls, k) == v
             for k, v in fparams.items()])
 
-    options = []
+    def get_result(res):
+        if not expect_one:
+            return res
+        if not res:
+            raise NoResultFound('No row was found for one()')
+        if len(res) > 1:
+            raise MultipleResultsFound(
+                'Multiple rows were found for one()')
+        return res[0]
+
+    qcache = None
+    if cache and not (db.new or db.dirty or db.deleted
+                      or db.info.get('changes')):
+        dbconn = DBConnection.get(db)
+        if dbconn is not None:
+            qcache = dbconn.query_cache
+    if qcache is not None:
+        try:
+            key = (cls, _freeze(fparams), tuple(load),
+                   _freeze_options(options), joining)
+            hash(key)
+        except TypeError:
+            qcache = None
+    if qcache is not None:
+        data = qcache.get(key)
+        if data is not None:
+            return get_result(
+                [db.merge(o, load=False) for o in pickle.loads(data)])
+        since = qcache.generation
+
+    _options = list(options)
     if load:
-        options = [joinedload(*get_attrs(load))]
-    res = db.query(cls).filter(get_filter()).options(*options)
-    if expect_one:
-        return res.one()
-    return res.all()
+        _options.append(joinedload(*get_attrs(load)))
+    res = db.query(cls).filter(get_filter()).options(*_options).all()
+    if qcache is not None:
+        tables = set(_mapper_tables(class_mapper(cls)))
+        for k, v in fparams.items():
+            if isinstance(v, dict):
+                tables.update(_mapper_tables(
+                    getattr(cls, k).property.mapper))
+        for obj in res:
+            _loaded_tables(obj, tables)
+        try:
+            data = pickle.dumps(res, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.debug('Cannot cache {} results: {}'.format(
+                cls.__tablename__, e))
+        else:
+            qcache.put(key, data, tables, since, refs=options)
+    return get_result(res)
+
+def _freeze(fparams):
+    '''Returns a hashable version of filter_results' fparams'''
+
+    return tuple(sorted(
+        (k, _freeze(v) if isinstance(v, dict) else v)
+        for k, v in fparams.items()))
+
+def _freeze_options(options):
+    '''Returns a hashable description of filter_results' options
+
+    Loader options with the same paths, strategies and arguments give
+    the same description, even if they are different objects (e.g.
+    built on each call). Other options are described by their id, so
+    they must be kept alive along with the cache entry.
+    '''
+
+    def freeze(value, seen):
+        if isinstance(value, Load):
+            if id(value) in seen:
+                return None  # a Load's context refers back to it
+            return (value.__class__.__name__,
+                    freeze(value.__getstate__(), seen | {id(value)}))
+        if isinstance(value, dict):
+            return tuple(sorted(
+                (k, freeze(v, seen)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(v, seen) for v in value)
+        return value
+
+    return tuple(freeze(o, frozenset()) if isinstance(o, Load)
+                 else ('id', id(o)) for o in options)
+
+def _mapper_tables(mapper):
+    return [t.name for t in mapper.tables]
+
+def _loaded_tables(obj, tables, seen=None):
+    '''Adds the tables of obj and loaded related objects to tables'''
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    mapper = object_mapper(obj)
+    tables.update(_mapper_tables(mapper))
+    for rel in mapper.relationships:
+        if rel.key not in obj.__dict__:
+            continue  # not loaded
+        if rel.secondary is not None:
+            tables.add(rel.secondary.name)
+        val = obj.__dict__[rel.key]
+        if val is None:
+            continue
+        if not rel.uselist:
+            val = [val]
+        for o in val:
+            _loaded_tables(o, tables, seen)
+
+class QueryCache(object):
+    '''A bounded, thread-safe cache of filter_results results
+
+    Results are kept pickled, so each hit unpickles its own copies to
+    merge into the caller's session. Each entry depends on the tables
+    of the loaded objects and of the filter; invalidate drops all
+    entries which depend on any of the given tables. The least
+    recently used entries are dropped once there are more than size.
+    If ttl is given, entries expire after that many seconds.
+    '''
+
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        # key--(expiry, tables, data, refs)
+        self.__entries = OrderedDict()
+        self.__by_table = {}  # table--set of keys
+        self.__invalidated = {}  # table--generation
+        self.__cleared = -1
+        self.__generation = 0
+
+    @property
+    def generation(self):
+        '''Increases with every invalidation, see put'''
+
+        return self.__generation
+
+    def get(self, key):
+        '''Returns the cached data or None'''
+
+        with self.__lock:
+            try:
+                entry = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                self.__drop(key, entry)
+                self.misses += 1
+                return None
+            self.__entries[key] = entry  # most recently used
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, data, tables, since, refs=None):
+        '''Saves the data unless a table changed since generation since
+
+        - refs are kept alive along with the entry (e.g. objects
+          whose id is part of the key)
+        '''
+
+        with self.__lock:
+            if self.__cleared >= since or any(
+                    self.__invalidated.get(t, -1) >= since
+                    for t in tables):
+                return
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__drop(key, old)
+            expiry = None
+            if self.ttl is not None:
+                expiry = time.time() + self.ttl
+            self.__entries[key] = (expiry, tables, data, refs)
+            for t in tables:
+                self.__by_table.setdefault(t, set()).add(key)
+            while len(self.__entries) > self.size:
+                k, e = self.__entries.popitem(last=False)
+                self.__drop(k, e)
+
+    def invalidate(self, tables):
+        '''Drops entries depending on any of the tables'''
+
+        with self.__lock:
+            for t in tables:
+                self.__invalidated[t] = self.__generation
+                for key in self.__by_table.pop(t, ()):
+                    entry = self.__entries.pop(key, None)
+                    if entry is not None:
+                        self.__drop(key, entry)
+            self.__generation += 1
+
+    def clear(self):
+        '''Drops all entries'''
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__by_table.clear()
+            self.__cleared = self.__generation
+            self.__generation += 1
+
+    def __drop(self, key, entry):
+        for t in entry[1]:
+            keys = self.__by_table.get(t)
+            if keys is not None:
+                keys.discard(key)
+
+class SQLiteWriter(object):
+    '''Serializes the commits of a SQLite database in one thread
+
+    Enabled via DBConnection.enable_sqlite_writer. Sessions of that
+    DBConnection read through a pool of read-only connections, and
+    session.commit() hands the session to the writer thread, which
+    flushes it on its own connection and waits until it is
+    committed. Sessions queued at the same time are committed
+    together in one transaction, each in its own savepoint, so a
+    failing one does not affect the rest. Change callbacks (see
+    DBConnection.track_changes) run once the transaction is
+    committed.
+    - Sessions which flush before commit (autoflush, explicit flush,
+      bulk updates and deletes, or raw SQL) write directly via the
+      DBConnection's engine until their transaction ends, waiting
+      for the writer as needed (busy_timeout).
+    - batch_size is the maximum number of sessions per transaction
+    - batch_wait is the number of seconds to wait for more sessions
+      after the first one
+    - readers is the size of the read-only connection pool
+    - pragmas is a dictionary of PRAGMA name--value set on every
+      connection, in addition to (or overriding) default_pragmas.
+      The journal mode is always WAL.
+    '''
+
+    default_pragmas = {
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self,
+                 dconn,
+                 batch_size=64,
+                 batch_wait=0.002,
+                 readers=4,
+                 pragmas={}):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.batches = 0
+        self.commits = 0
+        self.max_batch = 0
+        self.__dconn = dconn
+        self.__pragmas = dict(self.default_pragmas)
+        self.__pragmas.update(pragmas)
+        self.__queue = queue.Queue()
+        self.__deferred = None
+        self.__thread = None
+
+        url = dconn.url
+        event.listen(dconn.engine, 'connect', self.__set_pragmas)
+        self.__engine = create_engine(
+            url,
+            poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+        event.listen(self.__engine, 'connect', self.__set_pragmas)
+        event.listen(self.__engine, 'connect', self.__no_autobegin)
+        event.listen(self.__engine, 'begin', self.__begin)
+        self.__reader = create_engine(
+            url,
+            poolclass=MeteredQueuePool,
+            pool_size=readers,
+            connect_args={'check_same_thread': False})
+        event.listen(self.__reader, 'connect', self.__set_pragmas)
+        event.listen(self.__reader, 'connect', self.__set_readonly)
+        self.__conn = self.__engine.connect()
+        mode = self.__conn.execute('PRAGMA journal_mode=WAL').scalar()
+        if mode.lower() != 'wal':
+            logger.warning(
+                'Could not enable WAL for {}, journal mode is {}'.format(
+                    url, mode))
+
+    @property
+    def connection(self):
+        '''The writer's connection, only used in the writer thread'''
+
+        return self.__conn
+
+    @property
+    def engines(self):
+        '''The writer's and the readers' engines'''
+
+        return [self.__engine, self.__reader]
+
+    @property
+    def reader(self):
+        '''Engine with the read-only connection pool'''
+
+        return self.__reader
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def in_writer(self):
+        '''Returns True if called from the writer thread'''
+
+        return self.__thread is threading.current_thread()
+
+    def start(self):
+        if self.running:
+            return
+        self.__thread = threading.Thread(
+            target=self.__run, name='SQLiteWriter', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        '''Commits the queued sessions and stops the thread
+
+        Sessions committed after it is stopped are committed directly
+        by their own thread.
+        '''
+
+        if not self.running:
+            return
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def commit(self, session, committer):
+        '''Calls committer(session) in the writer thread and waits
+
+        Re-raises any exception it raised, or the one raised while
+        committing the batch.
+        '''
+
+        unit = [session, committer, threading.Event(), None]
+        self.__queue.put(unit)
+        while not unit[2].wait(1):
+            # queued while the thread was stopping
+            if not self.running and not unit[2].is_set():
+                raise ServerDBError('The SQLiteWriter has stopped')
+        if unit[3] is not None:
+            raise unit[3]
+
+    def defer(self, changes):
+        '''Called by track_changes' after_commit in the writer thread
+
+        Returns True if the changes will be announced after the
+        batch is committed.
+        '''
+
+        if self.__deferred is None:
+            return False
+        self.__deferred.append(changes)
+        return True
+
+    def __run(self):
+        stop = False
+        while not stop:
+            unit = self.__queue.get()
+            if unit is None:
+                break
+            batch = [unit]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    unit = self.__queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if unit is None:
+                    stop = True
+                    break
+                batch.append(unit)
+            self.__commit(batch)
+        # commit the sessions queued after stop by threads which
+        # still saw it running
+        batch = []
+        while True:
+            try:
+                unit = self.__queue.get_nowait()
+            except queue.Empty:
+                break
+            if unit is not None:
+                batch.append(unit)
+        if batch:
+            self.__commit(batch)
+
+    def __commit(self, batch):
+        conn = self.__conn
+        self.__deferred = []
+        try:
+            trans = conn.begin()
+            try:
+                for unit in batch:
+                    savepoint = conn.begin_nested()
+                    try:
+                        unit[1](unit[0])
+                    except Exception as e:
+                        unit[3] = e
+                        if savepoint.is_active:
+                            savepoint.rollback()
+                    else:
+                        savepoint.commit()
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+        except Exception as e:
+            logger.error('Group commit failed: {}'.format(e))
+            for unit in batch:
+                if unit[3] is None:
+                    unit[3] = ServerDBError(e)
+        else:
+            self.batches += 1
+            self.commits += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            for changes in self.__deferred:
+                self.__dconn._announce_changes(changes)
+        finally:
+            self.__deferred = None
+            for unit in batch:
+                unit[2].set()
+
+    def __set_pragmas(self, dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for k, v in self.__pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(k, v))
+        cursor.close()
+
+    @staticmethod
+    def __set_readonly(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA query_only=1')
+        cursor.close()
+
+    @staticmethod
+    def __no_autobegin(dbapi_conn, conn_record):
+        # pysqlite's own transaction handling breaks savepoints;
+        # emit BEGIN ourselves instead
+        dbapi_conn.isolation_level = None
+
+    @staticmethod
+    def __begin(conn):
+        conn.execute('BEGIN IMMEDIATE')
+
+class ReplicaSet(object):
+    '''Read replicas of a DBConnection
+
+    Enabled via DBConnection.enable_replicas. Sessions marked read
+    only (session.info['read_only'], see session_context) read from
+    the replicas, round-robin, one replica per transaction. Once a
+    session writes, it uses the primary until its transaction ends.
+    - Replicas which fail (the engine's handle_error event with a
+      disconnect or an OperationalError) are skipped for
+      retry_after seconds. If all are down, the primary is used.
+    - If session.info['client'] identifies the client (e.g. its
+      session token), that client reads from the primary for window
+      seconds after committing a write, so it sees its own writes
+      despite replication lag.
+    '''
+
+    def __init__(self,
+                 urls,
+                 engine_kargs={},
+                 window=5,
+                 retry_after=30):
+        self.window = window
+        self.retry_after = retry_after
+        self.__engines = []
+        self.__lock = threading.Lock()
+        self.__next = 0
+        self.__down = {}  # engine--time it failed
+        self.__writes = OrderedDict()  # client--time of last commit
+        for url in urls:
+            engine = _new_engine(url, engine_kargs)
+            event.listen(engine, 'handle_error', self.__check_error)
+            self.__engines.append(engine)
+
+    @property
+    def engines(self):
+        return list(self.__engines)
+
+    @property
+    def healthy(self):
+        '''List of engines which are not being skipped'''
+
+        now = time.time()
+        with self.__lock:
+            return [e for e in self.__engines
+                    if self.__down.get(e, 0) + self.retry_after <= now]
+
+    def pick(self, client=None):
+        '''Returns the next healthy replica engine or None
+
+        None means the primary should be used.
+        '''
+
+        now = time.time()
+        with self.__lock:
+            if client is not None and \
+                    self.__writes.get(client, 0) + self.window > now:
+                return None
+            n = len(self.__engines)
+            for i in range(n):
+                engine = self.__engines[(self.__next + i) % n]
+                if self.__down.get(engine, 0) + self.retry_after <= now:
+                    self.__next = (self.__next + i + 1) % n
+                    return engine
+        return None
+
+    def note_write(self, client):
+        '''Starts the read-your-writes window of client'''
+
+        now = time.time()
+        with self.__lock:
+            self.__writes.pop(client, None)
+            self.__writes[client] = now
+            # oldest first, drop the ones outside the window
+            while self.__writes:
+                c, t = next(iter(self.__writes.items()))
+                if t + self.window > now:
+                    break
+                del self.__writes[c]
+
+    def mark_down(self, engine):
+        logger.warning('Replica {} is down'.format(engine.url))
+        with self.__lock:
+            self.__down[engine] = time.time()
+
+    def mark_up(self, engine):
+        with self.__lock:
+            self.__down.pop(engine, None)
+
+    def __check_error(self, context):
+        if context.engine is None:
+            return
+        if context.is_disconnect or isinstance(
+                context.original_exception,
+                context.engine.dialect.dbapi.OperationalError):
+            self.mark_down(context.engine)
+
+class QueryMonitor(object):
+    '''Counts and times the SQL statements of a DBConnection
+
+    Enabled via DBConnection.enable_query_monitor. Statements are
+    attributed to the request being handled by the same thread,
+    between begin and end (see DBConnection.begin_monitoring).
+    - Statements taking longer than slow seconds are logged as a
+      warning, along with the request's label.
+    - If the same statement (with any parameters) runs more than
+      repeat times in one request, it is logged once as a possible
+      N+1 query.
+    - queries, time, slow_queries and repeated are totals since
+      creation, including statements outside of requests; requests
+      is the number of requests ended.
+    '''
+
+    def __init__(self, slow=0.5, repeat=20):
+        self.slow = slow
+        self.repeat = repeat
+        self.queries = 0
+        self.time = 0.0
+        self.slow_queries = 0
+        self.repeated = 0
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def stats(self):
+        '''Returns a dictionary of the totals'''
+
+        with self.__lock:
+            return {
+                'queries': self.queries,
+                'time': self.time,
+                'slow_queries': self.slow_queries,
+                'repeated': self.repeated,
+                'requests': self.requests,
+            }
+
+    def attach(self, engine):
+        '''Listens to the cursor executions of engine'''
+
+        event.listen(engine, 'before_cursor_execute', self.__before)
+        event.listen(engine, 'after_cursor_execute', self.__after)
+
+    def begin(self, label=None):
+        '''Starts counting for the current thread's request'''
+
+        local = self.__local
+        local.label = label
+        local.queries = 0
+        local.time = 0.0
+        local.shapes = {}  # statement--count
+
+    def end(self):
+        '''Returns (queries, time) of the current request or None'''
+
+        local = self.__local
+        if getattr(local, 'shapes', None) is None:
+            return None
+        result = (local.queries, local.time)
+        local.shapes = local.label = None
+        with self.__lock:
+            self.requests += 1
+        if result[0]:
+            logger.debug('{} queries in {:.3f}s for {}'.format(
+                result[0], result[1], self.__label()))
+        return result
+
+    def __label(self):
+        label = getattr(self.__local, 'label', None)
+        if label is None:
+            return 'no request'
+        return label
+
+    def __before(self, conn, cursor, statement, parameters,
+                 context, executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def __after(self, conn, cursor, statement, parameters,
+                context, executemany):
+        elapsed = time.time() - conn.info['query_start'].pop()
+        slow = self.slow is not None and elapsed > self.slow
+        repeated = False
+        local = self.__local
+        shapes = getattr(local, 'shapes', None)
+        if shapes is not None:
+            local.queries += 1
+            local.time += elapsed
+            n = shapes[statement] = shapes.get(statement, 0) + 1
+            repeated = n == self.repeat + 1
+        with self.__lock:
+            self.queries += 1
+            self.time += elapsed
+            self.slow_queries += slow
+            self.repeated += repeated
+        if slow:
+            logger.warning('Slow query ({:.3f}s) in {}: {}'.format(
+                elapsed, self.__label(), statement))
+        if repeated:
+            logger.warning(
+                ('Statement ran more than {} times in {}, '
+                 'possible N+1 query: {}').format(
+                     self.repeat, self.__label(), statement))
+
+class _CountingSessionMaker(sessionmaker):
+    '''sessionmaker which calls on_create with each new session'''
+
+    def __init__(self, on_create, **kargs):
+        super().__init__(**kargs)
+        self.on_create = on_create
+
+    def __call__(self, **local_kw):
+        session = super().__call__(**local_kw)
+        self.on_create(session)
+        return session
+
+class _RoutingSession(Session):
+    '''Session class of DBConnection
+
+    Routes reads and commits when an SQLiteWriter or a ReplicaSet is
+    enabled
+    '''
+
+    _dbconn = None  # set by DBConnection
+
+    def get_bind(self, mapper=None, clause=None):
+        dconn = self._dbconn
+        writer = dconn.sqlite_writer
+        if writer is not None and writer.in_writer():
+            return writer.connection
+        if self._flushing or not (
+                clause is None or isinstance(clause, Select)):
+            self.info['wrote'] = True
+        elif not self.info.get('wrote'):
+            replicas = dconn.replicas
+            if replicas is not None and self.info.get('read_only'):
+                replica = self.info.get('replica')
+                if replica is None:
+                    replica = self.info['replica'] = replicas.pick(
+                        self.info.get('client'))
+                if replica is not None:
+                    return replica
+            if writer is not None:
+                return writer.reader
+        return super().get_bind(mapper=mapper, clause=clause)
+
+    def commit(self):
+        dconn = self._dbconn
+        writer = dconn.sqlite_writer
+        wrote = self.info.get('wrote') or not self._is_clean()
+        try:
+            if writer is None or not writer.running \
+                    or writer.in_writer() \
+                    or self.info.get('wrote') \
+                    or self.transaction is None \
+                    or self.transaction.nested \
+                    or not wrote:
+                super().commit()
+            else:
+                writer.commit(self, Session.commit)
+        finally:
+            self.__end()
+        client = self.info.get('client')
+        if wrote and client is not None and dconn.replicas is not None:
+            dconn.replicas.note_write(client)
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self.__end()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.__end()
+
+    def __end(self):
+        self.info.pop('wrote', None)
+        self.info.pop('replica', None)
+
+def paginate_query(query,
+                   limit=None,
+                   after=None,
+                   fields=None,
+                   peek=False):
+    '''Restricts a query on a single mapper class
+
+    - If fields is given, it should be a list of attribute names of
+      the class; only the columns among them (and the primary key)
+      are loaded.
+    - If limit or after is given, the results are ordered by the
+      primary key (replacing any order_by of the query), and only
+      rows with a primary key greater than after are returned, at
+      most limit of them. after is converted to the Python type of
+      the primary key column.
+    - If peek is True, one more row than limit is returned, so that
+      the caller can tell if there is a next page.
+    Returns the new query and the name of the primary key attribute,
+    so that the cursor for the next page (the after value) can be
+    taken from the last result.
+    Raises InvalidQueryError for unknown fields or an invalid after,
+    or if the query is not on a single mapper class with a single
+    column primary key.
+    '''
+
+    descs = query.column_descriptions
+    if len(descs) != 1 or descs[0]['expr'] is not descs[0]['entity'] \
+            or not is_mapper(descs[0]['entity']):
+        raise InvalidQueryError(
+            'Only queries on a single table can be restricted')
+    cls = descs[0]['entity']
+    mapper = class_mapper(cls)
+    if len(mapper.primary_key) != 1:
+        raise InvalidQueryError(
+            '{} does not have a single primary key'.format(
+                cls.__tablename__))
+    pk_col = mapper.primary_key[0]
+    pk = mapper.get_property_by_column(pk_col).key
+
+    if fields is not None:
+        unknown = [f for f in fields if f not in mapper.attrs]
+        if unknown:
+            raise InvalidQueryError(
+                'Unknown fields for {}: {}'.format(
+                    cls.__tablename__, ', '.join(unknown)))
+        columns = [f for f in fields if f in mapper.column_attrs]
+        query = query.options(load_only(*(columns or [pk])))
+    if limit is None and after is None:
+        return query, pk
+
+    if after is not None:
+        try:
+            python_type = pk_col.type.python_type
+        except NotImplementedError:
+            python_type = None
+        if python_type is not None:
+            try:
+                after = python_type(after)
+            except (TypeError, ValueError):
+                raise InvalidQueryError(
+                    'after should be a valid {}'.format(pk))
+        query = query.filter(getattr(cls, pk) > after)
+    query = query.order_by(None).order_by(getattr(cls, pk))
+    if limit is not None:
+        query = query.limit(limit + 1 if peek else limit)
+    return query, pk
 
 def object_to_dict(obj,
                    skip='_id$',
                    no_skip=None,
                    max_depth=None,
                    convert_timestamp=date_from_timestamp,
-                   short_mappings={}):
+                   short_mappings={},
+                   fields=None):
     '''Returns a dictionary of the mapper object's columns
 
     Supports relationships (converts these to dictionaries).
@@ -367,6 +1732,9 @@ def object_to_dict(obj,
       skipped.
     - noskip is a regex of keys to be included and overrides any match
       in skip.
+    - If fields is given, it is a list of keys; only those (which are
+      not skipped) are included. It applies to the top-level object
+      only, not to related objects.
     - If max_depth is given, then it specifies the maximum depth of
       the dictionary. At the last level, objects are converted to
       strings via a predefined format containing one or more columns.
@@ -393,94 +1761,181 @@ def object_to_dict(obj,
       and with keys containing the word "time" or "date" (non-case
       sensitive). Both conditions have to match for the value to be
       converted. Local timezone is assumed.
+    The conversion is done by an ObjectSerializer, compiled once for
+    the object's class and these options.
     '''
 
     if max_depth is not None and max_depth < 0:
         raise ValueError('max_depth must be non-negative')
 
-    return _object_to_dict(obj,
-                           skip=skip,
-                           no_skip=no_skip,
-                           max_depth=max_depth,
-                           convert_timestamp=convert_timestamp,
-                           short_mappings=short_mappings)
-
-def _object_to_dict(obj,
-                    skip,
-                    no_skip,
-                    max_depth,
-                    convert_timestamp,
-                    short_mappings,
-                    seen=None):
-    def transform_value(key, val, seen):
+    return ObjectSerializer.get(
+        obj.__class__,
+        skip=skip,
+        no_skip=no_skip,
+        max_depth=max_depth,
+        convert_timestamp=convert_timestamp,
+        short_mappings=short_mappings,
+        fields=fields)(obj)
+
+class ObjectSerializer(object):
+    '''Converts objects of a single mapper class to dictionaries
+
+    Instances are callables which behave like object_to_dict for a
+    given set of options. The attributes to include, whether each one
+    may hold a timestamp and whether it is a column or relationship
+    are worked out once, when compiling, so serializing an object
+    only reads its attributes. Serializers of related classes are
+    compiled the first time an object of that class is met.
+    Use the get class method rather than instantiating directly, it
+    caches serializers per mapper class and options.
+    '''
+
+    _max_cached = 512
+    __cache = {}  # (class, options, max_depth, seen, fields)--serializer
+    __default_short_mappings = {
+        'user': ['{}', 'username'],
+        'session': ['{}', 'token'],
+        'role': ['{}', 'name']}
+    __plain_types = (str, bytes, int, float, type(None))
+    __COLUMN, __RELATIONSHIP, __OTHER = range(3)
+
+    def __init__(self, cls, options, max_depth, seen, fields=None):
+        '''Compiles the serializer
+
+        - options is a tuple of skip, no_skip, convert_timestamp and
+          short_mappings, the latter as a sorted tuple of
+          (table name, tuple of format and columns), already merged
+          with the default
+        - seen is a frozenset of table names met on the way to this
+          class, including its own
+        - fields is None or a frozenset of the keys to include
+        '''
+
+        skip, no_skip, convert_timestamp, short_mappings = options
+        self.__cls = cls
+        self.__options = options
+        self.__max_depth = max_depth
+        self.__seen = seen
+        self.__convert_timestamp = convert_timestamp
+        self.__children = {}
+        self.__attrs = []  # (key, kind, may be a timestamp)
+        mapper = class_mapper(cls)
+        if max_depth == 0:
+            fmt = dict(short_mappings).get(
+                cls.__tablename__, ('{}', 'id'))
+            self.__short_fmt = fmt[0]
+            self.__short_attrs = [
+                (a, a in mapper.columns) for a in fmt[1:]]
+            return
+        for prop in mapper.attrs:
+            key = prop.key
+            if fields is not None and key not in fields:
+                continue
+            if (skip is not None and re.search(skip, key)) \
+                    and (no_skip is None
+                         or not re.search(no_skip, key)):
+                continue
+            if isinstance(prop, RelationshipProperty):
+                kind = self.__RELATIONSHIP
+            elif isinstance(prop, ColumnProperty):
+                kind = self.__COLUMN
+            else:
+                kind = self.__OTHER
+            timelike = convert_timestamp is not None and bool(
+                re.search('time|date', key, re.IGNORECASE))
+            self.__attrs.append((key, kind, timelike))
+        logger.debug('Compiled serializer for {}: {}'.format(
+            cls.__tablename__, [a[0] for a in self.__attrs]))
+
+    @classmethod
+    def get(cls,
+            mapper_cls,
+            skip='_id$',
+            no_skip=None,
+            max_depth=None,
+            convert_timestamp=date_from_timestamp,
+            short_mappings={},
+            fields=None):
+        '''Returns a (cached) serializer for the mapper class
+
+        Arguments are the same as for object_to_dict.
+        '''
+
+        _short_mappings = cls.__default_short_mappings.copy()
+        _short_mappings.update(short_mappings)
+        options = (skip, no_skip, convert_timestamp, tuple(sorted(
+            (k, tuple(v)) for k, v in _short_mappings.items())))
+        if fields is not None:
+            fields = frozenset(fields)
+        return cls._get(mapper_cls, options, max_depth,
+                        frozenset([mapper_cls.__tablename__]), fields)
+
+    @classmethod
+    def _get(cls, mapper_cls, options, max_depth, seen, fields=None):
+        key = (mapper_cls, options, max_depth, seen, fields)
+        try:
+            return cls.__cache[key]
+        except KeyError:
+            pass
+        serializer = cls(mapper_cls, options, max_depth, seen, fields)
+        if len(cls.__cache) >= cls._max_cached:
+            # max_depth may come from the client
+            cls.__cache.clear()
+        cls.__cache[key] = serializer
+        return serializer
+
+    def __call__(self, obj):
+        if self.__max_depth == 0:
+            return self.__short_value(obj)
+        data = {}
+        for key, kind, timelike in self.__attrs:
+            val = getattr(obj, key)
+            if kind == self.__RELATIONSHIP:
+                if val is not None:
+                    val = self.__transform(val, timelike)
+            elif kind == self.__OTHER or timelike \
+                    or not isinstance(val, self.__plain_types):
+                val = self.__transform(val, timelike)
+            data[key] = val
+        return data
+
+    def __transform(self, val, timelike):
         if is_seq_like(val):
-            result = []
-            first = True
-            for e in val:
-                v = transform_value(key, e, seen)
-                result.append(v)
-                first = False
-            return result
-        elif convert_timestamp is not None and is_time_like(val) \
-                and re.search('time|date', key, re.IGNORECASE):
-            return convert_timestamp(val)
+            return [self.__transform(e, timelike) for e in val]
+        elif timelike and is_time_like(val):
+            return self.__convert_timestamp(val)
         elif is_mapper(val.__class__):
-            logger.debug('tansforming {}, seen: {}'.format(
-                val.__tablename__, seen))
-            if val.__tablename__ in seen:
-                this_max_depth = 0
-                logger.debug(
-                    '{} already seen'.format(val.__tablename__))
-            elif max_depth is None:
-                this_max_depth = None
-            else:
-                this_max_depth = max_depth - 1
-            seen = seen.union([val.__tablename__])
-            return _object_to_dict(
-                val,
-                skip=skip,
-                no_skip=no_skip,
-                short_mappings=short_mappings,
-                max_depth=this_max_depth,
-                convert_timestamp=convert_timestamp,
-                seen=seen)
+            return self.__child(val.__class__)(val)
         # assume it's a simple value like int or string
-        # should we check here if it's JSON serializable and ommit
-        # if not?
         return val
 
-    def get_short_value(obj):
-        _short_mappings = {
-            'user': ['{}', 'username'],
-            'session': ['{}', 'token'],
-            'role': ['{}', 'name']}
-        _short_mappings.update(short_mappings)
+    def __child(self, cls):
         try:
-            fmt = _short_mappings[obj.__tablename__]
+            return self.__children[cls]
         except KeyError:
-            fmt = ['{}', 'id']
+            pass
+        tbl = cls.__tablename__
+        if tbl in self.__seen:
+            logger.debug('{} already seen'.format(tbl))
+            max_depth = 0
+        elif self.__max_depth is None:
+            max_depth = None
+        else:
+            max_depth = self.__max_depth - 1
+        child = self.__class__._get(
+            cls, self.__options, max_depth, self.__seen.union([tbl]))
+        self.__children[cls] = child
+        return child
+
+    def __short_value(self, obj):
         vals = []
-        for attr in fmt[1:]:
+        for attr, is_column in self.__short_attrs:
             val = getattr(obj, attr)
-            while is_mapper(val.__class__):
-                val = get_short_value(val)
+            if not is_column and is_mapper(val.__class__):
+                val = self.__class__._get(
+                    val.__class__, self.__options, 0, self.__seen)(val)
             vals.append(val)
-        return fmt[0].format(*vals)
-
-    if max_depth == 0:
-        return get_short_value(obj)
-    insp = inspect(obj)
-    data = {}
-    if seen is None:
-        seen = set([obj.__tablename__])
-    for attr in insp.attrs:
-        if (skip is not None and re.search(skip, attr.key)) \
-                and (no_skip is None
-                     or not re.search(no_skip, attr.key)):
-            continue
-        val = transform_value(attr.key, attr.value, seen)
-        data[attr.key] = val
-    return data
+        return self.__short_fmt.format(*vals)
 
 def object_from_dict(db, cls, dic,
                      must_not_exist=False,
@@ -488,7 +1943,8 @@ def object_from_dict(db, cls, dic,
                      must_exist=False,
                      children_must_exist=False,
                      idprops={},
-                     add=False):
+                     add=False,
+                     batch=None):
     '''Creates or updates an object from a dictionary
 
     - If the dictionary describes uniquely an object already in the
@@ -513,6 +1969,8 @@ def object_from_dict(db, cls, dic,
       exist.
     - If children_must_exist is True, then any children of the object
       must exist, otherwise the same exception is raised.
+    - batch is used by bulk_objects_from_dicts: a BatchLookup which
+      has prefetched the existing objects.
     - Returns the object.
     '''
 
@@ -568,7 +2026,8 @@ def object_from_dict(db, cls, dic,
                         children_must_not_exist=must_not_exist,
                         must_exist=children_must_exist,
                         children_must_exist=children_must_exist,
-                        add=add)
+                        add=add,
+                        batch=batch)
                     for d in val]
             elif is_map_like(val):
                 lrkeys = relationships[key]['keys']
@@ -591,7 +2050,8 @@ def object_from_dict(db, cls, dic,
                     children_must_not_exist=must_not_exist,
                     must_exist=children_must_exist,
                     children_must_exist=children_must_exist,
-                    add=(lrkeys is None))
+                    add=(lrkeys is None),
+                    batch=batch)
                 if lrkeys is not None:
                     # get the value on the remote side of this foreign
                     # key and add it to the object we are creating
@@ -617,7 +2077,11 @@ def object_from_dict(db, cls, dic,
     if uprops:
         logger.debug('Looking for {} based on {}'.format(
             tbl, uprops))
-        res = filter_results(db, cls, uprops)
+        known = False
+        if batch is not None:
+            known, res = batch.find(cls, uprops)
+        if not known:
+            res = filter_results(db, cls, uprops)
         assert len(res) <= 1
         if res:
             logger.debug('Found {} in DB'.format(tbl))
@@ -628,6 +2092,8 @@ def object_from_dict(db, cls, dic,
             obj = res[0]
             for k, v in props.items():
                 setattr(obj, k, v)
+            if batch is not None:
+                batch.register(obj)
             return obj
 
     if must_exist:
@@ -641,20 +2107,178 @@ def object_from_dict(db, cls, dic,
     if add:
         logger.debug('Adding {} object'.format(tbl))
         db.add(obj)
+    if batch is not None:
+        # a later lookup would find it after an autoflush, or (if not
+        # added now) once it is added along with its parent
+        batch.register(obj)
     return obj
 
-def bulk_objects_from_dicts(db, cls, dics, **kargs):
+def bulk_objects_from_dicts(db, cls, dics, batch=False, **kargs):
     '''Creates or updates objects from a list of dictionaries
 
-    Keyword arguments are same as object_from_dict
+    - If batch is True, then existing objects (and children) are
+      looked up beforehand with one query per table and unique
+      column set (see BatchLookup), rather than one query per object.
+      Objects are then compared to the dictionaries in Python, so
+      this relies on the database comparing values exactly (e.g. not
+      case-insensitive collations).
+    Other keyword arguments are same as object_from_dict
     '''
 
+    lookup = None
+    if batch:
+        lookup = BatchLookup(db)
+        lookup.prefetch(cls, dics, kargs.get('idprops', {}))
     result = []
     for dic in dics:
-        obj = object_from_dict(db, cls, dic, **kargs)
+        obj = object_from_dict(db, cls, dic, batch=lookup, **kargs)
         result.append(obj)
     return result
 
+class BatchLookup(object):
+    '''Prefetched existing objects for bulk_objects_from_dicts
+
+    object_from_dict looks up an existing object by the values of its
+    unique column sets. prefetch collects those values from all
+    dictionaries (and their children) and loads the matching objects
+    with one query per table and unique column set (in chunks of
+    chunk_size values). find then answers lookups for prefetched
+    values from memory, or tells the caller to query the database
+    (e.g. for values which come from a newly created parent).
+    Objects created or updated during the batch are registered, so
+    that they are found as they would be after an autoflush.
+    '''
+
+    chunk_size = 500
+
+    def __init__(self, db):
+        self.__db = db
+        self.__dbconn = DBConnection.get(db)
+        assert self.__dbconn is not None
+        self.__index = {}  # (class, column set)--{values: object}
+        self.__fetched = {}  # (class, column set)--set of values
+
+    def prefetch(self, cls, dics, idprops={}):
+        '''Loads existing objects which dics may refer to'''
+
+        groups = {}
+        self.__collect(cls, dics, idprops, groups)
+        for (_cls, ucset), values in groups.items():
+            values = list(values)
+            self.__fetched.setdefault((_cls, ucset), set()).update(
+                values)
+            self.__index.setdefault((_cls, ucset), {})
+            for i in range(0, len(values), self.chunk_size):
+                chunk = values[i:i + self.chunk_size]
+                if len(ucset) == 1:
+                    crit = getattr(_cls, ucset[0]).in_(
+                        [v[0] for v in chunk])
+                else:
+                    crit = or_(*[
+                        and_(*[getattr(_cls, c) == v
+                               for c, v in zip(ucset, vals)])
+                        for vals in chunk])
+                for obj in self.__db.query(_cls).filter(crit):
+                    self.register(obj)
+            logger.debug('Prefetched {} {} by {}'.format(
+                len(values), _cls.__tablename__, ucset))
+
+    def find(self, cls, uprops):
+        '''Looks up an object by the given column values
+
+        Returns a tuple of (known, result): if known is False, the
+        values have not been prefetched and the database should be
+        queried; otherwise result is a list of zero or one object,
+        like filter_results.
+        '''
+
+        for ucset in self.__ucsets(cls):
+            if (cls, ucset) not in self.__fetched \
+                    or not all(c in uprops for c in ucset):
+                continue
+            try:
+                key = self.__key(cls, ucset, uprops.get)
+                if key not in self.__fetched[(cls, ucset)]:
+                    continue
+                obj = self.__index[(cls, ucset)].get(key)
+                if obj is not None and not all(
+                        self.__coerce(cls, c, getattr(obj, c)) ==
+                        self.__coerce(cls, c, v)
+                        for c, v in uprops.items()):
+                    obj = None
+            except ValueError:
+                return False, None
+            return True, [] if obj is None else [obj]
+        return False, None
+
+    def register(self, obj):
+        '''Adds an object which now exists'''
+
+        cls = obj.__class__
+        for ucset in self.__ucsets(cls):
+            try:
+                key = self.__key(
+                    cls, ucset, lambda c: getattr(obj, c))
+            except ValueError:
+                continue
+            if None in key:
+                continue
+            self.__index.setdefault((cls, ucset), {})[key] = obj
+            self.__fetched.setdefault((cls, ucset), set()).add(key)
+
+    def __collect(self, cls, dics, idprops, groups):
+        self.__dbconn.populate_maps(cls)
+        maps = self.__dbconn.maps[cls.__tablename__]
+        for dic in dics:
+            props = dict(
+                (k, v) for k, v in dic.items() if k in maps['columns'])
+            props.update(idprops)
+            for ucset in self.__ucsets(cls):
+                if not all(c in props for c in ucset):
+                    continue
+                try:
+                    key = self.__key(cls, ucset, props.get)
+                except ValueError:
+                    continue
+                if None not in key:
+                    groups.setdefault((cls, ucset), set()).add(key)
+            for key, val in dic.items():
+                if key not in maps['relationships']:
+                    continue
+                rcls = maps['relationships'][key]['class']
+                if is_seq_like(val):
+                    self.__collect(rcls, val, {}, groups)
+                elif is_map_like(val):
+                    self.__collect(rcls, [val], {}, groups)
+
+    def __ucsets(self, cls):
+        self.__dbconn.populate_maps(cls)
+        return [tuple(u) for u in
+                self.__dbconn.maps[cls.__tablename__][
+                    'uniq_column_sets']]
+
+    def __key(self, cls, ucset, get):
+        return tuple(self.__coerce(cls, c, get(c)) for c in ucset)
+
+    def __coerce(self, cls, column, value):
+        '''Converts to the column's Python type, raises ValueError'''
+
+        if value is None:
+            return None
+        coltype = self.__dbconn.maps[cls.__tablename__][
+            'columns'].get(column)
+        try:
+            python_type = coltype.python_type
+        except (AttributeError, NotImplementedError):
+            return value
+        if isinstance(value, python_type):
+            return value
+        try:
+            return python_type(value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                'Cannot convert {} to {}'.format(value, python_type))
+
 def delete_from_dict(db, cls, dic):
     '''Deletes an object from a dictionary
 
@@ -679,7 +2303,7 @@ def update_from_dict(db, cls, dic, idprops={}):
                             idprops=idprops,
                             must_exist=True)
 
-def bulk_update_from_dicts(db, cls, dics, idprops={}):
+def bulk_update_from_dicts(db, cls, dics, idprops={}, batch=False):
     '''Updates objects from a list of dictionaries
 
     Same as bulk_objects_from_dicts, except it requires them to exist
@@ -687,4 +2311,5 @@ def bulk_update_from_dicts(db, cls, dics, idprops={}):
 
     return bulk_objects_from_dicts(db, cls, dics,
                                    idprops=idprops,
-                                   must_exist=True)
+                                   must_exist=True,
+                                   batch=batch)
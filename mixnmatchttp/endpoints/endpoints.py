@@ -85,6 +85,19 @@ class Endpoint(DictNoClobber):
         raw_args: <bool>, defaults to False
         varname: <string>, only for wildcards, defaults to parent's
                  name
+        cache: <dict>, defaults to {}; if set, complete 200
+               responses to GET are cached server-side, see
+               BaseHTTPRequestHandler.response_cache. Recognized
+               keys:
+                 - ttl: seconds after which an entry expires
+                 - poller: name of a poller whose tag invalidates
+                   entries when it changes
+                 - params: query parameters to key entries on,
+                   defaults to all of them
+                 - vary: request headers to key entries on
+                 - per_user: if True, responses to authenticated
+                   requests are cached too, separately for each user;
+                   otherwise those are never cached
     Attempting to set another attribute (a key beginning with $) will
     result in AttributeError. If you want to add additional
     attributes, add them as keys to the instance's _defaultattrs
@@ -100,6 +113,7 @@ class Endpoint(DictNoClobber):
             'nargs': 0,
             'raw_args': False,
             'varname': '',
+            'cache': {},
         }
 
         # Set the name of the endpoint before initializing, so that
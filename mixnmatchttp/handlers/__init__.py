@@ -1,9 +1,10 @@
 from .base import BaseHTTPRequestHandler, methodhandler
 from .authenticator import AuthCookieHTTPRequestHandler, \
-    AuthJWTHTTPRequestHandler
+    AuthJWTHTTPRequestHandler, AuthSignedCookieHTTPRequestHandler
 try:
     from .authenticator import AuthCookieDatabaseHTTPRequestHandler, \
-        AuthJWTDatabaseHTTPRequestHandler
+        AuthJWTDatabaseHTTPRequestHandler, \
+        AuthSignedCookieDatabaseHTTPRequestHandler
 except ImportError:
     pass
 from .cacher import CachingHTTPRequestHandler
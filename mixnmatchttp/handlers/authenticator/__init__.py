@@ -1,11 +1,13 @@
 from .api import BaseAuthHTTPRequestHandler
 from .session import \
-    BaseAuthCookieHTTPRequestHandler, BaseAuthJWTHTTPRequestHandler
+    BaseAuthCookieHTTPRequestHandler, BaseAuthJWTHTTPRequestHandler, \
+    BaseAuthSignedCookieHTTPRequestHandler
 from .storage import BaseAuthInMemoryHTTPRequestHandler
 try:  # optional database classes
     from .dbstorage import BaseAuthSQLAlchemyORMHTTPRequestHandler
     from .dbutils import needs_db_response_handling, \
-        needs_db_error_response_handling, needs_db
+        needs_db_error_response_handling, needs_db, \
+        table_validator, row_validator
 except ImportError:  # no SQLAlchemy
     pass
 else:
@@ -23,6 +25,13 @@ else:
 
         pass
 
+    class AuthSignedCookieDatabaseHTTPRequestHandler(
+            BaseAuthSignedCookieHTTPRequestHandler,
+            BaseAuthSQLAlchemyORMHTTPRequestHandler):
+        '''Stateless signed cookie auth (DB storage of users)'''
+
+        pass
+
 class AuthCookieHTTPRequestHandler(
         BaseAuthInMemoryHTTPRequestHandler,
         BaseAuthCookieHTTPRequestHandler):
@@ -36,3 +45,10 @@ class AuthJWTHTTPRequestHandler(
     '''JWT-based auth with refresh tokens (in-memory storage)'''
 
     pass
+
+class AuthSignedCookieHTTPRequestHandler(
+        BaseAuthSignedCookieHTTPRequestHandler,
+        BaseAuthInMemoryHTTPRequestHandler):
+    '''Stateless signed cookie auth (in-memory storage of users)'''
+
+    pass
@@ -185,11 +185,18 @@ class BaseAuthHTTPRequestHandlerMeta(BaseMeta):
             '_cookie_name': (is_any_true, [is_str]),
             '_cookie_len': (isinstance, int),
             '_cookie_lifetime': (isinstance, (int, type(None))),
+            '_encrypt_cookie': (isinstance, bool),
+            '_signed_cookie_max_lifetime': (isinstance, int),
             '_SameSite': (is_one_of, [None, 'lax', 'strict']),
             '_jwt_lifetime': (isinstance, int),
             '_send_new_refresh_token': (isinstance, bool),
             '_refresh_token_lifetime': (isinstance, int),
             '_refresh_token_len': (isinstance, int),
+            '_jwt_cache_size': (isinstance, int),
+            '_jwt_leeway': (isinstance, (int, float)),
+            '_user_cache_ttl': (isinstance, (int, float)),
+            '_change_feed_acl': (is_any_true, [is_seq_like]),
+            '_db_stats_acl': (is_any_true, [is_seq_like]),
         }
 
         if key in transformer:
@@ -426,7 +433,7 @@ class BaseAuthHTTPRequestHandler(
 
     @classmethod
     def get_all_sessions(cls):
-        '''Should return a list of Sessions
+        '''Should return a list (or an iterator) of Sessions
 
         Child class should implement
         '''
@@ -452,6 +459,18 @@ class BaseAuthHTTPRequestHandler(
 
         raise NotImplementedError
 
+    @classmethod
+    def rm_user_sessions(cls, user):
+        '''Deletes all Sessions of the user
+
+        Child class may override this with a more efficient
+        implementation; the default one scans all sessions.
+        '''
+
+        for s in list(cls.get_all_sessions()):
+            if s.user.username == user.username:
+                cls.rm_session(s)
+
     @classmethod
     def find_user(cls, username):
         '''Should return the User for that username
@@ -474,12 +493,23 @@ class BaseAuthHTTPRequestHandler(
     def update_user(cls, user):
         '''Called after changing user's attributes
 
-        Should perform any necessary post-update actions
+        Should perform any necessary post-update actions, including
+        calling forget_user.
         Child class should implement
         '''
 
         raise NotImplementedError
 
+    @classmethod
+    def forget_user(cls, username):
+        '''Called by update_user after a user has changed
+
+        Does nothing; child classes which cache users override it to
+        drop the cached copy.
+        '''
+
+        pass
+
     def send_response_auth(self, error=None):
         '''Sends the response to a one of our endpoints
 
@@ -595,7 +625,11 @@ class BaseAuthHTTPRequestHandler(
         a Session with a None token (but valid User and expiry).
         '''
 
-        session = self.find_session(self.get_current_token())
+        token = self.get_current_token()
+        if token is None:
+            logger.debug('No session token')
+            return None
+        session = self.find_session(token)
         if session is None:
             logger.debug('No session')
             return None
@@ -609,6 +643,18 @@ class BaseAuthHTTPRequestHandler(
             session.user.username))
         return session
 
+    def response_cache_user(self):
+        '''Returns the username of the current session
+
+        If there is no valid session, returns the Authorization
+        header, or None if there is none either.
+        '''
+
+        session = self.get_current_session()
+        if session is None or session.user is None:
+            return super().response_cache_user()
+        return session.user.username
+
     def expire_current_session(self):
         '''Invalidates the session server-side'''
 
@@ -663,12 +709,22 @@ class BaseAuthHTTPRequestHandler(
                         BadPasswordError) as e:
                     logger.error('{}'.format(str(e)))
 
+    @classmethod
+    def sessions_to_prune(cls):
+        '''Returns the Sessions prune_old_sessions checks for expiry
+
+        Default is get_all_sessions(). Child class may override it,
+        e.g. to load less of each session.
+        '''
+
+        return cls.get_all_sessions()
+
     @classmethod
     def prune_old_sessions(cls):
         '''Removes expired sessions'''
 
         logger.debug('Pruning old sessions')
-        sessions = cls.get_all_sessions()
+        sessions = cls.sessions_to_prune()
         for s in sessions:
             if s.has_expired():
                 logger.debug('Removing session {}'.format(s.token))
@@ -18,14 +18,14 @@ class DBUser(DBBase, User):
     username = Column(String(250), nullable=False, unique=True)
     password = Column(String(250), nullable=False)
     roles = relationship(
-        'DBRole', lazy='joined', secondary='association_user_role')
+        'DBRole', lazy='select', secondary='association_user_role')
 
 class DBRole(DBBase, Role):
     __tablename__ = 'roles'
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False, unique=True)
     users = relationship(
-        'DBUser', lazy='joined', secondary='association_user_role')
+        'DBUser', lazy='select', secondary='association_user_role')
 
 class DBSession(DBBase, Session):
     __tablename__ = 'sessions'
@@ -33,8 +33,8 @@ class DBSession(DBBase, Session):
     user_id = Column(
         Integer, ForeignKey('users.id'), nullable=False)
     user = relationship(
-        'DBUser', lazy='joined',
-        backref=backref('sessions', lazy='joined', uselist=True))
+        'DBUser', lazy='select',
+        backref=backref('sessions', lazy='select', uselist=True))
     token = Column(String(250), nullable=False, unique=True)
     expiry = Column(DateTime)
 
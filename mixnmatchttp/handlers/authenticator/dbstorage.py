@@ -1,11 +1,14 @@
 from ..._py2 import *
 
 import logging
+import json
 from datetime import datetime
 
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
-from ...poller import Poller
+from ...poller import VersionPoller, ChangeFeed
+from ... import endpoints
 from ...utils import datetime_from_timestamp
 from ...db import DBConnection, \
     filter_results, object_from_dict
@@ -33,18 +36,109 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
 
     Default of _prune_sessions_every changed from 0 (every request) to
     300 (every 5 minutes).
+
+    Relationships in dbapi are loaded lazily by default; the lookups
+    on the authentication path load only what they need via the
+    following class attributes, each a list of SQLAlchemy loader
+    options. They can also be overridden per call via the options
+    keyword of find_session and find_user.
+    - _session_load_options: used by find_session. Default loads the
+      session's user and their roles in the same query, but not the
+      user's other sessions.
+    - _user_load_options: used by find_user. Default loads the user's
+      roles (needed for authorization), but not their sessions.
+
+    Database sessions are request-scoped: one is created on first use
+    in each request and removed in end_request, for every
+    DBConnection (see DBConnection.remove_session and session_stats).
+    If a QueryMonitor is enabled, the statements of each request are
+    counted and slow or repeated ones are logged with the request
+    line (see DBConnection.enable_query_monitor); the number of
+    queries and their time are logged via log_message after each
+    request.
+
+    Change feeds enabled via enable_change_feed are streamed as
+    server-sent events from /changes/<name> to users allowed by
+    _change_feed_acl. Each event is named change and its data is a JSON
+    object with table, pk and op. Clients may filter with the tables
+    and ops URL parameters (comma-separated), and resume with the
+    Last-Event-ID header (or last_event_id parameter). If events
+    have been missed, a reset event is sent first and the client
+    should refetch everything.
+    - _change_feed_keepalive: Number of seconds after which a comment
+      is sent to an idle stream, so dead clients are noticed. Default
+      is 15.
+    - _change_feed_acl: A list of users or roles allowed to stream
+      change feeds, in the same format as the values of _secrets.
+      Default is ['#admin']. Set it to [None] to allow anyone, e.g.
+      if /changes is already protected via _secrets.
+    Pollers and change feeds belong to the class they are enabled on
+    (and its subclasses), not to its parents.
+
+    /dbstats returns, as JSON, the connection pool, session and query
+    statistics of every DBConnection, see DBConnection.all_stats.
+    - _db_stats_acl: A list of users or roles allowed to get them, as
+      for _change_feed_acl. Default is ['#admin'].
     '''
 
     _prune_sessions_every = 300
+    _change_feed_keepalive = 15
+    _change_feed_acl = ['#admin']
+    _db_stats_acl = ['#admin']
+    change_feeds = {}
+    _endpoints = endpoints.Endpoint(
+        changes={
+            '$allowed_methods': {'GET'},
+            '$nargs': 1,
+        },
+        dbstats={
+            '$allowed_methods': {'GET'},
+        },
+    )
+    _session_load_options = [
+        joinedload(DBSession.user).joinedload(DBUser.roles)]
+    _user_load_options = [joinedload(DBUser.roles)]
+
+    def begin_request(self):
+        '''Starts counting the queries of this request'''
+
+        super().begin_request()
+        DBConnection.begin_monitoring('{} {}'.format(
+            self.command, self.path.split('?', 1)[0]))
+
+    def end_request(self):
+        '''Removes the thread's database sessions
+
+        Logs the number of queries of this request and their time, if
+        any, via log_message.
+        '''
+
+        try:
+            super().end_request()
+        finally:
+            stats = DBConnection.end_monitoring()
+            DBConnection.remove_all_sessions()
+            queries = sum(n for n, t in stats.values())
+            if queries:
+                self.log_message(
+                    '"%s" %d queries in %.3fs', self.requestline,
+                    queries, sum(t for n, t in stats.values()))
 
     @needs_db(DBBase, expire_on_commit=False)
     @classmethod
-    def find_session(cls, db, token, must_exist=False):
-        '''Returns the Session corresponding to the token'''
+    def find_session(cls, db, token, must_exist=False, options=None):
+        '''Returns the Session corresponding to the token
 
+        - options is a list of loader options, defaults to
+          _session_load_options
+        '''
+
+        if options is None:
+            options = cls._session_load_options
         try:
             return filter_results(
-                db, DBSession, {'token': token}, expect_one=True)
+                db, DBSession, {'token': token},
+                expect_one=True, options=options)
         except NoResultFound:
             if must_exist:
                 raise
@@ -52,10 +146,22 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
 
     @needs_db(DBBase, expire_on_commit=False)
     @classmethod
-    def get_all_sessions(cls, db):
-        '''Returns a list of Sessions'''
+    def get_all_sessions(cls, db, options=None):
+        '''Returns a list of Sessions
+
+        - options is a list of loader options, defaults to
+          _session_load_options
+        '''
+
+        if options is None:
+            options = cls._session_load_options
+        return db.query(DBSession).options(*options).all()
+
+    @classmethod
+    def sessions_to_prune(cls):
+        '''Returns all Sessions, without their users and roles'''
 
-        return db.query(DBSession).all()
+        return cls.get_all_sessions(options=[])
 
     @needs_db(DBBase)
     @classmethod
@@ -65,7 +171,8 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
         # session is an instance of Session; need to convert to
         # DBSession
         expiry = session.expiry
-        user = cls.find_user(session.user.username, must_exist=True)
+        user = cls.find_user(
+            session.user.username, must_exist=True, options=[])
         token = session.token
         if expiry is not None and not isinstance(expiry, datetime):
             # SQLAlchemy loses information on the timezone, so we need
@@ -79,17 +186,37 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
     def rm_session(cls, db, session):
         '''Deletes the Session'''
 
-        db_session = cls.find_session(session.token, must_exist=True)
+        db_session = cls.find_session(
+            session.token, must_exist=True, options=[])
         db.delete(db_session)
 
+    @needs_db(DBBase)
+    @classmethod
+    def rm_user_sessions(cls, db, user):
+        '''Deletes all Sessions of the user'''
+
+        db_user = cls.find_user(user.username, options=[])
+        if db_user is None:
+            return
+        db.query(DBSession).filter(
+            DBSession.user_id == db_user.id).delete(
+                synchronize_session='fetch')
+
     @needs_db(DBBase, expire_on_commit=False)
     @classmethod
-    def find_user(cls, db, username, must_exist=False):
-        '''Returns the User for that username'''
+    def find_user(cls, db, username, must_exist=False, options=None):
+        '''Returns the User for that username
+
+        - options is a list of loader options, defaults to
+          _user_load_options
+        '''
 
+        if options is None:
+            options = cls._user_load_options
         try:
             return filter_results(
-                db, DBUser, {'username': username}, expect_one=True)
+                db, DBUser, {'username': username},
+                expect_one=True, options=options)
         except NoResultFound:
             if must_exist:
                 raise
@@ -111,6 +238,7 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
         '''Adds the user to the session to be commited'''
 
         db.add(user)
+        cls.forget_user(user.username)
 
     # All methods which call our wrapped methods (defined in
     # BaseAuthSQLAlchemyORMHTTPRequestHandler) should close the
@@ -141,39 +269,95 @@ class BaseAuthSQLAlchemyORMHTTPRequestHandler(
 
     @classmethod
     def enable_client_cache(cls, name, base):
-        '''Add a new Poller named <name> that monitors DB changes to base
+        '''Add a VersionPoller named <name> monitoring DB changes to base
 
         - base is a declarative base which must have been configured
           via DBConnection(base, url, ...).
+        The poller's latest tag changes on any commit which changes
+        the database; see VersionPoller for tags scoped to tables or
+        rows.
         '''
 
-        def is_clean(session):
-            if session.new or session.deleted:
-                return False
-            for i in session.dirty:
-                if session.is_modified(i):
-                    return False
-            return True
+        if 'pollers' not in cls.__dict__:
+            # don't add it to the parents' pollers
+            cls.pollers = dict(cls.pollers)
+        cls.pollers[name] = VersionPoller()
+        DBConnection.get(base).track_changes(cls.pollers[name].update)
+
+    @classmethod
+    def enable_change_feed(cls, name, base, size=10000):
+        '''Add a ChangeFeed named <name> of row changes to base
+
+        - base is a declarative base which must have been configured
+          via DBConnection(base, url, ...).
+        - size is the number of events kept for clients to catch up
+        '''
+
+        if 'change_feeds' not in cls.__dict__:
+            # don't add it to the parents' change feeds
+            cls.change_feeds = dict(cls.change_feeds)
+        cls.change_feeds[name] = ChangeFeed(size=size)
+        DBConnection.get(base).track_changes(
+            cls.change_feeds[name].publish)
 
-        def before_flush(session, flush_context, instances):
-            if 'is_clean' not in session.info:
-                session.info['is_clean'] = True
-            if not session.info['is_clean']:
+    def __check_acl(self, acl):
+        '''Sends 401 or 403 and returns False if acl does not allow'''
+
+        if self.is_authorized(None, {None: acl}, is_regex=False):
+            return True
+        if self.get_current_session() is None:
+            self.send_error(401)
+        else:
+            self.send_error(403)
+        return False
+
+    def do_dbstats(self):
+        '''Sends the statistics of the database connections'''
+
+        if not self.__check_acl(self._db_stats_acl):
+            logger.debug('Not allowed to get DB statistics')
+            return
+        self.send_as_json(DBConnection.all_stats())
+
+    def do_changes(self):
+        '''Streams the events of a change feed'''
+
+        def get_list(parname):
+            value = self.get_param(parname, self.query)
+            if value is None:
+                return None
+            return set(v.strip() for v in value.split(','))
+
+        if not self.__check_acl(self._change_feed_acl):
+            logger.debug('Not allowed to stream changes')
+            return
+        try:
+            feed = self.change_feeds[self.ep.args]
+        except KeyError:
+            self.send_error(404)
+            return
+        tables = get_list('tables')
+        ops = get_list('ops')
+        last_id = self.headers.get('Last-Event-ID')
+        if last_id is None:
+            last_id = self.get_param('last_event_id', self.query)
+
+        self.begin_event_stream()
+        events, complete, last_id = feed.since(last_id, tables, ops)
+        if not complete:
+            logger.debug('Client missed events, sending reset')
+            if not self.send_event('', name='reset', eid=last_id):
                 return
-            if is_clean(session):
-                logger.debug('DB unchanged')
-            else:
-                logger.debug('DB will change')
-                session.info['is_clean'] = False
-
-        def after_commit(session):
-            if not session.info.get('is_clean', True):
-                logger.debug('DB changed')
-                cls.pollers[name].update()
-                session.info['is_clean'] = True
-
-        cls.pollers[name] = Poller()
-        DBConnection.get(base).listen(
-            'before_flush', before_flush)
-        DBConnection.get(base).listen(
-            'after_commit', after_commit)
+        while True:
+            for e in events:
+                data = json.dumps(
+                    {'table': e['table'], 'pk': e['pk'], 'op': e['op']})
+                if not self.send_event(
+                        data, name='change', eid=e['id']):
+                    return
+            if not feed.wait(
+                    last_id, timeout=self._change_feed_keepalive):
+                if feed.closed or not self.write(': keepalive\n\n'):
+                    return
+            events, complete, last_id = feed.since(
+                last_id, tables, ops)
@@ -1,14 +1,19 @@
 from ..._py2 import *
 
 from sqlalchemy.exc import DatabaseError
+from sqlalchemy.orm import Query
 
 from functools import partial
 from wrapt import decorator
 from datetime import datetime
+import urllib
+import json
 import logging
+from ..._py2 import _abcoll
 
-from ...utils import is_map_like, datetime_to_str
-from ...db import DBConnection, is_mapper, object_to_dict
+from ...utils import is_map_like, datetime_to_str, SingleFlight
+from ...db import DBConnection, is_mapper, paginate_query, \
+    object_to_dict
 from ...db.exc import ServerDBError
 from ..exc import ServerError, InvalidRequestError
 from .dbapi import DBBase
@@ -35,41 +40,84 @@ def needs_db_response_handling(base,
                                poller=None,
                                poll_any=False,
                                send_None=True,
-                               json_serializer=json_serializer):
+                               json_serializer=json_serializer,
+                               yield_per=1000,
+                               read_only=None,
+                               coalesce=False,
+                               coalesce_keep=256,
+                               coalesce_timeout=30):
     '''Passes a session and sends the returned object as JSON
 
     The wrapped method should be an endpoint handler and must not send
     anything, instead return the response body as an object.
+    If it returns a Query or an iterator (e.g. a generator), then the
+    results are streamed as they are fetched (see
+    send_as_json_stream), as newline-delimited JSON if the client
+    accepts application/x-ndjson, otherwise as a JSON array.
     - If poller is given, it should be the name of a poller that has
       been enabled via
       BaseAuthSQLAlchemyORMHTTPRequestHandler.enable_client_cache;
       then we support If-None-Match request headers and ETag response
-      header via the current tag of that poller
+      header via the current tag of that poller. It can also be a
+      validator returned by table_validator or row_validator (or any
+      callable taking the request handler and returning the current
+      tag), so that only changes to those tables or that row change
+      the ETag.
     - If poll_any is True, then we always inspect the If-None-Match.
       Otherwise, only in GET requests.
     - If send_None is True, then a 204 is sent if the wrapped method
       returns None. Otherwise nothing is sent, i.e. the wrapped method
       must send the response itself.
-    - json_serializer is used to serialize the returned object.
+    - json_serializer is used to serialize the returned object. It is
+      passed max_depth, and fields only if the client requested it.
+    - yield_per is the number of rows to fetch at a time when a Query
+      is returned. Queries which eagerly join collections cannot be
+      streamed this way; use selectinload or subqueryload instead.
+    - If read_only is True, or it is None and the request is a GET,
+      reads may go to a replica (see DBConnection.enable_replicas).
+      The client's session token (or address) is passed along for
+      the read-your-writes window.
+    - If coalesce is True, concurrent GET requests for the same URL
+      by the same user (and roles) are served by a single call of
+      the wrapped method and share the serialized response. With a
+      poller, the responses of up to coalesce_keep URLs are also
+      reused until the tag changes. Results are not streamed then
+      (unless newline-delimited JSON is requested, which is never
+      coalesced). Requests waiting for another one to run the
+      wrapped method run it themselves after coalesce_timeout
+      seconds.
+    The following query parameters are supported:
+    - max_depth: see object_to_dict
+    - fields: a comma-separated list of attributes to include in the
+      top-level objects; for a returned Query only those columns are
+      loaded
+    - limit and after: keyset pagination, only for a returned Query.
+      At most limit results with a primary key greater than after
+      are sent, ordered by primary key. If there are more, a Link
+      header with rel="next" points to the next page.
     '''
 
+    flights = SingleFlight(keep=coalesce_keep, timeout=coalesce_timeout)
+
     @decorator
     def _decorator(wrapped, self, args, kwargs):
-        dconn = DBConnection.get(base)
-        with dconn.session_context(reraise=False) as db:
-            # check if client cache is up to date
-            if poller is not None \
-                    and (self.command == 'GET' or poll_any):
-                current = self.headers.get('If-None-Match')
-                if current is not None:
-                    if self.pollers[poller].is_match(
-                            current.strip('"')):
-                        self.send_response_empty(304)
-                        return
+        def respond(db, capture):
+            '''Sends the response; if capture, only sends errors
+
+            If capture is True, returns (body, Link header or None)
+            of a successful response instead of sending it, or None
+            if it sent an error.
+            '''
+
+            link = None
             try:
                 result = wrapped(db, *args, **kwargs)
-                # commit so that new objects get an ID
-                db.commit()
+                stream = isinstance(result, (Query, _abcoll.Iterator))
+                # commit so that new objects get an ID; streamed
+                # results may hold an open cursor, session_context
+                # commits those at the end
+                if not stream:
+                    db.commit()
             except InvalidRequestError as e:
                 self.save_param('error', str(e))
                 self.send_as_json(code=400)
@@ -80,30 +128,205 @@ def needs_db_response_handling(base,
                 raise ServerDBError(e)  # so session_context cleans up
 
             if poller is not None:
-                self.save_header(
-                    'ETag', self.pollers[poller].latest)
+                self.save_header('ETag', tag)
             if result is None:
                 if send_None:
                     self.send_response_empty(204)
             else:
-                max_depth = self.get_param('max_depth', self.query)
-                if max_depth is not None:
+                try:
+                    max_depth = _get_int_param(self, 'max_depth', 0)
+                    limit = _get_int_param(self, 'limit', 1)
+                    after = self.get_param('after', self.query)
+                    fields = self.get_param('fields', self.query)
+                    if fields is not None:
+                        fields = [f.strip() for f in fields.split(',')
+                                  if f.strip()]
+                    if isinstance(result, Query):
+                        result, pk = paginate_query(
+                            result,
+                            limit=limit,
+                            after=after,
+                            fields=fields,
+                            peek=True)
+                    elif limit is not None or after is not None:
+                        raise InvalidRequestError(
+                            'This endpoint does not support limit '
+                            'and after')
+                except InvalidRequestError as e:
+                    self.save_param('error', str(e))
+                    self.send_as_json(code=400)
+                    return
+                # custom serializers may not support fields
+                serializer_kargs = {'max_depth': max_depth}
+                if fields is not None:
+                    serializer_kargs['fields'] = fields
+                serializer = partial(json_serializer, **serializer_kargs)
+                if limit is not None:
+                    # one more was fetched to see if there's a next page
+                    try:
+                        result = result.all()
+                    except DatabaseError as e:
+                        self.save_param('error', str(e))
+                        self.send_as_json(code=500)
+                        raise ServerDBError(e)
+                    if len(result) > limit:
+                        result = result[:limit]
+                        link = '<{}>; rel="next"'.format(
+                            _next_page_url(self, getattr(result[-1], pk)))
+                        if not capture:
+                            self.save_header('Link', link)
+                    stream = False
+                if capture:
+                    # the response is shared, so it cannot be streamed
                     try:
-                        max_depth = int(max_depth)
-                        if max_depth < 0:
-                            raise ValueError
-                    except ValueError:
-                        self.save_param(
-                            'error',
-                            ('max_depth must be a non-negative '
-                             'integer'))
-                        self.send_as_json(code=400)
-                        return
-                self.send_as_json(result, serializer=partial(
-                    json_serializer, max_depth=max_depth))
+                        if stream:
+                            result = list(result)
+                        return (json.dumps(
+                            result, default=serializer).encode('utf-8'),
+                            link)
+                    except (DatabaseError, ServerError) as e:
+                        self.save_param('error', str(e))
+                        self.send_as_json(code=500)
+                        raise ServerDBError(e)
+                if not stream:
+                    self.send_as_json(result, serializer=serializer)
+                    return
+                if isinstance(result, Query):
+                    result = result.yield_per(yield_per)
+                # errors are logged and the connection closed, since
+                # the response has started
+                self.send_as_json_stream(result,
+                                         serializer=serializer,
+                                         ndjson=ndjson)
+
+        dconn = DBConnection.get(base)
+        info = {'client': _client_key(self)}
+        if read_only or (read_only is None and self.command == 'GET'):
+            info['read_only'] = True
+        with dconn.session_context(reraise=False, info=info) as db:
+            # get the tag before the query, so a change in between
+            # gives the client a stale tag rather than stale data
+            if poller is not None:
+                if callable(poller):
+                    tag = poller(self)
+                else:
+                    tag = self.pollers[poller].latest
+            # check if client cache is up to date
+            if poller is not None \
+                    and (self.command == 'GET' or poll_any):
+                if self.if_none_match(tag):
+                    self.send_response_empty(304)
+                    return
+            ndjson = 'application/x-ndjson' in \
+                self.headers.get('Accept', '')
+            ran = []  # whether this request ran as the leader
+            if coalesce and self.command == 'GET' and not ndjson:
+                key = (self.path,
+                       _user_key(self),
+                       tag if poller is not None else None)
+                def lead():
+                    ran.append(True)
+                    return respond(db, True)
+
+                shared = flights.do(key, lead, keep=poller is not None)
+                if shared is not None:
+                    if poller is not None and not ran:
+                        self.save_header('ETag', tag)
+                    if shared[1] is not None:
+                        self.save_header('Link', shared[1])
+                    self.render({'data': shared[0],
+                                 'type': 'application/json'})
+                    return
+                if ran:
+                    return  # already sent a response
+            respond(db, False)
 
     return _decorator
 
+def table_validator(poller, *tables):
+    '''Returns a validator for needs_db_response_handling
+
+    The ETag changes only when any of the given tables changes.
+    - poller is the name of a poller enabled via
+      BaseAuthSQLAlchemyORMHTTPRequestHandler.enable_client_cache
+    '''
+
+    def validator(handler):
+        return handler.pollers[poller].table_tag(*tables)
+
+    return validator
+
+def row_validator(poller, table, pk=None):
+    '''Returns a validator for needs_db_response_handling
+
+    The ETag changes only when the requested row of table changes.
+    - poller is the name of a poller enabled via
+      BaseAuthSQLAlchemyORMHTTPRequestHandler.enable_client_cache
+    - pk is a callable taking the request handler and returning the
+      primary key of the row; by default it's the endpoint's
+      arguments (ep.args)
+    '''
+
+    def validator(handler):
+        if pk is None:
+            key = handler.ep.args
+        else:
+            key = pk(handler)
+        return handler.pollers[poller].row_tag(table, key)
+
+    return validator
+
+def _client_key(handler):
+    '''Returns the session token, or the address of the client'''
+
+    try:
+        token = handler.get_current_token()
+    except (AttributeError, NotImplementedError):
+        token = None
+    if token is None:
+        return handler.client_address[0]
+    return token
+
+def _user_key(handler):
+    '''Returns (username, sorted role names) or None if anonymous'''
+
+    try:
+        session = handler.get_current_session()
+    except (AttributeError, NotImplementedError):
+        return None
+    if session is None or session.user is None:
+        return None
+    return (session.user.username,
+            tuple(sorted(r.name for r in session.user.roles)))
+
+def _get_int_param(handler, parname, minimum):
+    '''Returns an integer URL parameter or None if not given
+
+    Raises InvalidRequestError if it's less than minimum or not an
+    integer
+    '''
+
+    value = handler.get_param(parname, handler.query)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+        if value < minimum:
+            raise ValueError
+    except ValueError:
+        raise InvalidRequestError(
+            '{} must be an integer greater than or equal to {}'.format(
+                parname, minimum))
+    return value
+
+def _next_page_url(handler, after):
+    '''Returns the request URL with the after parameter replaced'''
+
+    query = dict(handler.query)
+    query['after'] = after
+    return '{}?{}'.format(handler.path.split('?', 1)[0],
+                          urllib.parse.urlencode(query))
+
 def needs_db_error_response_handling(base):
     '''Passes a session, catches a DB error and sends an error
 
@@ -124,11 +347,22 @@ def needs_db_error_response_handling(base):
 
     return _decorator
 
-def needs_db(base, reraise=False, close_at_end=False, **kargs):
+def needs_db(base,
+             reraise=False,
+             close_at_end=False,
+             read_only=False,
+             **kargs):
     '''Passes a session of base to the wrapped method
 
     - The session is commited but not closed, unless close_at_end is
-      True.
+      True. BaseAuthSQLAlchemyORMHTTPRequestHandler removes it at the
+      end of the request.
+    - If read_only is True, reads may go to a replica (see
+      DBConnection.enable_replicas). Otherwise they go to the
+      primary, even if called while a read-only request holds the
+      session, e.g. find_session under
+      needs_db_response_handling, since sessions and users may have
+      just been written.
     - Any additional keyword arguments are passed to
       DBConnection.session_context
     '''
@@ -136,9 +370,11 @@ def needs_db(base, reraise=False, close_at_end=False, **kargs):
     @decorator
     def _decorator(wrapped, self, args, kwargs):
         dconn = DBConnection.get(base)
+        info = {'read_only': bool(read_only)}
         with dconn.session_context(
                 reraise=reraise,
-                close_at_end=close_at_end, **kargs) as db:
+                close_at_end=close_at_end,
+                info=info, **kargs) as db:
             return wrapped(db, *args, **kwargs)
 
     return _decorator
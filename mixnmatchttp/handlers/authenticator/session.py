@@ -2,6 +2,12 @@ from ..._py2 import *
 
 import logging
 import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+from collections import OrderedDict
 
 # optional features
 try:
@@ -22,15 +28,19 @@ else:
     from cryptography.hazmat.primitives.serialization import \
         load_pem_private_key
     from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
 
 from ... import endpoints
 from ...utils import is_str, param_dict, datetime_from_timestamp, \
     curr_timestamp, randhex, randstr, int_to_bytes
-from .api import BaseAuthHTTPRequestHandler, Session
+from .api import BaseAuthHTTPRequestHandler, User, Session
 from .utils import cookie_expflag
 
 
 logger = logging.getLogger(__name__)
+_jwt_caches_lock = threading.Lock()  # creates them, see _JWTCaches
+_revocations_lock = threading.Lock()  # see _Revocations
 
 
 class BaseAuthCookieHTTPRequestHandler(BaseAuthHTTPRequestHandler):
@@ -107,6 +117,270 @@ class BaseAuthCookieHTTPRequestHandler(BaseAuthHTTPRequestHandler):
             user=user,
             expiry=expiry)
 
+class BaseAuthSignedCookieHTTPRequestHandler(
+        BaseAuthCookieHTTPRequestHandler):
+    '''Implements stateless cookie-based authentication
+
+    Instead of a random token which has to be looked up in storage on
+    every request, the cookie carries the username, roles and expiry,
+    signed with HMAC-SHA256 (and optionally encrypted with AES-GCM).
+    Verifying it requires no storage access. Users are still looked up
+    in storage at login, so the child class must define methods for
+    storing/getting/updating users; sessions are not stored.
+
+    Logging out adds the cookie to a small in-memory revocation set,
+    where it is kept only until it would have expired anyway.
+    rm_user_sessions revokes all cookies of the user issued so far.
+    The revocations are kept in memory by this process only: they are
+    lost on restart and not seen by other processes or workers, which
+    will still accept the revoked cookies until they expire. Each
+    class has its own revocations, not shared with its parents or
+    subclasses.
+
+    If matched with a storage class, this class should take
+    precedence in the MRO, i.e. be first.
+
+    Class attributes, in addition to those of
+    BaseAuthCookieHTTPRequestHandler:
+    - _cookie_keys: a list of (key id, secret) tuples, set via
+      set_cookie_keys. The first one signs new cookies, all of them
+      are accepted when verifying, which allows rotating keys.
+    - _encrypt_cookie: encrypt the payload too, so that the username
+      and roles are not visible to the client. Requires the
+      cryptography module. Default is False.
+    - _signed_cookie_max_lifetime: Lifetime in seconds of the signed
+      payload if _cookie_lifetime is None (session cookie), since the
+      signature cannot be left valid forever. Default is 86400.
+    '''
+
+    _cookie_keys = []
+    _encrypt_cookie = False
+    _signed_cookie_max_lifetime = 86400
+    _revocation_prune_every = 60
+
+    def __init__(self, *args, **kargs):
+        if not self._cookie_keys:
+            raise RuntimeError('Cookie key not set')
+        super().__init__(*args, **kargs)
+
+    @classmethod
+    def set_cookie_keys(cls, *secrets):
+        '''Sets the secrets used to sign (and encrypt) cookies
+
+        The first one is used for new cookies; cookies signed with any
+        of them are accepted. Each secret is a string or bytes and its
+        key id is derived from it, so it stays the same across
+        restarts.
+        '''
+
+        if not secrets:
+            raise ValueError('At least one cookie key is required')
+        if cls._encrypt_cookie:
+            try:
+                AESGCM
+            except NameError:
+                raise ImportError(
+                    'The cryptography module is required for '
+                    'encrypted cookies')
+        keys = []
+        for secret in secrets:
+            if not isinstance(secret, bytes):
+                secret = secret.encode('utf-8')
+            kid = hashlib.sha256(secret).hexdigest()[:8]
+            keys.append((kid, secret))
+        cls._cookie_keys = keys
+
+    def get_current_session(self):
+        '''Returns a Session if the signed cookie is valid
+
+        The Session's user is built from the cookie payload, not
+        looked up in storage. Returns None if the cookie is missing,
+        invalid, expired or revoked.
+        '''
+
+        token = self.get_current_token()
+        if token is None:
+            return None
+        payload = self._decode_cookie(token)
+        if payload is None:
+            logger.debug('Invalid session cookie')
+            return None
+        username, roles, exp, iat, nonce = payload
+        if exp <= curr_timestamp(to_utc=True):
+            logger.debug('Session cookie has expired')
+            self.unset_session(None)
+            return None
+        if self.__is_revoked(username, iat, nonce):
+            logger.debug('Session cookie has been revoked')
+            return None
+        logger.debug('Found session for {}'.format(username))
+        return Session(token=token,
+                       user=User(username=username, roles=roles),
+                       expiry=exp)
+
+    def expire_current_session(self):
+        '''Revokes the session cookie server-side'''
+
+        session = self.get_current_session()
+        if session is None:
+            return
+        self.revoke_session(session)
+        self.unset_session(session)
+
+    def new_session(self, user):
+        '''Invalidates the old session and issues a new cookie
+
+        Sessions are not stored.
+        '''
+
+        self.expire_current_session()
+        session = self.generate_session(user)
+        self.set_session(session)
+        return session
+
+    @classmethod
+    def generate_session(cls, user):
+        '''Returns a new Session; token is the signed payload'''
+
+        now = curr_timestamp(to_utc=True, to_ms=True) / 1000
+        expiry = cls._cookie_lifetime
+        if expiry is not None:
+            expiry += now
+            exp = expiry
+        else:
+            exp = now + cls._signed_cookie_max_lifetime
+        payload = [user.username,
+                   [r.name for r in user.roles],
+                   int(exp),
+                   # milliseconds, so that a new login straight after
+                   # rm_user_sessions is not revoked
+                   round(now, 3),
+                   randhex(16)]
+        return Session(
+            token=cls._encode_cookie(payload),
+            user=user,
+            expiry=expiry)
+
+    @classmethod
+    def revoke_session(cls, session):
+        '''Adds the session's cookie to the revocation set'''
+
+        payload = cls._decode_cookie(session.token)
+        if payload is None:
+            return
+        exp, nonce = payload[2], payload[4]
+        revocations = cls.__revocations()
+        with revocations.lock:
+            revocations.tokens[nonce] = exp
+        cls.__prune_revoked()
+
+    @classmethod
+    def rm_user_sessions(cls, user):
+        '''Revokes all cookies issued to the user so far'''
+
+        revocations = cls.__revocations()
+        with revocations.lock:
+            revocations.users[user.username] = round(
+                curr_timestamp(to_utc=True, to_ms=True) / 1000, 3)
+        cls.__prune_revoked()
+        super().rm_user_sessions(user)
+
+    @classmethod
+    def _encode_cookie(cls, payload):
+        kid, secret = cls._cookie_keys[0]
+        data = json.dumps(payload, separators=(',', ':')).encode(
+            'utf-8')
+        if cls._encrypt_cookie:
+            nonce = os.urandom(12)
+            data = nonce + AESGCM(cls.__enc_key(secret)).encrypt(
+                nonce, data, None)
+        body = '{}.{}'.format(kid, _b64encode(data))
+        return '{}.{}'.format(body, _b64encode(
+            cls.__sign(secret, body)))
+
+    @classmethod
+    def _decode_cookie(cls, token):
+        '''Returns the verified payload or None'''
+
+        try:
+            body, sig = token.rsplit('.', 1)
+            kid, data = body.split('.', 1)
+            secret = dict(cls._cookie_keys)[kid]
+            if not hmac.compare_digest(
+                    _b64decode(sig), cls.__sign(secret, body)):
+                return None
+            data = _b64decode(data)
+        except (ValueError, KeyError) as e:
+            logger.debug('Cannot verify cookie: {}'.format(e))
+            return None
+        if cls._encrypt_cookie:
+            try:
+                data = AESGCM(cls.__enc_key(secret)).decrypt(
+                    data[:12], data[12:], None)
+            except (ValueError, InvalidTag):
+                logger.debug('Cannot decrypt cookie')
+                return None
+        try:
+            payload = json.loads(data.decode('utf-8'))
+            username, roles, exp, iat, nonce = payload
+        except (ValueError, TypeError) as e:
+            logger.debug('Cannot decode cookie: {}'.format(e))
+            return None
+        return payload
+
+    @staticmethod
+    def __sign(secret, body):
+        return hmac.new(
+            secret, body.encode('utf-8'), hashlib.sha256).digest()
+
+    @staticmethod
+    def __enc_key(secret):
+        return hashlib.sha256(b'enc:' + secret).digest()
+
+    @classmethod
+    def __revocations(cls):
+        '''Returns the _Revocations of this class, not of a parent'''
+
+        try:
+            return cls.__dict__['_revocations']
+        except KeyError:
+            pass
+        with _revocations_lock:
+            if '_revocations' not in cls.__dict__:
+                cls._revocations = _Revocations()
+        return cls.__dict__['_revocations']
+
+    @classmethod
+    def __is_revoked(cls, username, iat, nonce):
+        revocations = cls.__revocations()
+        with revocations.lock:
+            if nonce in revocations.tokens:
+                return True
+            revoked_at = revocations.users.get(username)
+        # iat has millisecond precision, so a cookie issued in the
+        # same millisecond as the revocation is revoked too
+        return revoked_at is not None and iat <= revoked_at
+
+    @classmethod
+    def __prune_revoked(cls):
+        revocations = cls.__revocations()
+        now = curr_timestamp(to_utc=True)
+        # a user's cookies issued before the revocation have all
+        # expired after the maximum lifetime
+        max_lifetime = max(cls._cookie_lifetime or 0,
+                           cls._signed_cookie_max_lifetime)
+        with revocations.lock:
+            if revocations.last_prune \
+                    + cls._revocation_prune_every > now:
+                return
+            revocations.last_prune = now
+            for nonce, exp in list(revocations.tokens.items()):
+                if exp <= now:
+                    del revocations.tokens[nonce]
+            for username, ts in list(revocations.users.items()):
+                if ts + max_lifetime <= now:
+                    del revocations.users[username]
+
 class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
     '''Implements JWT-based authentication with refresh tokens
 
@@ -148,6 +422,19 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
       key (for asymmetric algorithms).
     - _jwks: If the jwks option is given to set_JWT_keys, then a JWKS
       object is saved in _jwks with a random kid.
+    - _jwt_cache_size: Maximum number of verified JWTs whose claims
+      are remembered (until they expire), so that repeated requests
+      with the same JWT skip signature verification. 0 disables it.
+      Default is 1024. Each class has its own cache, and entries
+      are keyed by the algorithm and key too.
+    - _jwt_leeway: Number of seconds of leeway when checking the
+      expiry and not-before time of a JWT. Default is 0.
+    - _user_cache_ttl: Number of seconds for which the user (and
+      roles) a JWT refers to is remembered, so that repeated requests
+      skip the storage lookup. Cached users are dropped on
+      update_user. The session's user is then a plain User with only
+      the username and roles, rather than the storage object.
+      0 disables it. Default is 0.
     You can load public/private keys from a file by calling the
     set_JWT_keys class method.
     '''
@@ -166,6 +453,9 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
     _enc_key = None
     _dec_key = None
     _jwks = None
+    _jwt_cache_size = 1024
+    _jwt_leeway = 0
+    _user_cache_ttl = 0
     _endpoints = endpoints.Endpoint(
         authtoken={
             '$allowed_methods': {'POST'},
@@ -244,6 +534,9 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
                     }
                 ]}
 
+        caches = cls.__caches()
+        with caches.lock:
+            caches.claims.clear()
         if algorithm is not None:
             cls._algorithm = algorithm
         if cls._algorithm.startswith('HS'):
@@ -305,7 +598,7 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
             return None
         logger.debug('Found session for {}'.format(jwtok_d['sub']))
         return Session(token=None,
-                       user=self.find_user(jwtok_d['sub']),
+                       user=self.find_cached_user(jwtok_d['sub']),
                        expiry=datetime_from_timestamp(
                            jwtok_d['exp'],
                            relative=False,
@@ -363,17 +656,97 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
             return None
         return auth[len('Bearer '):]
 
+    @classmethod
+    def find_cached_user(cls, username):
+        '''Returns the User for that username, cached for a while
+
+        The cached User is a copy holding only the username and role
+        names, so it can be shared between threads. See
+        _user_cache_ttl.
+        '''
+
+        if not cls._user_cache_ttl:
+            return cls.find_user(username)
+        now = curr_timestamp(to_utc=True)
+        caches = cls.__caches()
+        try:
+            expiry, user = caches.users[username]
+        except KeyError:
+            pass
+        else:
+            if expiry > now:
+                return user
+        db_user = cls.find_user(username)
+        if db_user is None:
+            return None
+        user = User(username=db_user.username,
+                    roles=[r.name for r in db_user.roles])
+        with caches.lock:
+            caches.users[username] = (now + cls._user_cache_ttl, user)
+        return user
+
+    @classmethod
+    def forget_user(cls, username):
+        '''Drops the user from the cache used by find_cached_user'''
+
+        caches = cls.__caches()
+        with caches.lock:
+            caches.users.pop(username, None)
+        super().forget_user(username)
+
+    @classmethod
+    def __caches(cls):
+        '''Returns the _JWTCaches of this class, not of a parent'''
+
+        try:
+            return cls.__dict__['_jwt_caches']
+        except KeyError:
+            pass
+        with _jwt_caches_lock:
+            if '_jwt_caches' not in cls.__dict__:
+                cls._jwt_caches = _JWTCaches()
+        return cls.__dict__['_jwt_caches']
+
     @classmethod
     def _decode_jwt(cls, token):
+        '''Returns the verified claims or None
+
+        Claims of verified tokens are cached (see _jwt_cache_size)
+        until the token expires.
+        '''
+
+        key = None
+        if cls._jwt_cache_size:
+            caches = cls.__caches()
+            dec_key = cls._dec_key
+            if not isinstance(dec_key, bytes):
+                dec_key = str(dec_key).encode('utf-8')
+            h = hashlib.sha256(cls._algorithm.encode('utf-8'))
+            h.update(b'\0' + dec_key + b'\0' + token.encode('utf-8'))
+            key = h.digest()
+            now = curr_timestamp(to_utc=True)
+            with caches.lock:
+                res = caches.claims.pop(key, None)
+                if res is not None \
+                        and res['exp'] > now - cls._jwt_leeway \
+                        and res.get('nbf', now) <= now + cls._jwt_leeway:
+                    caches.claims[key] = res  # most recently used
+                    return res
         try:
             res = jwt.decode(
                 token,
                 cls._dec_key,
                 algorithms=[cls._algorithm],
-                options=cls._decode_opts)
+                options=cls._decode_opts,
+                leeway=cls._jwt_leeway)
         except (JWTInvalidTokenError, JWTInvalidKeyError) as e:
             logger.debug(str(e))
             return None
+        if key is not None and 'exp' in res:
+            with caches.lock:
+                caches.claims[key] = res
+                while len(caches.claims) > cls._jwt_cache_size:
+                    caches.claims.popitem(last=False)
         return res
 
     def do_authtoken(self):
@@ -397,3 +770,28 @@ class BaseAuthJWTHTTPRequestHandler(BaseAuthHTTPRequestHandler):
             self.set_session(Session(user=session.user))
         self.send_response_auth()
         return session.user
+
+
+class _Revocations(object):
+    '''Revoked cookies of one BaseAuthSignedCookieHTTPRequestHandler'''
+
+    def __init__(self):
+        self.tokens = {}  # nonce--expiry key-values
+        self.users = {}  # username--time of revocation key-values
+        self.lock = threading.Lock()
+        self.last_prune = curr_timestamp()
+
+class _JWTCaches(object):
+    '''Caches of one BaseAuthJWTHTTPRequestHandler class'''
+
+    def __init__(self):
+        self.claims = OrderedDict()  # digest--claims key-values
+        self.users = {}  # username--(expiry, User) key-values
+        self.lock = threading.Lock()
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+def _b64decode(data):
+    data = data.encode('utf-8')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
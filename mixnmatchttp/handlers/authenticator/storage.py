@@ -1,67 +1,586 @@
 from ..._py2 import *
 
-from .api import BaseAuthHTTPRequestHandler, User
+import logging
+import os
+import threading
+import heapq
+import json
+import tempfile
+from datetime import datetime
 
+from ...utils import datetime_to_timestamp, curr_timestamp, is_str
+from .api import BaseAuthHTTPRequestHandler, User, Session
+
+
+logger = logging.getLogger(__name__)
+
+
+class _SessionRecord(object):
+    '''Compact in-memory representation of a Session
+
+    The token is the key it is stored under, so only the user and
+    the expiry are kept.
+    '''
+
+    __slots__ = ('user', 'expiry')
+
+    def __init__(self, user, expiry):
+        self.user = user
+        self.expiry = expiry
+
+    def to_session(self, token):
+        return Session(user=self.user, token=token, expiry=self.expiry)
+
+class MemoryStore(object):
+    '''Thread-safe in-memory storage of users and sessions
+
+    - Sessions are split among a number of shards (by token), each one
+      protected by its own lock, so that concurrent requests rarely
+      contend for the same lock.
+    - A secondary index of tokens per username allows removing all
+      sessions of a user in time proportional to their number of
+      sessions.
+    - An expiry index (a heap of timestamp, token) allows removing
+      expired sessions without scanning all of them. Entries of
+      removed sessions are left in it until they expire, but once
+      they outnumber the live ones it is rebuilt, so it holds at most
+      about twice as many entries as there are sessions.
+    - Sessions are stored as _SessionRecords, which use __slots__ and
+      share the User object, rather than as full Session objects.
+    '''
+
+    def __init__(self, shards=16):
+        if shards < 1:
+            raise ValueError('Number of shards must be positive')
+        self.__shards = [{} for i in range(shards)]
+        self.__shard_locks = [threading.Lock() for i in range(shards)]
+        self.__users = {}  # username--User key-values
+        self.__user_tokens = {}  # username--set of tokens
+        self.__users_lock = threading.Lock()
+        self.__expiry_heap = []  # (timestamp, token)
+        self.__expiry_lock = threading.Lock()
+        self.__stale_expiries = 0  # heap entries of removed sessions
+        self.__changes = 0  # to skip unneeded snapshots
+        self.__changes_lock = threading.Lock()
+        self.__saved_changes = None
+        self.__snapshot_stop = None
+        self.__snapshot_thread = None
+
+    def __len__(self):
+        return sum(len(s) for s in self.__shards)
+
+    def __shard(self, token):
+        i = hash(token) % len(self.__shards)
+        return self.__shards[i], self.__shard_locks[i]
+
+    @staticmethod
+    def _expiry_to_timestamp(expiry):
+        if expiry is None:
+            return None
+        if isinstance(expiry, datetime):
+            return datetime_to_timestamp(expiry, to_utc=True)
+        return expiry
+
+    def get_session(self, token):
+        '''Returns the Session for the token or None'''
+
+        shard, lock = self.__shard(token)
+        with lock:
+            rec = shard.get(token)
+        if rec is None:
+            return None
+        return rec.to_session(token)
+
+    def iter_sessions(self):
+        '''Yields all Sessions
+
+        Each shard is copied (under its lock) only when reached, so
+        the whole store is never copied at once.
+        '''
+
+        for shard, lock in zip(self.__shards, self.__shard_locks):
+            with lock:
+                items = list(shard.items())
+            for token, rec in items:
+                yield rec.to_session(token)
+
+    def add_session(self, session):
+        '''Records the Session, replacing any with the same token'''
+
+        token = session.token
+        rec = _SessionRecord(session.user, session.expiry)
+        shard, lock = self.__shard(token)
+        # index and publish it atomically with respect to
+        # rm_user_sessions, otherwise it could miss the new session
+        with self.__users_lock:
+            with lock:
+                old = shard.get(token)
+                shard[token] = rec
+            if old is not None and old.user is not session.user:
+                self.__unindex_user_token(
+                    old.user.username, token, locked=True)
+            self.__user_tokens.setdefault(
+                session.user.username, set()).add(token)
+        if old is not None and old.expiry is not None:
+            self.__add_stale_expiries(1)
+        ts = self._expiry_to_timestamp(session.expiry)
+        if ts is not None:
+            with self.__expiry_lock:
+                heapq.heappush(self.__expiry_heap, (ts, token))
+        self.__changed()
+
+    def rm_session(self, token):
+        '''Deletes the Session for the token
+
+        Returns True if it existed, False otherwise. The expiry index
+        is cleaned up lazily, see __add_stale_expiries.
+        '''
+
+        shard, lock = self.__shard(token)
+        with lock:
+            rec = shard.pop(token, None)
+        if rec is None:
+            return False
+        self.__unindex_user_token(rec.user.username, token)
+        if rec.expiry is not None:
+            self.__add_stale_expiries(1)
+        self.__changed()
+        return True
+
+    def rm_user_sessions(self, username):
+        '''Deletes all sessions of the user
+
+        Returns the number of deleted sessions.
+        '''
+
+        with self.__users_lock:
+            tokens = self.__user_tokens.pop(username, set())
+        count = stale = 0
+        for token in tokens:
+            shard, lock = self.__shard(token)
+            with lock:
+                rec = shard.get(token)
+                if rec is not None and rec.user.username == username:
+                    del shard[token]
+                    count += 1
+                    stale += rec.expiry is not None
+        self.__add_stale_expiries(stale)
+        self.__changed(count)
+        return count
+
+    def user_sessions(self, username):
+        '''Returns a list of the user's Sessions'''
+
+        with self.__users_lock:
+            tokens = list(self.__user_tokens.get(username, ()))
+        sessions = []
+        for token in tokens:
+            session = self.get_session(token)
+            if session is not None:
+                sessions.append(session)
+        return sessions
+
+    def pop_expired_sessions(self, now=None):
+        '''Deletes all sessions which have expired by now
+
+        now defaults to the current UTC timestamp.
+        Returns a list of the deleted Sessions.
+        '''
+
+        if now is None:
+            now = curr_timestamp(to_utc=True)
+        due = []
+        with self.__expiry_lock:
+            heap = self.__expiry_heap
+            while heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap))
+        removed = []
+        for ts, token in due:
+            shard, lock = self.__shard(token)
+            with lock:
+                rec = shard.get(token)
+                if rec is None:
+                    continue  # already removed
+                # the session may have been replaced by one with the
+                # same token but a later expiry
+                rec_ts = self._expiry_to_timestamp(rec.expiry)
+                if rec_ts is None or rec_ts > now:
+                    continue
+                del shard[token]
+            self.__unindex_user_token(rec.user.username, token)
+            removed.append(rec.to_session(token))
+        self.__changed(len(removed))
+        return removed
+
+    def touch(self):
+        '''Records a change, e.g. to a User which was updated in place
+
+        So that the next periodic snapshot is not skipped.
+        '''
+
+        self.__changed()
+
+    def __changed(self, count=1):
+        if not count:
+            return
+        with self.__changes_lock:
+            self.__changes += count
+
+    def get_user(self, username):
+        '''Returns the User for that username or None'''
+
+        with self.__users_lock:
+            return self.__users.get(username)
+
+    def add_user(self, user):
+        '''Records the User, replacing any with the same username'''
+
+        with self.__users_lock:
+            self.__users[user.username] = user
+        self.__changed()
+
+    def iter_users(self):
+        '''Yields all Users'''
+
+        with self.__users_lock:
+            users = list(self.__users.values())
+        for user in users:
+            yield user
+
+    def dump(self, fh, now=None):
+        '''Writes a snapshot of users and unexpired sessions to fh
+
+        fh is a file open in text mode. Each line is a JSON array: the
+        header ["mixnmatchttp-memstore", 1], then one
+        ["U", username, password, [role, ...]] per user and one
+        ["S", token, username, expiry] per session, where expiry is
+        a UTC timestamp or null.
+        now defaults to the current UTC timestamp.
+        Returns the number of sessions written.
+        '''
+
+        if now is None:
+            now = curr_timestamp(to_utc=True)
+        fh.write(json.dumps(['mixnmatchttp-memstore', 1]) + '\n')
+        for user in self.iter_users():
+            fh.write(json.dumps([
+                'U', user.username, user.password,
+                [r.name for r in user.roles]]) + '\n')
+        count = 0
+        for shard, lock in zip(self.__shards, self.__shard_locks):
+            with lock:
+                items = list(shard.items())
+            lines = []
+            for token, rec in items:
+                ts = self._expiry_to_timestamp(rec.expiry)
+                if ts is not None and ts <= now:
+                    continue
+                lines.append(json.dumps(
+                    ['S', token, rec.user.username, ts]))
+            if lines:
+                fh.write('\n'.join(lines) + '\n')
+            count += len(lines)
+        return count
+
+    def load(self, fh, now=None):
+        '''Restores users and sessions from a snapshot written by dump
+
+        - Users which already exist (e.g. loaded from a file at
+          startup) are kept as they are; others are added.
+        - Sessions which have expired by now or belong to an unknown
+          user are skipped.
+        - Invalid lines, e.g. the last one of a truncated file, are
+          skipped and logged.
+        now defaults to the current UTC timestamp.
+        Returns a tuple of the number of users and sessions added.
+        Raises ValueError if fh does not start with the header of a
+        snapshot.
+        '''
+
+        if now is None:
+            now = curr_timestamp(to_utc=True)
+        try:
+            header = json.loads(fh.readline() or 'null')
+        except ValueError:
+            header = None
+        if header != ['mixnmatchttp-memstore', 1]:
+            raise ValueError('Not a session store snapshot')
+        nusers = nsessions = 0
+        bad_lines = []
+        nshards = len(self.__shards)
+        shards = [{} for i in range(nshards)]
+        user_tokens = {}
+        expiries = []
+        decode = json.JSONDecoder().decode
+        get_user = self.get_user
+        # collect everything first and merge it in shard by shard, so
+        # that each lock is taken once
+        for lineno, line in enumerate(fh, 2):
+            try:
+                entry = decode(line)
+                if entry[0] == 'U':
+                    username, password, roles = entry[1:]
+                    if not all(is_str(v) for v in [username] + roles):
+                        raise ValueError('Invalid user')
+                    if get_user(username) is None:
+                        self.add_user(User(username=username,
+                                           password=password,
+                                           roles=roles))
+                        nusers += 1
+                    continue
+                if entry[0] != 'S':
+                    raise ValueError('Unknown entry')
+                token, username, ts = entry[1:]
+                if not is_str(token) or not (
+                        ts is None or isinstance(ts, (int, float))):
+                    raise ValueError('Invalid session')
+                user = get_user(username)
+                if user is None or (ts is not None and ts <= now):
+                    continue
+            except (ValueError, TypeError, IndexError,
+                    KeyError, AttributeError) as e:
+                logger.debug('Invalid snapshot line {}: {}'.format(
+                    lineno, e))
+                bad_lines.append(lineno)
+                continue
+            shards[hash(token) % nshards][token] = \
+                _SessionRecord(user, ts)
+            user_tokens.setdefault(username, []).append(token)
+            if ts is not None:
+                expiries.append((ts, token))
+            nsessions += 1
+        for new, shard, lock in zip(
+                shards, self.__shards, self.__shard_locks):
+            with lock:
+                shard.update(new)
+        with self.__users_lock:
+            for username, tokens in user_tokens.items():
+                self.__user_tokens.setdefault(
+                    username, set()).update(tokens)
+        with self.__expiry_lock:
+            self.__expiry_heap.extend(expiries)
+            heapq.heapify(self.__expiry_heap)
+        self.__changed(nsessions)
+        if bad_lines:
+            logger.warning(
+                'Skipped {} invalid lines of the snapshot, the first '
+                'is line {}'.format(len(bad_lines), bad_lines[0]))
+        return nusers, nsessions
+
+    def save(self, path):
+        '''Atomically writes a snapshot (see dump) to path
+
+        The file is readable only by the owner, since it contains
+        password hashes and session tokens.
+        '''
+
+        path = os.path.abspath(path)
+        changes = self.__changes
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.{}.'.format(os.path.basename(path)))
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                count = self.dump(fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.__saved_changes = changes
+        logger.debug('Saved {} sessions to {}'.format(count, path))
+
+    def restore(self, path):
+        '''Loads a snapshot from path, if it exists (see load)'''
+
+        try:
+            fh = open(path, 'r')
+        except FileNotFoundError:
+            logger.debug('No snapshot at {}'.format(path))
+            return 0, 0
+        with fh:
+            nusers, nsessions = self.load(fh)
+        self.__saved_changes = self.__changes
+        logger.debug('Restored {} users and {} sessions from {}'.format(
+            nusers, nsessions, path))
+        return nusers, nsessions
+
+    def start_snapshots(self, path, interval):
+        '''Saves a snapshot to path every interval seconds
+
+        Snapshots are written from a daemon thread and skipped if
+        nothing has changed since the last one.
+        '''
+
+        self.stop_snapshots(save_to=None)
+        self.__snapshot_stop = stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                if self.__changes == self.__saved_changes:
+                    continue
+                try:
+                    self.save(path)
+                except (IOError, OSError) as e:
+                    logger.error('Cannot save snapshot: {}'.format(e))
+
+        self.__snapshot_thread = threading.Thread(
+            target=run, name='MemoryStoreSnapshot')
+        self.__snapshot_thread.daemon = True
+        self.__snapshot_thread.start()
+
+    def stop_snapshots(self, save_to=None):
+        '''Stops periodic snapshots and optionally saves a final one'''
+
+        if self.__snapshot_thread is not None:
+            self.__snapshot_stop.set()
+            self.__snapshot_thread.join()
+            self.__snapshot_thread = self.__snapshot_stop = None
+        if save_to is not None:
+            self.save(save_to)
+
+    def __unindex_user_token(self, username, token, locked=False):
+        if not locked:
+            with self.__users_lock:
+                return self.__unindex_user_token(
+                    username, token, locked=True)
+        tokens = self.__user_tokens.get(username)
+        if tokens is None:
+            return
+        tokens.discard(token)
+        if not tokens:
+            del self.__user_tokens[username]
+
+    def __add_stale_expiries(self, count):
+        '''Records removed sessions, rebuilds the expiry index if due
+
+        The index is rebuilt from the live sessions once the entries
+        of removed ones outnumber them (and there are at least 1024).
+        '''
+
+        if not count:
+            return
+        with self.__expiry_lock:
+            self.__stale_expiries += count
+            heap = self.__expiry_heap
+            if self.__stale_expiries < max(1024, len(heap) // 2):
+                return
+            new = []
+            for shard, lock in zip(self.__shards, self.__shard_locks):
+                with lock:
+                    for token, rec in shard.items():
+                        ts = self._expiry_to_timestamp(rec.expiry)
+                        if ts is not None:
+                            new.append((ts, token))
+            heapq.heapify(new)
+            logger.debug('Rebuilt expiry index: {} -> {} entries'.format(
+                len(heap), len(new)))
+            self.__expiry_heap = new
+            self.__stale_expiries = 0
 
 class BaseAuthInMemoryHTTPRequestHandler(BaseAuthHTTPRequestHandler):
     '''Implements in-memory storage of users and sessions
 
     Incomplete, must be inherited, and the child class must define
     methods for creating and sending tokens.
+
+    Users and sessions are kept in a MemoryStore shared by all
+    children, which is safe to use from multiple threads. It can be
+    saved to and restored from a file, so that sessions survive
+    a restart, see restore_snapshot and start_snapshots.
     '''
 
-    __users = {}  # username-User key-valuse
-    __sessions = {}  # token--Session key-values
+    __store = MemoryStore()
 
     @classmethod
-    def find_session(cls, token):
-        '''Returns the Session corresponding to the token
+    def restore_snapshot(cls, path):
+        '''Loads users and sessions saved by save_snapshot
 
-        Child class should implement
+        Should be called before the server starts accepting requests
+        and after any users have been loaded (those take precedence
+        over saved ones). Does nothing if path does not exist.
+        Returns a tuple of the number of users and sessions restored.
         '''
 
-        try:
-            return cls.__sessions[token]
-        except KeyError:
+        return cls.__store.restore(path)
+
+    @classmethod
+    def save_snapshot(cls, path):
+        '''Saves all users and unexpired sessions to path'''
+
+        cls.__store.save(path)
+
+    @classmethod
+    def start_snapshots(cls, path, interval=60):
+        '''Saves a snapshot to path every interval seconds'''
+
+        cls.__store.start_snapshots(path, interval)
+
+    @classmethod
+    def stop_snapshots(cls, path=None):
+        '''Stops periodic snapshots; saves a final one if path given'''
+
+        cls.__store.stop_snapshots(save_to=path)
+
+    @classmethod
+    def find_session(cls, token):
+        '''Returns the Session corresponding to the token'''
+
+        if token is None:
             return None
+        return cls.__store.get_session(token)
 
     @classmethod
     def get_all_sessions(cls):
-        '''Returns a list of Sessions'''
+        '''Returns an iterator over all Sessions'''
 
-        return list(cls.__sessions.values())
+        return cls.__store.iter_sessions()
 
     @classmethod
     def add_session(cls, session):
         '''Records the Session'''
 
-        cls.__sessions[session.token] = session
+        cls.__store.add_session(session)
 
     @classmethod
     def rm_session(cls, session):
         '''Deletes the Session'''
 
-        del cls.__sessions[session.token]
+        cls.__store.rm_session(session.token)
+
+    @classmethod
+    def rm_user_sessions(cls, user):
+        '''Deletes all Sessions of the user'''
+
+        cls.__store.rm_user_sessions(user.username)
+
+    @classmethod
+    def prune_old_sessions(cls):
+        '''Removes expired sessions using the store's expiry index'''
+
+        cls.__store.pop_expired_sessions()
 
     @classmethod
     def find_user(cls, username):
         '''Returns the User for that username'''
 
-        try:
-            return cls.__users[username]
-        except KeyError:
-            return None
+        return cls.__store.get_user(username)
 
     @classmethod
     def create_user(cls, username, password, roles=None):
         '''Creates and returns a new User'''
 
         u = User(username=username, password=password, roles=roles)
-        cls.__users[username] = u
+        cls.__store.add_user(u)
         return u
 
     @classmethod
     def update_user(cls, user, **kargs):
-        '''Does nothing'''
+        '''Users are updated in place
+
+        Records the change for snapshots and calls forget_user.
+        '''
 
-        pass
+        cls.__store.touch()
+        cls.forget_user(user.username)
@@ -9,14 +9,20 @@ import errno
 from datetime import datetime
 import shutil
 import mimetypes
+import fnmatch
 import urllib
 import json
 from .._py2 import _JSONDecodeError
 import base64
 import binascii
+import threading
+from collections import OrderedDict
+import gzip
+import zlib
 from wrapt import decorator
 from string import Template
 
+from ..cache import ResponseCache
 from ..endpoints import Endpoint
 from ..endpoints.exc import NotAnEndpointError, \
     MethodNotAllowedError, MissingArgsError, ExtraArgsError
@@ -31,14 +37,31 @@ logger = logging.getLogger(__name__)
 def methodhandler(realhandler, self, args, kwargs):
     '''Decorator for do_{HTTP METHOD} handlers
 
+    Answers CORS preflight requests straight away if fast_preflight
+    is True.
     Sets the canonical pathname, query and body; checks if the request
     is allowed, and if it's for an endpoint.
-    Calls the endpoint's handler or the HTTP method handler
+    Calls begin_request, the endpoint's handler or the HTTP method
+    handler, and finally end_request
     '''
 
+    try:
+        self.begin_request()
+        _handle_method(realhandler, self, args, kwargs)
+    finally:
+        self.end_request()
+
+def _handle_method(realhandler, self, args, kwargs):
+    '''Does the work of methodhandler'''
+
     logger.debug('INIT for method handler')
     logger.debug('Path is {}'.format(self.path))
 
+    if self.fast_preflight and self.is_preflight():
+        logger.debug('Answering CORS preflight')
+        self.send_response_empty()
+        return
+
     # split query from pathname and decode them
     # TODO other encodings??
     # take only the first set of parameters (i.e. everything
@@ -104,14 +127,196 @@ def methodhandler(realhandler, self, args, kwargs):
             self.pathname[len(self.endpoint_prefix):]
         logger.debug('Calling endpoint handler, path is {}'.format(
             self.pathname))
-        self.ep.handler(*args, **kwargs)
+        if self.ep.cache and self.command in ['GET', 'HEAD']:
+            self._BaseHTTPRequestHandler__handle_cached(args, kwargs)
+        else:
+            self.ep.handler(*args, **kwargs)
+
+class _ResponseRecorder(object):
+    '''Wraps wfile and records the response for the response cache
+
+    Headers are recorded by BaseHTTPRequestHandler.send_header until
+    the recorder is sealed in end_headers, after the saved headers
+    (see save_header) are sent, so that custom headers and
+    Cache-Control, which are computed for each request, are not
+    recorded. The body is whatever is written after the headers.
+    '''
+
+    # headers which are never replayed from the cache
+    _skip_headers = {'date', 'server', 'connection', 'content-length'}
+    # responses with those are not cached at all
+    _uncacheable_headers = {'set-cookie', 'transfer-encoding'}
+
+    def __init__(self, wfile, max_size):
+        self.wfile = wfile
+        self.max_size = max_size
+        self.sealed = False
+        self.code = None
+        self.headers = []
+        self.body = None  # a list once the headers are flushed
+        self.size = 0
+
+    def write(self, data):
+        if self.body is None:
+            if self.code is None and data.startswith(b'HTTP/'):
+                self.code = int(data.split(b' ', 2)[1])
+        elif self.size <= self.max_size:
+            self.body.append(bytes(data))
+            self.size += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.wfile, attr)
+
+    def entry(self):
+        '''Returns a ResponseCache entry or None if not cacheable
+
+        Only complete 200 responses with a Content-Length and no
+        cookies are cacheable.
+        '''
+
+        if self.code != 200 or self.body is None \
+                or self.size > self.max_size:
+            return None
+        headers = []
+        length = None
+        for h, v in self.headers:
+            name = h.lower()
+            if name in self._uncacheable_headers:
+                return None
+            if name == 'content-length':
+                length = int(v)
+            if name not in self._skip_headers:
+                headers.append((h, v))
+        if length != self.size:
+            return None
+        return {'code': self.code,
+                'headers': headers,
+                'data': b''.join(self.body),
+                'gzip': None}
+
+def _template_page(pages, template):
+    '''Returns the template's page or the default one'''
+
+    try:
+        return pages[template['page']]
+    except KeyError:
+        logger.debug('Using default template page')
+        return pages['default']
+
+def _compile_cache_policy(policy):
+    '''Returns (path regex, type regex, Cache-Control value)
+
+    See BaseHTTPRequestHandler.send_cache_control.
+    '''
+
+    path = policy.get('path')
+    if path is not None:
+        path = re.compile(path)
+    types = policy.get('type')
+    if types is not None:
+        if not is_seq_like(types):
+            types = [types]
+        types = re.compile(
+            '|'.join(fnmatch.translate(t) for t in types), re.I)
+    directives = []
+    for key, value in policy.items():
+        if key in ['path', 'type'] or value is None or value is False:
+            continue
+        if value is True:
+            directives.append(key.replace('_', '-'))
+        else:
+            directives.append('{}={}'.format(
+                key.replace('_', '-'), value))
+    return (path, types, ', '.join(directives))
+
+class _CompiledTemplate(object):
+    '''A template and its page compiled into literals and fields
+
+    The template's fields are substituted in the page once; the
+    result is split into literal segments and the names of the
+    remaining fields, so that rendering is a single join. Fields
+    which are not given when rendering are removed, unless they are
+    in braces (${name}), in which case they are left as is.
+    If the template has a memo item, the last that many rendered
+    pages are kept, keyed by the given field values.
+    '''
+
+    def __init__(self, template, page):
+        self.template = template
+        self.page = page
+        self.fields = template.get('fields')
+        data = Template(page['data']).safe_substitute(
+            self.fields or {})
+        self.__parts = []
+        self.__slots = []
+        literal = []
+        pos = 0
+        for m in Template.pattern.finditer(data):
+            literal.append(data[pos:m.start()])
+            pos = m.end()
+            if m.group('escaped') is not None:
+                literal.append('$')
+                continue
+            if m.group('invalid') is not None:
+                literal.append(data[m.start():m.end()])
+                continue
+            self.__parts.append(self.__strip(literal))
+            literal = []
+            name = m.group('named') or m.group('braced')
+            leftover = '' if m.group('named') else m.group()
+            self.__slots.append((len(self.__parts), name))
+            self.__parts.append(leftover)
+        literal.append(data[pos:])
+        self.__parts.append(self.__strip(literal))
+        self.__names = sorted(set(name for _, name in self.__slots))
+        self.__memo_size = template.get('memo', 0)
+        self.__memo = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __strip(literal):
+        # remove anything that looks like an invalid field
+        return re.sub('\$[a-zA-Z0-9_]+', '', ''.join(literal))
+
+    def render(self, dynfields):
+        '''Returns the page as encoded bytes'''
+
+        values = {name: str(dynfields[name])
+                  for name in self.__names if name in dynfields}
+        if not self.__memo_size:
+            return self.__render(values)
+        key = tuple(values.items())
+        data = self.__memo.get(key)
+        if data is None:
+            data = self.__render(values)
+            with self.__lock:
+                self.__memo[key] = data
+                while len(self.__memo) > self.__memo_size:
+                    self.__memo.popitem(last=False)
+        return data
+
+    def __render(self, values):
+        parts = list(self.__parts)
+        for i, name in self.__slots:
+            if name in values:
+                parts[i] = values[name]
+        data = ''.join(parts)
+        try:
+            return data.encode('utf-8')
+        except UnicodeEncodeError:
+            logger.debug('Errors encoding page body')
+            return data.encode('utf-8', errors='backslashreplace')
 
 
 ############################################################
 class BaseMeta(type):
     '''Metaclass for BaseHTTPRequestHandler
 
-    Adds each of the parents' endpoints, templates and template pages
+    Adds each of the parents' endpoints, templates, template pages
+    and cache policies; compiles the templates (see
+    page_from_template) and the cache policies (see
+    send_cache_control)
     '''
 
     def __new__(cls, name, bases, attrs):
@@ -121,14 +326,16 @@ class BaseMeta(type):
         logger.debug('New class {}; bases: {}'.format(
             name, [b.__name__ for b in bases]))
         # every child gets it's own class attribute for _endpoints,
-        # _template_pages and _templates, which combines all parents'
-        # attributes
+        # _template_pages, _templates and _cache_policies, which
+        # combines all parents' attributes
         required_classes = {
             '_endpoints': Endpoint,
             '_template_pages': DictNoClobber,
             '_templates': DictNoClobber,
+            '_cache_policies': DictNoClobber,
         }
-        for attr in ['_endpoints', '_template_pages', '_templates']:
+        for attr in ['_endpoints', '_template_pages', '_templates',
+                     '_cache_policies']:
             try:
                 dic = getattr(new_class, attr)
             except AttributeError:
@@ -146,6 +353,14 @@ class BaseMeta(type):
             logger.debug('Final {} for {}: {}'.format(
                 attr, name, list(getattr(new_class, attr).keys())))
 
+        new_class._compiled_templates = {}
+        for tmpl in new_class._templates.values():
+            new_class._compiled_templates[id(tmpl)] = _CompiledTemplate(
+                tmpl, _template_page(new_class._template_pages, tmpl))
+        new_class._compiled_cache_policies = [
+            _compile_cache_policy(policy)
+            for policy in new_class._cache_policies.values()]
+
         if new_class.path_prefix.endswith('/'):
             new_class.path_prefix = new_class.path_prefix.rstrip('/')
         if new_class.endpoint_prefix.endswith('/'):
@@ -156,9 +371,16 @@ class BaseMeta(type):
 class BaseHTTPRequestHandler(with_metaclass(
         BaseMeta, http.server.SimpleHTTPRequestHandler, object)):
     pollers = {}
+    response_cache = ResponseCache()
+    _compress_min_size = 1024
+    auto_etag = False
+    fast_preflight = False
+    assets = None
+    asset_manifest_url = '/asset-manifest.json'
     enable_directory_listing = False
     path_prefix = ''
     endpoint_prefix = ''
+    _stream_chunk_size = 65536
     _endpoints = Endpoint()
     _template_pages = DictNoClobber(
         default={
@@ -178,6 +400,7 @@ class BaseHTTPRequestHandler(with_metaclass(
         },
     )
     _templates = DictNoClobber()
+    _cache_policies = DictNoClobber()
 
     # copy the class attributes to instance ones, since Endpoint and
     # dicts are mutable
@@ -248,6 +471,10 @@ class BaseHTTPRequestHandler(with_metaclass(
         self.__params = None
         self.__headers_to_send = {}
         self.__params_to_send = {}
+        self.__recorder = None
+        self.__response_code = None
+        self.__response_ctype = None
+        self.__has_cache_control = False
         super().__init__(*args, **kwargs)
 
     @property
@@ -356,6 +583,49 @@ class BaseHTTPRequestHandler(with_metaclass(
 
         return None
 
+    def response_cache_user(self):
+        '''Returns who the request is authenticated as, or None
+
+        Responses to authenticated requests are only served from (and
+        saved in) the response cache if the endpoint's cache has
+        per_user set, and then separately for each user.
+        This implementation returns the Authorization header;
+        authentication handlers return the user of the session.
+        '''
+
+        return self.headers.get('Authorization')
+
+    def is_preflight(self):
+        '''Returns True if the request is a CORS preflight
+
+        That is an OPTIONS request with an Origin and an
+        Access-Control-Request-Method header, and no body.
+        '''
+
+        return self.command == 'OPTIONS' \
+            and 'Origin' in self.headers \
+            and 'Access-Control-Request-Method' in self.headers \
+            and self.headers.get('Content-Length', '0') == '0' \
+            and 'Transfer-Encoding' not in self.headers
+
+    def begin_request(self):
+        '''Child class overrides this
+
+        Called by methodhandler before anything else.
+        '''
+
+        pass
+
+    def end_request(self):
+        '''Child class overrides this
+
+        Called by methodhandler after the request has been handled,
+        even if the handler raised. Use it to release per-request
+        resources.
+        '''
+
+        pass
+
     def no_cache(self):
         '''Child overrides this
 
@@ -366,13 +636,57 @@ class BaseHTTPRequestHandler(with_metaclass(
         return False
 
     def send_cache_control(self):
-        '''Sends a no-caching directive if no_cache returns True'''
+        '''Sends the Cache-Control header for the response
+
+        Nothing is sent if the response already has a Cache-Control
+        header. Otherwise, if no_cache returns True, a no-caching
+        directive is sent. Otherwise, unless the response is an error,
+        the first policy in _cache_policies which matches is used.
+        _cache_policies maps a name to a dictionary with the following
+        items:
+            - path: a regex searched for in the pathname; optional
+            - type: a glob (or a list of globs) for the response's
+              Content-Type, e.g. 'image/*'; optional
+            - any other item is a directive, underscores are turned
+              into dashes. True values are sent as is (e.g.
+              immutable=True), other values are given as the
+              directive's value (e.g. max_age=3600); None or False
+              values are skipped.
+        For example:
+            _cache_policies = DictNoClobber(
+                assets={
+                    'path': '^/static/',
+                    'public': True,
+                    'max_age': 31536000,
+                    'immutable': True,
+                },
+                images={
+                    'type': 'image/*',
+                    'max_age': 3600,
+                    'stale_while_revalidate': 60,
+                },
+            )
+        A child's policies come before its parents' ones. Policies are
+        compiled once when the class is created.
+        '''
 
+        if self.__has_cache_control:
+            return
         if self.no_cache():
             self.send_header('Cache-Control',
                              'no-cache, no-store, must-revalidate')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Expires', '0')
+            return
+        if self.__response_code is None or self.__response_code >= 400:
+            return
+        ctype = (self.__response_ctype or '').split(';')[0].strip()
+        for path, types, value in self._compiled_cache_policies:
+            if (path is None or path.search(self.pathname)) \
+                    and (types is None or types.match(ctype)):
+                if value:
+                    self.send_header('Cache-Control', value)
+                return
 
     def send_custom_headers(self):
         '''Called from end_headers; child overrides this'''
@@ -495,8 +809,21 @@ class BaseHTTPRequestHandler(with_metaclass(
             - data: the content of the page
             - type: the content type
         headers: additional headers to send
+        If auto_etag is True, a weak ETag is computed from the body of
+        200 responses to GET, unless one has been given or saved, and
+        a 304 is sent instead if the client has it (see
+        validate_etag).
         '''
 
+        if self.auto_etag and code == 200 \
+                and self.command in ['GET', 'HEAD'] \
+                and 'ETag' not in headers \
+                and 'ETag' not in self.__headers_to_send:
+            etag = self.body_etag(page['data'])
+            if self.if_none_match(etag):
+                self.send_not_modified(etag)
+                return
+            headers = dict(headers, ETag=etag)
         self.send_response(code)
         self.send_header('Content-Type', page['type'])
         self.send_header('Content-Length', len(page['data']))
@@ -504,6 +831,62 @@ class BaseHTTPRequestHandler(with_metaclass(
         self.end_headers()
         self.write(page['data'])
 
+    @staticmethod
+    def body_etag(data):
+        '''Returns a weak ETag for the body
+
+        It is a (non-cryptographic) CRC32 checksum and the length of
+        data.
+        '''
+
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return 'W/"{:x}-{:08x}"'.format(len(data), zlib.crc32(data))
+
+    def if_none_match(self, etag):
+        '''Returns True if the client's If-None-Match matches etag
+
+        Uses the weak comparison, i.e. W/ prefixes are ignored. Tags
+        may be quoted or not.
+        '''
+
+        current = self.headers.get('If-None-Match')
+        if current is None:
+            return False
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for t in current.split(','):
+            t = t.strip()
+            if t == '*':
+                return True
+            t = t[2:] if t.startswith('W/') else t
+            if t.strip('"') == etag.strip('"'):
+                return True
+        return False
+
+    def send_not_modified(self, etag=None):
+        '''Sends a 304 response, with the ETag if given'''
+
+        self.send_response(304)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+
+    def validate_etag(self, etag):
+        '''Checks a validator before generating the response
+
+        Handlers which can cheaply compute an ETag (e.g. from
+        a version number) can call this before doing the actual work.
+        It saves the ETag header for the response; if the client
+        already has it, sends a 304 and returns True, in which case
+        the handler should return without sending anything else.
+        '''
+
+        if self.command in ['GET', 'HEAD'] and self.if_none_match(etag):
+            self.send_not_modified(etag)
+            return True
+        self.save_header('ETag', etag, append=False)
+        return False
+
     def write(self, data):
         if not isinstance(data, bytes):
             data = data.encode('utf-8')
@@ -520,10 +903,31 @@ class BaseHTTPRequestHandler(with_metaclass(
         - path defaults to the URL (minus the leading / of course)
         - If as_attachment is True, we add Content-Disposition:
           attachment
+        - If auto_etag is True, a weak ETag is computed from the size
+          and modification time, and a 304 is sent if the client has
+          it
+        - If path is not given and assets is an AssetManifest, then
+          fingerprinted URLs are served with an immutable
+          Cache-Control, outdated ones are redirected to the current
+          one, and asset_manifest_url returns the manifest as JSON
         If path is a directory, will raise IsADirectoryError
         '''
 
-        if path is None:
+        asset = None
+        if path is None and self.assets is not None:
+            self.assets.refresh()
+            if self.pathname == self.asset_manifest_url:
+                self.send_as_json(self.assets.manifest,
+                                  headers={'Cache-Control': 'no-cache'})
+                return
+            asset = self.assets.resolve(self.pathname)
+            if asset is not None and not asset[1]:
+                self.send_response_goto(url='{}{}'.format(
+                    self.path_prefix, self.assets.url(asset[0])))
+                return
+        if asset is not None:
+            path = asset[0][1:]
+        elif path is None:
             path = self.pathname[1:]
         if path == '':
             path = '.'  # will raise IsADirectoryError
@@ -543,12 +947,32 @@ class BaseHTTPRequestHandler(with_metaclass(
             return
 
         fs = os.fstat(f.fileno())
+        if asset is not None and not self.assets.is_current(
+                asset[0], fs):
+            # changed since the last refresh
+            f.close()
+            self.assets.update(asset[0])
+            self.send_response_goto(url='{}{}'.format(
+                self.path_prefix, self.assets.url(asset[0])))
+            return
+        if self.auto_etag:
+            etag = 'W/"{:x}-{:x}"'.format(
+                fs.st_size, int(fs.st_mtime * 1000000))
+            if self.if_none_match(etag):
+                f.close()
+                self.send_not_modified(etag)
+                return
         self.send_response(200)
         ctype = mimetypes.guess_type(path)[0]
         if ctype is None:
             ctype = 'application/octet-stream'
         self.send_header('Content-Type', ctype)
         self.send_header('Content-Length', str(fs.st_size))
+        if self.auto_etag:
+            self.send_header('ETag', etag)
+        if asset is not None:
+            self.send_header('Cache-Control',
+                             'public, max-age=31536000, immutable')
         self.send_header(
             'Last-Modified',
             datetime.utcfromtimestamp(fs.st_mtime).strftime(
@@ -606,41 +1030,232 @@ class BaseHTTPRequestHandler(with_metaclass(
             code=code,
             headers=headers)
 
-    def page_from_template(self, template, dynfields={}):
-        '''Returns a page from the given template'''
+    def send_as_json_stream(self,
+                            iterable,
+                            serializer=None,
+                            ndjson=False,
+                            code=200,
+                            headers={}):
+        '''Sends the items of an iterable as JSON while iterating
+
+        - The response is a JSON array, or if ndjson is True,
+          newline-delimited JSON (one item per line).
+        - No Content-Length is sent. If the client and server speak
+          HTTP/1.1, the body is chunked, otherwise the connection is
+          closed at the end.
+        - Serialized items are buffered up to _stream_chunk_size bytes
+          before being written.
+        If iterating or serializing raises an exception, it is logged
+        and the connection is closed without terminating the body, so
+        the client can tell the response is incomplete. It is not
+        re-raised, since the headers have been sent and no other
+        response can be.
+        Returns False if the client closed the connection early or
+        the response is incomplete.
+        '''
 
-        try:
-            page = self._template_pages[template['page']].copy()
-        except KeyError:
-            logger.debug('Using default template page')
-            page = self._template_pages['default'].copy()
+        chunked = self.request_version != 'HTTP/0.9' \
+            and self.request_version != 'HTTP/1.0' \
+            and self.protocol_version >= 'HTTP/1.1'
+        self.send_response(code)
+        self.send_header(
+            'Content-Type',
+            'application/x-ndjson' if ndjson else 'application/json')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.send_headers(headers)
+        self.end_headers()
 
+        def flush(buf):
+            data = ''.join(buf).encode('utf-8')
+            del buf[:]
+            if not data:
+                return True
+            if chunked:
+                data = '{:x}\r\n'.format(len(data)).encode(
+                    'ascii') + data + b'\r\n'
+            return self.write(data)
+
+        encoder = json.JSONEncoder(default=serializer)
+        sep = '\n' if ndjson else ','
+        buf = [] if ndjson else ['[']
+        size = 0
+        first = True
         try:
-            fields = template['fields']
-        except KeyError:
-            logger.debug('No fields for template')
-            fields = {}
+            for item in iterable:
+                enc = encoder.encode(item)
+                if ndjson:
+                    buf.append(enc + sep)
+                elif first:
+                    buf.append(enc)
+                else:
+                    buf.append(sep + enc)
+                first = False
+                size += len(enc) + 1
+                if size >= self._stream_chunk_size:
+                    size = 0
+                    if not flush(buf):
+                        return False
+        except Exception as e:
+            logger.exception(
+                'Cannot stream the response, closing the connection: '
+                '{}'.format(e))
+            self.close_connection = True
+            return False
+        if not ndjson:
+            buf.append(']')
+        if not flush(buf):
+            return False
+        if chunked:
+            return self.write(b'0\r\n\r\n')
+        return True
+
+    def page_from_template(self, template, dynfields={}):
+        '''Returns a page from the given template
+
+        The template's fields are substituted in its page, then the
+        fields in dynfields. Unused fields are removed.
+        It's allowed to have the same field in the template as well as
+        in the page's field values (e.g. fields['BODY'] also has
+        '$BODY' in there). The second one will be replaced with the
+        value from dynfields.
+        Templates are compiled when the class is created; a template
+        or page which has since been replaced (rather than modified
+        in place) is compiled on each call. If the template has
+        a 'memo' item, that many rendered pages are kept, keyed by
+        dynfields.
+        '''
+
+        page = _template_page(self._template_pages, template)
+        compiled = self._compiled_templates.get(id(template))
+        if compiled is None or compiled.template is not template \
+                or compiled.page is not page \
+                or compiled.fields is not template.get('fields'):
+            logger.debug('Compiling template')
+            compiled = _CompiledTemplate(template, page)
+        page = page.copy()
+        page['data'] = compiled.render(dynfields)
+        return page
+
+    def accepts_encoding(self, encoding):
+        '''Returns True if the client accepts the content encoding'''
+
+        for enc in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, q = enc.partition(';')
+            if name.strip().lower() not in [encoding, '*']:
+                continue
+            q = q.strip()
+            try:
+                return not q.startswith('q=') or float(q[2:]) > 0
+            except ValueError:
+                return False
+        return False
 
-        page['data'] = Template(page['data']).safe_substitute(fields)
+    def __response_cache_key(self, user):
+        '''Returns the response cache key for the current request
 
-        # it's allowed to have the same field in the template as well
-        # as in the page's field values (e.g. fields['BODY'] also has
-        # '$BODY' in there. The second one will be replaced with the
-        # value from dynfields; so don't coalesce fields and dynfields
-        # together
-        page['data'] = Template(
-            page['data']).safe_substitute(dynfields)
+        It is made of the request's pathname, the query parameters
+        listed in the endpoint's cache params (all by default), the
+        values of the request headers listed in its cache vary and
+        the user (see response_cache_user). GET and HEAD share the
+        same key.
+        '''
+
+        conf = self.ep.cache
+        params = conf.get('params')
+        query = tuple(sorted(
+            (k, str(v)) for k, v in self.query.items()
+            if params is None or k in params))
+        vary = tuple(self.headers.get(h) for h in conf.get('vary', []))
+        return (type(self).__name__, self.pathname, query, vary, user)
+
+    def __handle_cached(self, args, kwargs):
+        '''Serves the endpoint from response_cache
+
+        On a miss calls the handler, recording the response, and
+        saves it. See the cache attribute of Endpoint.
+        '''
+
+        conf = self.ep.cache
+        user = self.response_cache_user()
+        if user is not None and not conf.get('per_user'):
+            logger.debug(('Not using the response cache for {}, '
+                          'request is authenticated').format(
+                              self.pathname))
+            self.ep.handler(*args, **kwargs)
+            return
+        tag = None
+        if conf.get('poller') is not None:
+            tag = self.pollers[conf['poller']].latest
+        key = self.__response_cache_key(user)
+        entry = self.response_cache.get(key, tag=tag)
+        if entry is not None:
+            logger.debug('Serving {} from the response cache'.format(
+                self.pathname))
+            self.__send_cached(entry)
+            return
+        if self.command == 'HEAD':
+            self.ep.handler(*args, **kwargs)
+            return
 
-        # remove unused fields and encode
-        page['data'] = re.sub('\$[a-zA-Z0-9_]+', '', page['data'])
+        self.__recorder = _ResponseRecorder(
+            self.wfile, self.response_cache.max_size)
+        self.wfile = self.__recorder
         try:
-            page['data'] = page['data'].encode('utf-8')
-        except UnicodeEncodeError:
-            logger.debug('Errors encoding page body')
-            page['data'] = page['data'].encode(
-                'utf-8', errors='backslashreplace')
+            self.ep.handler(*args, **kwargs)
+        finally:
+            self.wfile = self.__recorder.wfile
+            entry = self.__recorder.entry()
+            self.__recorder = None
+        if entry is None:
+            logger.debug('Response for {} is not cacheable'.format(
+                self.pathname))
+            return
+        self.__precompress(entry)
+        self.response_cache.save(
+            key, entry, ttl=conf.get('ttl'), tag=tag)
 
-        return page
+    def __precompress(self, entry):
+        '''Adds a gzip variant to the entry if worthwhile'''
+
+        if len(entry['data']) < self._compress_min_size:
+            return
+        ctype = ''
+        for h, v in entry['headers']:
+            if h.lower() == 'content-encoding':
+                return
+            if h.lower() == 'content-type':
+                ctype = v
+        if not re.match(('text/|application/(json|javascript|xml)|'
+                         '[^;]*\\+(json|xml)'), ctype):
+            return
+        data = gzip.compress(entry['data'])
+        if len(data) < len(entry['data']):
+            entry['gzip'] = data
+
+    def __send_cached(self, entry):
+        '''Replays a response saved in response_cache'''
+
+        for h, v in entry['headers']:
+            if h.lower() == 'etag' and self.if_none_match(v):
+                self.send_not_modified(v)
+                return
+        data = entry['data']
+        self.send_response(entry['code'])
+        for h, v in entry['headers']:
+            self.send_header(h, v)
+        if entry['gzip'] is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+            if self.accepts_encoding('gzip'):
+                data = entry['gzip']
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', len(data))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write(data)
 
     def __read_body(self):
         '''Sets __body to the body data
@@ -777,9 +1392,37 @@ class BaseHTTPRequestHandler(with_metaclass(
             'Sending final headers; this request has {}'.format(
                 self.__headers_to_send))
         self.send_headers(self.__headers_to_send)
+        if self.__recorder is not None:
+            self.__recorder.sealed = True
         self.send_custom_headers()
         self.send_cache_control()
         super().end_headers()
+        if self.__recorder is not None:
+            self.__recorder.body = []
+
+    def send_response(self, code, message=None):
+        '''Calls parent's send_response, remembering the code'''
+
+        self.__response_code = code
+        self.__response_ctype = None
+        self.__has_cache_control = False
+        super().send_response(code, message=message)
+
+    def send_header(self, keyword, value):
+        '''Calls parent's send_header, recording cached responses
+
+        Also remembers the Content-Type and whether Cache-Control has
+        been sent, for send_cache_control.
+        '''
+
+        if self.__recorder is not None and not self.__recorder.sealed:
+            self.__recorder.headers.append((keyword, str(value)))
+        name = keyword.lower()
+        if name == 'content-type':
+            self.__response_ctype = value
+        elif name == 'cache-control':
+            self.__has_cache_control = True
+        super().send_header(keyword, value)
 
     def send_error(self, code, message=None, explain=None):
         '''Calls parent's send_error with the correct signature
@@ -1,5 +1,6 @@
 from ._py2 import *
 import threading
+from collections import OrderedDict, deque
 
 from .utils import datetime_from_timestamp
 from uuid import uuid4 as uuid
@@ -76,3 +77,177 @@ class Poller:
 
     def is_match(self, tag):
         return self.__latest == tag
+
+class VersionPoller(Poller):
+    '''A Poller which also keeps versions of tables and rows
+
+    update takes the changes as given to DBConnection.track_changes
+    callbacks and, besides changing latest, increases the version of
+    each changed table and row. table_tag and row_tag return ETags
+    which only change when the given tables or row change.
+    - max_rows is the number of row versions remembered; rows which
+      have been forgotten take the version of the latest forgotten
+      row of that table.
+    '''
+
+    def __init__(self, max_rows=100000):
+        self.max_rows = max_rows
+        self.__lock = threading.Lock()
+        self.__uid = str(uuid())
+        self.__version = 0
+        self.__all = 0  # version of the last update without changes
+        self.__tables = {}  # table--version
+        self.__unknown_rows = {}  # table--version
+        self.__forgotten_rows = {}  # table--version
+        self.__rows = OrderedDict()  # (table, pk)--version
+        super().__init__()
+
+    def update(self, changes=None):
+        '''Records the changes and notifies waiters
+
+        If changes is None, then all tags change.
+        '''
+
+        with self.__lock:
+            self.__version += 1
+            version = self.__version
+            if changes is None:
+                self.__all = version
+            else:
+                for table, rows in changes.items():
+                    self.__tables[table] = version
+                    if rows is None:
+                        self.__unknown_rows[table] = version
+                        continue
+                    for pk in rows:
+                        self.__rows.pop((table, pk), None)
+                        self.__rows[(table, pk)] = version
+                while len(self.__rows) > self.max_rows:
+                    (table, pk), v = self.__rows.popitem(last=False)
+                    self.__forgotten_rows[table] = max(
+                        v, self.__forgotten_rows.get(table, 0))
+        super().update()
+
+    def table_tag(self, *tables):
+        '''Returns an ETag which changes when any table changes'''
+
+        version = max([self.__all] + [
+            self.__tables.get(t, 0) for t in tables])
+        return '{}-{}'.format(self.__uid, version)
+
+    def row_tag(self, table, pk):
+        '''Returns an ETag which changes when the row changes
+
+        pk is compared as a string, see DBConnection.track_changes.
+        '''
+
+        key = (table, str(pk))
+        version = max(
+            self.__all,
+            self.__unknown_rows.get(table, 0),
+            self.__rows.get(
+                key, self.__forgotten_rows.get(table, 0)))
+        return '{}-{}'.format(self.__uid, version)
+
+class ChangeFeed(object):
+    '''A bounded buffer of database change events with waiters
+
+    publish takes the changes as given to DBConnection.track_changes
+    callbacks and appends one event per changed row: a dictionary
+    with id, table, pk and op. Changes to unknown rows give an event
+    with a None pk and an 'unknown' op. Only the last size events are
+    kept.
+    Event ids are <epoch>-<number>, where epoch is unique to this
+    feed, so ids from before a restart are recognized as such.
+    '''
+
+    def __init__(self, size=10000):
+        self.__events = deque(maxlen=size)
+        self.__epoch = uuid().hex[:8]
+        self.__seq = 0
+        self.__waiter = threading.Condition(threading.Lock())
+        self.__closed = False
+
+    @property
+    def closed(self):
+        '''A boolean indicating if the feed has been closed'''
+
+        return self.__closed
+
+    @property
+    def last_id(self):
+        '''The id of the latest event'''
+
+        return '{}-{}'.format(self.__epoch, self.__seq)
+
+    def publish(self, changes):
+        with self.__waiter:
+            for table, rows in changes.items():
+                if rows is None:
+                    rows = {None: 'unknown'}
+                for pk, op in rows.items():
+                    self.__seq += 1
+                    self.__events.append({
+                        'id': '{}-{}'.format(self.__epoch, self.__seq),
+                        'seq': self.__seq,
+                        'table': table,
+                        'pk': pk,
+                        'op': op})
+            self.__waiter.notify_all()
+
+    def since(self, last_id, tables=None, ops=None):
+        '''Returns the events following last_id
+
+        - tables and ops, if given, are collections of the table
+          names and operations to return
+        Returns a tuple of (events, complete, last_id). complete is
+        False if some events following last_id are no longer kept (or
+        last_id is from a previous epoch or invalid); the client
+        should then refetch everything. The returned last_id should be
+        passed to the next call.
+        '''
+
+        with self.__waiter:
+            seq = self.__seq
+            events = list(self.__events)
+        complete = True
+        try:
+            epoch, last_seq = last_id.rsplit('-', 1)
+            last_seq = int(last_seq)
+            if epoch != self.__epoch or last_seq > seq:
+                raise ValueError
+        except (AttributeError, ValueError):
+            return [], last_id is None, '{}-{}'.format(
+                self.__epoch, seq)
+        if events and events[0]['seq'] > last_seq + 1:
+            complete = False
+        res = [
+            e for e in events
+            if e['seq'] > last_seq and e['seq'] <= seq
+            and (tables is None or e['table'] in tables)
+            and (ops is None or e['op'] in ops)]
+        return res, complete, '{}-{}'.format(self.__epoch, seq)
+
+    def wait(self, last_id, timeout=None):
+        '''Waits for events following last_id
+
+        Returns False if the feed has been closed or a timeout has
+        occurred.
+        '''
+
+        with self.__waiter:
+            if self.__closed:
+                return False
+            if self.last_id == last_id:
+                self.__waiter.wait(timeout=timeout)
+            return not self.__closed and self.last_id != last_id
+
+    def close(self):
+        '''Wakes up all waiting threads
+
+        From now on, wait will return False
+        '''
+
+        self.__closed = True
+        with self.__waiter:
+            self.__waiter.notify_all()
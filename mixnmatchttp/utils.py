@@ -5,7 +5,8 @@ from contextlib import contextmanager
 import re
 import string
 import random
-from collections import UserDict
+from collections import UserDict, OrderedDict
+import threading
 from ._py2 import _abcoll
 import logging
 from datetime import datetime, tzinfo, timedelta
@@ -153,6 +154,75 @@ class DictNoClobber(UserDict, object):
             return super().items()
 
 
+class SingleFlight(object):
+    '''Runs a function once for concurrent callers with the same key
+
+    While a call for a key is in progress, other callers with the same
+    key wait for it and get the same result. If keep is given, the
+    results of up to that many keys are also kept (least recently
+    used are dropped) and returned to later callers, so the key
+    should change whenever the result would (e.g. include a poller's
+    tag).
+    If timeout is given, callers wait for a call in progress for at
+    most that many seconds.
+    '''
+
+    def __init__(self, keep=0, timeout=None):
+        self.keep = keep
+        self.timeout = timeout
+        self.shared = 0  # number of calls served by another's result
+        self.timeouts = 0  # number of callers which stopped waiting
+        self.__lock = threading.Lock()
+        self.__calls = {}  # key--[Event, result, failed]
+        self.__results = OrderedDict()
+
+    def do(self, key, func, keep=True):
+        '''Returns func() or the result of a concurrent call
+
+        - If keep is False, the result is not kept for later callers
+        If func raises, the exception propagates to its caller only;
+        the callers waiting on it get None. So do callers which time
+        out waiting, see timeout. None means that the caller should
+        do the work itself.
+        '''
+
+        with self.__lock:
+            try:
+                result = self.__results.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.__results[key] = result  # most recently used
+                self.shared += 1
+                return result
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = [
+                    threading.Event(), None, True]
+        if not leader:
+            if not call[0].wait(self.timeout):
+                with self.__lock:
+                    self.timeouts += 1
+                return None
+            with self.__lock:
+                self.shared += 1
+            return None if call[2] else call[1]
+
+        try:
+            call[1] = func()
+            call[2] = False
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+                if keep and self.keep and not call[2] \
+                        and call[1] is not None:
+                    self.__results[key] = call[1]
+                    while len(self.__results) > self.keep:
+                        self.__results.popitem(last=False)
+            call[0].set()
+        return call[1]
+
 def to_bool(val):
     '''Converts val to a boolean. val can be numeric or a string
 
@@ -0,0 +1,92 @@
+'''The recursive object_to_dict replaced by ObjectSerializer, and
+test data for comparing them
+
+Shared by tests/test_serializer.py and benchmarks/serializer.py.
+'''
+
+from datetime import datetime
+import re
+
+from sqlalchemy import inspect
+
+from mixnmatchttp.db.utils import is_mapper
+from mixnmatchttp.utils import is_seq_like, is_time_like, \
+    date_from_timestamp
+from mixnmatchttp.handlers.authenticator.dbapi import \
+    DBUser, DBRole, DBSession
+
+
+def reference_object_to_dict(obj,
+                             skip='_id$',
+                             no_skip=None,
+                             max_depth=None,
+                             convert_timestamp=date_from_timestamp,
+                             short_mappings={},
+                             seen=None):
+    def transform_value(key, val, seen):
+        if is_seq_like(val):
+            return [transform_value(key, e, seen) for e in val]
+        elif convert_timestamp is not None and is_time_like(val) \
+                and re.search('time|date', key, re.IGNORECASE):
+            return convert_timestamp(val)
+        elif is_mapper(val.__class__):
+            if val.__tablename__ in seen:
+                this_max_depth = 0
+            elif max_depth is None:
+                this_max_depth = None
+            else:
+                this_max_depth = max_depth - 1
+            return reference_object_to_dict(
+                val,
+                skip=skip,
+                no_skip=no_skip,
+                short_mappings=short_mappings,
+                max_depth=this_max_depth,
+                convert_timestamp=convert_timestamp,
+                seen=seen.union([val.__tablename__]))
+        return val
+
+    def get_short_value(obj):
+        _short_mappings = {
+            'user': ['{}', 'username'],
+            'session': ['{}', 'token'],
+            'role': ['{}', 'name']}
+        _short_mappings.update(short_mappings)
+        try:
+            fmt = _short_mappings[obj.__tablename__]
+        except KeyError:
+            fmt = ['{}', 'id']
+        vals = []
+        for attr in fmt[1:]:
+            val = getattr(obj, attr)
+            while is_mapper(val.__class__):
+                val = get_short_value(val)
+            vals.append(val)
+        return fmt[0].format(*vals)
+
+    if max_depth == 0:
+        return get_short_value(obj)
+    data = {}
+    if seen is None:
+        seen = set([obj.__tablename__])
+    for attr in inspect(obj).attrs:
+        if (skip is not None and re.search(skip, attr.key)) \
+                and (no_skip is None
+                     or not re.search(no_skip, attr.key)):
+            continue
+        data[attr.key] = transform_value(attr.key, attr.value, seen)
+    return data
+
+
+def populate(db, users=2, sessions=2):
+    roles = [DBRole(name='admin'), DBRole(name='guest')]
+    db.add_all(roles)
+    for u in range(users):
+        user = DBUser(username='user{}'.format(u), password='x',
+                      roles=roles[:u % 2 + 1])
+        db.add(user)
+        for s in range(sessions):
+            db.add(DBSession(user=user,
+                             token='token{}.{}'.format(u, s),
+                             expiry=datetime(2030, 1, 1)))
+    db.commit()
@@ -0,0 +1,120 @@
+import http.client
+import os
+import threading
+import time
+
+import pytest
+
+from mixnmatchttp.cache import AssetManifest
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers import BaseHTTPRequestHandler
+
+
+def write(root, path, content):
+    fullpath = os.path.join(str(root), *path.split('/'))
+    if not os.path.isdir(os.path.dirname(fullpath)):
+        os.makedirs(os.path.dirname(fullpath))
+    with open(fullpath, 'w') as f:
+        f.write(content)
+    # so that the change is noticed even within the mtime resolution
+    st = os.stat(fullpath)
+    os.utime(fullpath, (st.st_atime, st.st_mtime + len(content)))
+
+
+@pytest.fixture
+def root(tmpdir):
+    write(tmpdir, 'js/app.js', 'one')
+    write(tmpdir, 'index.html', 'skipped')
+    write(tmpdir, '.hidden/x.js', 'skipped')
+    return str(tmpdir)
+
+
+def test_manifest_and_resolve(root):
+    assets = AssetManifest(root)
+    url = assets.url('/js/app.js')
+    assert url.startswith('/js/app.') and url.endswith('.js')
+    assert url != '/js/app.js'
+    assert assets.manifest == {'/js/app.js': url}
+    assert assets.url('/index.html') == '/index.html'
+    assert assets.resolve(url) == ('/js/app.js', True)
+    assert assets.resolve('/js/app.js') is None
+    assert assets.resolve('/js/other.{}.js'.format(
+        '0' * AssetManifest.hash_length)) is None
+
+
+def test_update_on_change(root):
+    assets = AssetManifest(root)
+    old = assets.url('/js/app.js')
+    write(root, 'js/app.js', 'changed')
+    st = os.stat(os.path.join(root, 'js', 'app.js'))
+    assert not assets.is_current('/js/app.js', st)
+    assets.update('/js/app.js')
+    assert assets.is_current('/js/app.js', st)
+    new = assets.url('/js/app.js')
+    assert new != old
+    assert assets.resolve(old) == ('/js/app.js', False)
+    os.remove(os.path.join(root, 'js', 'app.js'))
+    assets.update('/js/app.js')
+    assert assets.manifest == {}
+
+
+def test_refresh_in_background(root):
+    assets = AssetManifest(root, interval=0)
+    write(root, 'css/site.css', 'body {}')
+    assets.refresh()
+    for i in range(100):
+        if '/css/site.css' in assets.manifest:
+            break
+        time.sleep(0.01)
+    assert '/css/site.css' in assets.manifest
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def port(root, monkeypatch):
+    # files are opened relative to the working directory
+    monkeypatch.chdir(root)
+    Handler.assets = AssetManifest('.', interval=3600)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    Handler.assets = None
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp, body
+
+
+def test_served(port):
+    url = Handler.assets.url('/js/app.js')
+    resp, body = get(port, url)
+    assert resp.status == 200
+    assert body == b'one'
+    assert 'immutable' in resp.getheader('Cache-Control')
+
+
+def test_old_fingerprint_redirected(port):
+    old = Handler.assets.url('/js/app.js')
+    write('.', 'js/app.js', 'two')
+    # noticed when served, before the next rescan
+    resp, body = get(port, old)
+    assert resp.status in (301, 302, 303, 307, 308)
+    new = Handler.assets.url('/js/app.js')
+    assert new != old
+    assert resp.getheader('Location').endswith(new)
+    resp, body = get(port, new)
+    assert (resp.status, body) == (200, b'two')
+    resp, body = get(port, old)
+    assert resp.getheader('Location').endswith(new)
@@ -0,0 +1,144 @@
+from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+import pytest
+
+from mixnmatchttp.db import DBConnection, bulk_objects_from_dicts
+from mixnmatchttp.db.exc import ObjectExistsError, ObjectNotFoundError
+
+
+Base = declarative_base()
+
+
+class Parent(Base):
+    __tablename__ = 'parent'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30), unique=True, nullable=False)
+
+
+class Child(Base):
+    __tablename__ = 'child'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30), unique=True, nullable=False)
+    parent_id = Column(Integer, ForeignKey('parent.id'), nullable=False)
+    parent = relationship('Parent')
+
+
+@pytest.fixture
+def db():
+    dbconn = DBConnection(Base, 'sqlite://')
+    session = dbconn.session()
+    yield session
+    session.rollback()
+    dbconn.session.remove()
+    Base.metadata.drop_all(dbconn.engine)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_shared_new_parent(db, batch):
+    dics = [{'name': 'c1', 'parent': {'name': 'p'}},
+            {'name': 'c2', 'parent': {'name': 'p'}}]
+    children = bulk_objects_from_dicts(
+        db, Child, dics, batch=batch, add=True)
+    db.commit()
+    assert children[0].parent is children[1].parent
+    assert db.query(Parent).count() == 1
+    assert db.query(Child).count() == 2
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_existing_parent(db, batch):
+    db.add(Parent(name='p'))
+    db.commit()
+    dics = [{'name': 'c1', 'parent': {'name': 'p'}},
+            {'name': 'c2', 'parent': {'name': 'q'}},
+            {'name': 'c3', 'parent': {'name': 'q'}}]
+    bulk_objects_from_dicts(db, Child, dics, batch=batch, add=True)
+    db.commit()
+    assert sorted(p.name for p in db.query(Parent)) == ['p', 'q']
+    assert db.query(Child).count() == 3
+
+
+def both_modes(db, cls, dics, **kargs):
+    '''Returns the outcome without and with batch, which must match
+
+    The outcome is the exception class raised, or the names of the
+    parents and children in the database. Everything since the last
+    commit is rolled back after each mode.
+    '''
+
+    outcomes = []
+    for batch in [False, True]:
+        try:
+            bulk_objects_from_dicts(
+                db, cls, dics, batch=batch, add=True, **kargs)
+            db.flush()
+        except (ObjectExistsError, ObjectNotFoundError) as e:
+            outcomes.append(type(e))
+        else:
+            outcomes.append((sorted(p.name for p in db.query(Parent)),
+                             sorted(c.name for c in db.query(Child))))
+        db.rollback()
+    assert outcomes[0] == outcomes[1]
+    return outcomes[0]
+
+
+@pytest.fixture
+def existing(db):
+    db.add(Child(name='c', parent=Parent(name='p')))
+    db.commit()
+    return db
+
+
+def test_must_exist(existing):
+    db = existing
+    assert both_modes(db, Parent, [{'name': 'p'}], must_exist=True) \
+        == (['p'], ['c'])
+    assert both_modes(db, Parent, [{'name': 'p'}, {'name': 'q'}],
+                      must_exist=True) is ObjectNotFoundError
+
+
+def test_must_not_exist(existing):
+    db = existing
+    assert both_modes(db, Parent, [{'name': 'q'}, {'name': 'r'}],
+                      must_not_exist=True) == (['p', 'q', 'r'], ['c'])
+    assert both_modes(db, Parent, [{'name': 'q'}, {'name': 'p'}],
+                      must_not_exist=True) is ObjectExistsError
+    # created earlier in the same call
+    assert both_modes(db, Parent, [{'name': 'q'}, {'name': 'q'}],
+                      must_not_exist=True) is ObjectExistsError
+
+
+def test_children_must_exist(existing):
+    db = existing
+    assert both_modes(
+        db, Child,
+        [{'name': 'c1', 'parent': {'name': 'p'}},
+         {'name': 'c2', 'parent': {'name': 'p'}}],
+        children_must_exist=True) == (['p'], ['c', 'c1', 'c2'])
+    assert both_modes(
+        db, Child,
+        [{'name': 'c1', 'parent': {'name': 'p'}},
+         {'name': 'c2', 'parent': {'name': 'q'}}],
+        children_must_exist=True) is ObjectNotFoundError
+
+
+def test_children_must_not_exist(existing):
+    db = existing
+    assert both_modes(
+        db, Child,
+        [{'name': 'c1', 'parent': {'name': 'q'}},
+         {'name': 'c2', 'parent': {'name': 'r'}}],
+        children_must_not_exist=True) == (['p', 'q', 'r'],
+                                          ['c', 'c1', 'c2'])
+    assert both_modes(
+        db, Child,
+        [{'name': 'c1', 'parent': {'name': 'q'}},
+         {'name': 'c2', 'parent': {'name': 'p'}}],
+        children_must_not_exist=True) is ObjectExistsError
+    # created for the first child in the same call
+    assert both_modes(
+        db, Child,
+        [{'name': 'c1', 'parent': {'name': 'q'}},
+         {'name': 'c2', 'parent': {'name': 'q'}}],
+        children_must_not_exist=True) is ObjectExistsError
@@ -0,0 +1,81 @@
+import http.client
+import os
+import threading
+
+import pytest
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import \
+    AuthCookieDatabaseHTTPRequestHandler
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase
+
+
+class Handler(AuthCookieDatabaseHTTPRequestHandler):
+    _pwd_type = None
+    _change_feed_keepalive = 0.1
+
+    def log_message(self, *args):
+        pass
+
+
+class Sibling(AuthCookieDatabaseHTTPRequestHandler):
+    pass
+
+
+@pytest.fixture(scope='module')
+def port(tmpdir_factory):
+    path = os.path.join(str(tmpdir_factory.mktemp('db')), 'test.db')
+    dbconn = DBConnection(DBBase, 'sqlite:///{}'.format(path))
+    Handler.enable_change_feed('feed', DBBase)
+    Handler.enable_client_cache('feed', DBBase)
+    Handler.create_user('admin', 'x', ['admin'])
+    Handler.create_user('user', 'x', [])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    Handler.change_feeds['feed'].close()
+    dbconn.session.remove()
+
+
+def login(username):
+    session = Handler.generate_session(Handler.find_user(username))
+    Handler.add_session(session)
+    return session.token
+
+
+def get_changes(port, token=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    headers = {}
+    if token is not None:
+        headers['Cookie'] = 'SESSION={}'.format(token)
+    conn.request('GET', '/changes/feed', headers=headers)
+    resp = conn.getresponse()
+    conn.close()
+    return resp
+
+
+def test_feeds_are_per_class(port):
+    assert 'feed' in Handler.change_feeds
+    assert 'feed' in Handler.pollers
+    for cls in (Sibling, AuthCookieDatabaseHTTPRequestHandler):
+        assert 'feed' not in cls.change_feeds
+        assert 'feed' not in cls.pollers
+
+
+def test_anonymous_denied(port):
+    assert get_changes(port).status == 401
+
+
+def test_user_without_role_denied(port):
+    assert get_changes(port, login('user')).status == 403
+
+
+def test_admin_allowed(port):
+    resp = get_changes(port, login('admin'))
+    assert resp.status == 200
+    assert resp.getheader('Content-Type').startswith(
+        'text/event-stream')
@@ -0,0 +1,122 @@
+import http.client
+import json
+import os
+import threading
+
+import pytest
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers import BaseHTTPRequestHandler
+from mixnmatchttp.handlers.authenticator import \
+    needs_db_response_handling
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30), nullable=False)
+    color = Column(String(30))
+
+
+def name_only(obj, max_depth=None):
+    # an old-style serializer, without fields
+    return obj.name
+
+
+class Handler(BaseHTTPRequestHandler):
+    _endpoints = endpoints.Endpoint(
+        items={},
+        names={},
+        listed={},
+    )
+
+    @needs_db_response_handling(Base)
+    def do_items(self, db):
+        return db.query(Item)
+
+    @needs_db_response_handling(Base, json_serializer=name_only)
+    def do_names(self, db):
+        return db.query(Item)
+
+    @needs_db_response_handling(Base)
+    def do_listed(self, db):
+        return db.query(Item).all()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def port(tmpdir_factory):
+    path = os.path.join(str(tmpdir_factory.mktemp('db')), 'test.db')
+    dbconn = DBConnection(Base, 'sqlite:///{}'.format(path))
+    db = dbconn.session()
+    for i in range(1, 8):
+        db.add(Item(id=i, name='item{}'.format(i), color='red'))
+    db.commit()
+    dbconn.session.remove()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    dbconn.session.remove()
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    body = json.loads(resp.read().decode('utf-8'))
+    conn.close()
+    return resp, body
+
+
+def test_keyset_pages(port):
+    resp, body = get(port, '/items?limit=3')
+    assert [i['id'] for i in body] == [1, 2, 3]
+    resp, body = get(port, '/items?limit=3&after=3')
+    assert [i['id'] for i in body] == [4, 5, 6]
+    resp, body = get(port, '/items?limit=3&after=6')
+    assert [i['id'] for i in body] == [7]
+    resp, body = get(port, '/items?limit=7')
+    assert len(body) == 7
+
+
+def test_link_header(port):
+    resp, body = get(port, '/items?limit=3&after=3&max_depth=1')
+    assert resp.getheader('Link') == \
+        '</items?limit=3&after=6&max_depth=1>; rel="next"'
+    resp, body = get(port, '/items?limit=3&after=4')
+    assert resp.getheader('Link') is None
+    resp, body = get(port, '/items?limit=7')
+    assert resp.getheader('Link') is None
+
+
+def test_fields(port):
+    resp, body = get(port, '/items?limit=2&fields=name')
+    assert body == [{'name': 'item1'}, {'name': 'item2'}]
+    resp, body = get(port, '/items?fields=name,nosuchfield')
+    assert resp.status == 400
+
+
+def test_serializer_without_fields(port):
+    resp, body = get(port, '/names?limit=2')
+    assert body == ['item1', 'item2']
+
+
+def test_no_paging_of_lists(port):
+    resp, body = get(port, '/listed')
+    assert len(body) == 7
+    for query in ['limit=2', 'after=2']:
+        resp, body = get(port, '/listed?{}'.format(query))
+        assert resp.status == 400
+        assert 'limit' in body['error']
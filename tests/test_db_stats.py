@@ -0,0 +1,115 @@
+import http.client
+import json
+import os
+import threading
+
+import pytest
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.db.utils import MeteredQueuePool
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import \
+    AuthCookieDatabaseHTTPRequestHandler
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase
+
+
+def sqlite_url(tmpdir, name='test.db'):
+    return 'sqlite:///{}'.format(os.path.join(str(tmpdir), name))
+
+
+@pytest.fixture
+def dbconn(tmpdir):
+    dbconn = DBConnection(
+        DBBase, sqlite_url(tmpdir),
+        engine_kargs={'pool_size': 2, 'max_overflow': 1,
+                      'pool_timeout': 0.1})
+    yield dbconn
+    dbconn.session.remove()
+    dbconn.engine.dispose()
+
+
+def test_pool_only_when_sized(tmpdir):
+    dbconn = DBConnection(DBBase, sqlite_url(tmpdir, 'unsized.db'))
+    assert not isinstance(dbconn.engine.pool, MeteredQueuePool)
+    assert dbconn.pool_stats == {}
+    assert dbconn.prewarm() == 0
+    dbconn.engine.dispose()
+
+
+def test_pool_stats(dbconn):
+    assert isinstance(dbconn.engine.pool, MeteredQueuePool)
+    conns = [dbconn.engine.connect() for i in range(3)]
+    stats = dbconn.pool_stats['primary']
+    assert stats['size'] == 2
+    assert stats['max_overflow'] == 1
+    assert stats['checked_out'] == 3
+    assert stats['utilization'] == 1
+    with pytest.raises(PoolTimeoutError):
+        dbconn.engine.connect()
+    for conn in conns:
+        conn.close()
+    stats = dbconn.pool_stats['primary']
+    assert stats['checked_out'] == 0
+    assert stats['timeouts'] == 1
+    assert stats['max_wait'] >= 0.1
+    assert stats['wait_time'] >= stats['max_wait']
+
+
+def test_prewarm(dbconn):
+    dbconn.engine.dispose()
+    checkouts = dbconn.pool_stats['primary']['checkouts']
+    assert dbconn.prewarm() == 2
+    assert dbconn.engine.pool.checkedin() == 2
+    assert dbconn.prewarm(3) == 3
+    stats = dbconn.pool_stats['primary']
+    assert stats['checkouts'] == checkouts + 5
+    assert stats['checked_out'] == 0
+
+
+class Handler(AuthCookieDatabaseHTTPRequestHandler):
+    _pwd_type = None
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def port(dbconn):
+    dbconn.enable_query_monitor()
+    Handler.create_user('admin', 'x', ['admin'])
+    Handler.create_user('user', 'x', [])
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def get_stats(port, username=None):
+    headers = {}
+    if username is not None:
+        session = Handler.generate_session(Handler.find_user(username))
+        Handler.add_session(session)
+        headers['Cookie'] = 'SESSION={}'.format(session.token)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/dbstats', headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp.status, body
+
+
+def test_endpoint_acl(port):
+    assert get_stats(port)[0] == 401
+    assert get_stats(port, 'user')[0] == 403
+
+
+def test_endpoint(port, dbconn):
+    status, body = get_stats(port, 'admin')
+    assert status == 200
+    stats = json.loads(body.decode('utf-8'))[repr(dbconn.engine.url)]
+    assert stats['pool_stats']['primary']['size'] == 2
+    assert stats['session_stats']['created'] > 0
+    assert stats['query_stats']['queries'] > 0
@@ -0,0 +1,84 @@
+'''Query and row counts of the database storage lookups'''
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+import pytest
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.handlers.authenticator import \
+    AuthCookieDatabaseHTTPRequestHandler as Handler
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, \
+    DBUser, DBRole, DBSession
+
+
+class Statements(object):
+    '''Records the SELECT statements executed on an engine'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.executed = []
+        event.listen(engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.executed.append((statement, parameters))
+
+    def rows(self):
+        '''Returns the number of rows each statement fetches'''
+
+        executed = list(self.executed)
+        self.close()
+        try:
+            with self.engine.connect() as conn:
+                return [len(conn.execute(s, p).fetchall())
+                        for s, p in executed]
+        finally:
+            event.listen(
+                self.engine, 'before_cursor_execute', self.record)
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+
+@pytest.fixture
+def statements():
+    dbconn = DBConnection(DBBase, 'sqlite://')
+    db = dbconn.session()
+    roles = [DBRole(name='admin'), DBRole(name='user')]
+    user = DBUser(username='alice', password='x', roles=roles)
+    db.add(user)
+    expiry = datetime.now() + timedelta(hours=1)
+    for i in range(4):
+        db.add(DBSession(user=user, token='token{}'.format(i),
+                         expiry=expiry))
+    db.commit()
+    dbconn.session.remove()
+    recorder = Statements(dbconn.engine)
+    yield recorder
+    recorder.close()
+    dbconn.session.remove()
+    DBBase.metadata.drop_all(dbconn.engine)
+
+
+def test_find_user(statements):
+    user = Handler.find_user('alice')
+    assert sorted(r.name for r in user.roles) == ['admin', 'user']
+    # one query, one row per role, none per session
+    assert statements.rows() == [2]
+
+
+def test_find_session(statements):
+    session = Handler.find_session('token0')
+    assert session.user.username == 'alice'
+    assert len(session.user.roles) == 2
+    assert statements.rows() == [2]
+
+
+def test_prune_old_sessions(statements):
+    Handler.prune_old_sessions()
+    # only the sessions, not their users and roles
+    assert len(statements.executed) == 1
+    assert 'users' not in statements.executed[0][0]
+    assert statements.rows() == [4]
@@ -0,0 +1,126 @@
+import json
+import logging
+import socket
+import threading
+
+import pytest
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers import BaseHTTPRequestHandler
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    _stream_chunk_size = 20
+    _endpoints = endpoints.Endpoint(
+        items={},
+        broken={},
+    )
+
+    def do_items(self):
+        ndjson = self.get_param('ndjson', self.query) is not None
+        self.send_as_json_stream(
+            ({'n': i} for i in range(5)), ndjson=ndjson)
+
+    def do_broken(self):
+        def items():
+            for i in range(5):
+                yield {'n': i}
+            raise RuntimeError('cursor is gone')
+
+        self.send_as_json_stream(items())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def port():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def raw_get(port, path, version='HTTP/1.1'):
+    '''Returns the headers (a dict) and the raw body'''
+
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    sock.sendall('GET {} {}\r\nHost: localhost\r\n\r\n'.format(
+        path, version).encode('ascii'))
+    data = b''
+    while True:
+        # the server closes the connection after the last chunk only
+        # if it fails or speaks HTTP/1.0
+        if data.endswith(b'\r\n0\r\n\r\n'):
+            break
+        part = sock.recv(65536)
+        if not part:
+            break
+        data += part
+    sock.close()
+    head, body = data.split(b'\r\n\r\n', 1)
+    lines = head.decode('ascii').split('\r\n')
+    headers = {'status': lines[0]}
+    for line in lines[1:]:
+        k, v = line.split(': ', 1)
+        headers[k.lower()] = v
+    return headers, body
+
+
+def dechunk(body):
+    '''Returns the chunks, the last one is empty if complete'''
+
+    chunks = []
+    while body:
+        size, body = body.split(b'\r\n', 1)
+        size = int(size, 16)
+        chunks.append(body[:size])
+        assert body[size:size + 2] == b'\r\n'
+        body = body[size + 2:]
+    return chunks
+
+
+def test_chunked_json_array(port):
+    headers, body = raw_get(port, '/items')
+    assert headers['transfer-encoding'] == 'chunked'
+    assert headers['content-type'] == 'application/json'
+    assert 'content-length' not in headers
+    chunks = dechunk(body)
+    assert len(chunks) > 2
+    assert chunks[-1] == b''
+    assert json.loads(b''.join(chunks).decode('utf-8')) == [
+        {'n': i} for i in range(5)]
+
+
+def test_chunked_ndjson(port):
+    headers, body = raw_get(port, '/items?ndjson=1')
+    assert headers['content-type'] == 'application/x-ndjson'
+    chunks = dechunk(body)
+    assert chunks[-1] == b''
+    lines = b''.join(chunks).decode('utf-8').split('\n')
+    assert lines[-1] == ''
+    assert [json.loads(line) for line in lines[:-1]] == [
+        {'n': i} for i in range(5)]
+
+
+def test_http10_closes_connection(port):
+    headers, body = raw_get(port, '/items', version='HTTP/1.0')
+    assert 'transfer-encoding' not in headers
+    assert headers['connection'] == 'close'
+    assert json.loads(body.decode('utf-8')) == [
+        {'n': i} for i in range(5)]
+
+
+def test_error_closes_unterminated_body(port, caplog):
+    with caplog.at_level(logging.ERROR):
+        headers, body = raw_get(port, '/broken')
+    assert headers['status'].startswith('HTTP/1.1 200')
+    chunks = dechunk(body)
+    # no terminating chunk and no second response
+    assert chunks[-1] != b''
+    assert b'HTTP/' not in body
+    assert 'cursor is gone' in caplog.text
@@ -0,0 +1,83 @@
+import time
+
+import jwt
+import pytest
+
+from mixnmatchttp.handlers.authenticator import AuthJWTHTTPRequestHandler
+from mixnmatchttp.handlers.authenticator.api import User
+
+
+class First(AuthJWTHTTPRequestHandler):
+    pass
+
+
+class Second(AuthJWTHTTPRequestHandler):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def keys():
+    First.set_JWT_keys('first secret', algorithm='HS256')
+    Second.set_JWT_keys('second secret', algorithm='HS256')
+    yield
+
+
+def token(cls, **claims):
+    claims.setdefault('sub', 'alice')
+    claims.setdefault('exp', int(time.time()) + 60)
+    data = jwt.encode(claims, cls._enc_key, algorithm=cls._algorithm)
+    return data.decode('utf-8') if isinstance(data, bytes) else data
+
+
+def test_cached_claims_are_not_shared():
+    tok = First._get_new_jwt(User(username='alice'))
+    assert First._decode_jwt(tok)['sub'] == 'alice'
+    assert First._decode_jwt(tok)['sub'] == 'alice'  # cached
+    assert Second._decode_jwt(tok) is None
+
+
+def test_same_key_in_other_class_is_verified():
+    Second.set_JWT_keys('first secret')
+    tok = First._get_new_jwt(User(username='alice'))
+    assert First._decode_jwt(tok) is not None
+    assert Second._decode_jwt(tok) is not None
+
+
+def test_set_keys_clears_only_own_cache():
+    tok = First._get_new_jwt(User(username='alice'))
+    assert First._decode_jwt(tok) is not None
+    Second.set_JWT_keys('another secret')
+    assert First._decode_jwt(tok) is not None
+    First.set_JWT_keys('new secret')
+    assert First._decode_jwt(tok) is None
+
+
+def test_key_change_in_parent_not_served_from_cache():
+    class Child(First):
+        pass
+
+    tok = First._get_new_jwt(User(username='alice'))
+    assert Child._decode_jwt(tok) is not None
+    # the child inherits the new key, but its cache is not cleared
+    First.set_JWT_keys('new secret')
+    assert Child._decode_jwt(tok) is None
+
+
+def test_expired_claims_not_served_from_cache():
+    tok = token(First, exp=int(time.time()) + 1)
+    assert First._decode_jwt(tok) is not None
+    time.sleep(2.1)
+    assert First._decode_jwt(tok) is None
+
+
+def test_leeway():
+    First._jwt_leeway = 30
+    try:
+        tok = token(First, exp=int(time.time()) - 10)
+        assert First._decode_jwt(tok) is not None
+        assert First._decode_jwt(tok) is not None  # cached
+        tok = token(First, nbf=int(time.time()) + 10)
+        assert First._decode_jwt(tok) is not None
+    finally:
+        First._jwt_leeway = 0
+    assert First._decode_jwt(tok) is None
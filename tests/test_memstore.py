@@ -0,0 +1,237 @@
+import io
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from mixnmatchttp.handlers.authenticator.api import User, Session
+from mixnmatchttp.handlers.authenticator.storage import MemoryStore
+
+
+# in the future, since save dumps the sessions unexpired by now
+NOW = int(time.time()) + 3600
+
+
+def store_with_sessions(users=3, sessions=4):
+    store = MemoryStore(shards=4)
+    for u in range(users):
+        user = User(username='user{}'.format(u),
+                    password='pwd{}'.format(u),
+                    roles=['role{}'.format(u)])
+        store.add_user(user)
+        for s in range(sessions):
+            store.add_session(Session(
+                token='token{}.{}'.format(u, s), user=user,
+                expiry=NOW + 10 + s if s else None))
+    return store
+
+
+def snapshot(store):
+    fh = io.StringIO()
+    store.dump(fh, now=NOW)
+    return fh.getvalue()
+
+
+def sessions(store):
+    return sorted((s.token, s.user.username, s.expiry)
+                  for s in store.iter_sessions())
+
+
+def test_round_trip(tmpdir):
+    store = store_with_sessions()
+    store.add_session(Session(token='expired', user=store.get_user(
+        'user0'), expiry=NOW - 1))
+    path = os.path.join(str(tmpdir), 'snapshot')
+    store.save(path)
+    assert os.stat(path).st_mode & 0o077 == 0
+    restored = MemoryStore()
+    with open(path) as fh:
+        assert restored.load(fh, now=NOW) == (3, 12)
+    assert sessions(restored) == [
+        s for s in sessions(store) if s[0] != 'expired']
+    user = restored.get_user('user1')
+    assert user.password == 'pwd1'
+    assert [r.name for r in user.roles] == ['role1']
+    assert len(restored.user_sessions('user2')) == 4
+    assert sorted(s.token for s in restored.pop_expired_sessions(
+        now=NOW + 11)) == ['token0.1', 'token1.1', 'token2.1']
+
+
+def test_existing_users_are_kept():
+    restored = MemoryStore()
+    restored.add_user(User(username='user0', password='new'))
+    assert restored.load(io.StringIO(snapshot(store_with_sessions())),
+                         now=NOW) == (2, 12)
+    assert restored.get_user('user0').password == 'new'
+    # the sessions belong to the existing user
+    assert restored.get_session('token0.0').user \
+        is restored.get_user('user0')
+
+
+def test_truncated_snapshot(caplog):
+    data = snapshot(store_with_sessions())
+    restored = MemoryStore()
+    with caplog.at_level(logging.WARNING):
+        nusers, nsessions = restored.load(
+            io.StringIO(data[:-5]), now=NOW)
+    assert (nusers, nsessions) == (3, 11)
+    assert 'Skipped 1 invalid lines' in caplog.text
+
+
+@pytest.mark.parametrize('line', [
+    'garbage',
+    '["X", "what"]',
+    '["S", "token"]',
+    '["S", ["token"], "user0", null]',
+    '["S", "token", "user0", "tomorrow"]',
+    '["U", "user9", "pwd", "admin"]',
+    '["U", "user9", "pwd", [1]]',
+    '{}',
+])
+def test_invalid_lines_are_skipped(line):
+    lines = snapshot(store_with_sessions(users=1)).splitlines(True)
+    lines.insert(2, line + '\n')
+    restored = MemoryStore()
+    assert restored.load(io.StringIO(''.join(lines)), now=NOW) == (1, 4)
+    assert restored.get_user('user9') is None
+
+
+@pytest.mark.parametrize('data', [
+    '',
+    'token0 user0\n',
+    '["mixnmatchttp-memstore", 2]\n',
+    '{"users": []}\n',
+])
+def test_foreign_snapshot(data):
+    restored = MemoryStore()
+    with pytest.raises(ValueError):
+        restored.load(io.StringIO(data), now=NOW)
+    assert len(restored) == 0
+
+
+def test_restore_missing_file(tmpdir):
+    assert MemoryStore().restore(
+        os.path.join(str(tmpdir), 'missing')) == (0, 0)
+
+
+def run_threads(*targets):
+    threads = [threading.Thread(target=t) for t in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def test_concurrent_add_and_rm_user_sessions():
+    store = MemoryStore(shards=4)
+    alice = User(username='alice', password='x')
+    store.add_user(alice)
+    stop = threading.Event()
+
+    def add(n):
+        def run():
+            for i in range(2000):
+                store.add_session(Session(
+                    token='{}.{}'.format(n, i), user=alice,
+                    expiry=NOW))
+        return run
+
+    def rm():
+        while not stop.is_set():
+            store.rm_user_sessions('alice')
+
+    remover = threading.Thread(target=rm)
+    remover.start()
+    run_threads(*[add(n) for n in range(4)])
+    stop.set()
+    remover.join()
+    # every added session was indexed, so none is left behind
+    store.rm_user_sessions('alice')
+    assert len(store) == 0
+    assert store.user_sessions('alice') == []
+
+
+def test_concurrent_get_and_replace():
+    store = MemoryStore(shards=4)
+    users = [User(username='user{}'.format(i)) for i in range(4)]
+    for user in users:
+        store.add_user(user)
+    tokens = ['token{}'.format(i) for i in range(50)]
+    for token in tokens:
+        store.add_session(Session(token=token, user=users[0]))
+    missing = []
+
+    def replace(user):
+        def run():
+            for i in range(20):
+                for token in tokens:
+                    store.add_session(Session(token=token, user=user))
+        return run
+
+    def get():
+        for i in range(20):
+            for token in tokens:
+                if store.get_session(token) is None:
+                    missing.append(token)
+                if store.get_user('user0') is not users[0]:
+                    missing.append('user0')
+
+    run_threads(get, get, *[replace(u) for u in users])
+    assert missing == []
+    assert len(store) == len(tokens)
+    # each token is indexed under its current user only
+    indexed = []
+    for user in users:
+        for session in store.user_sessions(user.username):
+            assert session.user is user
+            indexed.append(session.token)
+    assert sorted(indexed) == sorted(tokens)
+
+
+def test_concurrent_add_and_expire():
+    store = MemoryStore(shards=4)
+    alice = User(username='alice')
+    store.add_user(alice)
+    removed = []
+
+    def add(n):
+        def run():
+            for i in range(1000):
+                # odd ones have expired
+                store.add_session(Session(
+                    token='{}.{}'.format(n, i), user=alice,
+                    expiry=NOW - 1 if i % 2 else NOW + 1))
+        return run
+
+    def expire():
+        for i in range(200):
+            removed.extend(
+                s.token for s in store.pop_expired_sessions(now=NOW))
+
+    run_threads(expire, expire, *[add(n) for n in range(4)])
+    removed.extend(
+        s.token for s in store.pop_expired_sessions(now=NOW))
+    assert len(removed) == len(set(removed)) == 2000
+    assert all(int(t.split('.')[1]) % 2 for t in removed)
+    assert len(store) == len(store.user_sessions('alice')) == 2000
+
+
+def test_expiry_index_is_rebuilt(caplog):
+    store = MemoryStore(shards=4)
+    alice = User(username='alice')
+    store.add_user(alice)
+    for i in range(3000):
+        store.add_session(Session(
+            token='token{}'.format(i), user=alice, expiry=NOW + i))
+    with caplog.at_level(logging.DEBUG):
+        for i in range(2000):
+            store.rm_session('token{}'.format(i))
+    # rebuilt once the removed entries were half of the index
+    assert 'Rebuilt expiry index: 3000 -> 1500 entries' in caplog.text
+    assert 'Rebuilt expiry index: 1500' not in caplog.text
+    expired = store.pop_expired_sessions(now=NOW + 2499)
+    assert sorted(s.token for s in expired) == sorted(
+        'token{}'.format(i) for i in range(2000, 2500))
+    assert len(store) == 500
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from sqlalchemy.orm import joinedload, selectinload
+
+from mixnmatchttp.db import DBConnection, filter_results
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, \
+    DBUser, DBRole
+
+
+@pytest.fixture
+def dbconn():
+    dbconn = DBConnection(DBBase, 'sqlite://')
+    db = dbconn.session()
+    db.add(DBUser(username='alice', password='x',
+                  roles=[DBRole(name='admin')]))
+    db.add(DBUser(username='bob', password='x'))
+    db.commit()
+    dbconn.session.remove()
+    yield dbconn
+    dbconn.session.remove()
+    DBBase.metadata.drop_all(dbconn.engine)
+
+
+def find(dbconn, username, options=()):
+    db = dbconn.session()
+    try:
+        return filter_results(db, DBUser, {'username': username},
+                              expect_one=True, options=list(options))
+    finally:
+        dbconn.session.remove()
+
+
+def test_hits(dbconn):
+    qcache = dbconn.enable_query_cache()
+    assert find(dbconn, 'alice').username == 'alice'
+    assert find(dbconn, 'alice').username == 'alice'
+    assert find(dbconn, 'bob').username == 'bob'
+    assert (qcache.hits, qcache.misses) == (1, 2)
+
+
+def test_equal_options_built_per_call_hit(dbconn):
+    qcache = dbconn.enable_query_cache()
+    for i in range(3):
+        user = find(dbconn, 'alice', [joinedload(DBUser.roles)])
+        # loaded, not lazily after the session was removed
+        assert [r.name for r in user.roles] == ['admin']
+    assert (qcache.hits, qcache.misses) == (2, 1)
+    find(dbconn, 'alice', [selectinload(DBUser.roles)])
+    find(dbconn, 'alice', [joinedload(DBUser.roles, innerjoin=True)])
+    find(dbconn, 'alice')
+    assert (qcache.hits, qcache.misses) == (2, 4)
+
+
+def test_ttl(dbconn):
+    qcache = dbconn.enable_query_cache(ttl=0.2)
+    find(dbconn, 'alice')
+    find(dbconn, 'alice')
+    time.sleep(0.3)
+    find(dbconn, 'alice')
+    assert (qcache.hits, qcache.misses) == (1, 2)
+
+
+def test_invalidation(dbconn):
+    qcache = dbconn.enable_query_cache()
+    find(dbconn, 'alice', [joinedload(DBUser.roles)])
+    find(dbconn, 'bob')
+    db = dbconn.session()
+    db.query(DBRole).filter_by(name='admin').one().name = 'root'
+    db.commit()
+    dbconn.session.remove()
+    # only the entry which loaded roles depends on them
+    user = find(dbconn, 'alice', [joinedload(DBUser.roles)])
+    assert [r.name for r in user.roles] == ['root']
+    find(dbconn, 'bob')
+    assert (qcache.hits, qcache.misses) == (1, 3)
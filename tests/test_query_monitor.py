@@ -0,0 +1,113 @@
+import http.client
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import \
+    AuthCookieDatabaseHTTPRequestHandler
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, DBUser
+
+
+@pytest.fixture
+def dbconn():
+    dbconn = DBConnection(DBBase, 'sqlite://')
+    yield dbconn
+    dbconn.session.remove()
+    DBBase.metadata.drop_all(dbconn.engine)
+
+
+def select(dbconn, times=1):
+    db = dbconn.session()
+    for i in range(times):
+        db.query(DBUser).filter_by(username='user{}'.format(i)).all()
+    dbconn.session.remove()
+
+
+def test_counts(dbconn):
+    monitor = dbconn.enable_query_monitor()
+    assert monitor.end() is None
+    select(dbconn)  # outside of a request
+    DBConnection.begin_monitoring('GET /users')
+    select(dbconn, 3)
+    stats = DBConnection.end_monitoring()
+    assert dbconn.url in stats
+    assert stats[dbconn.url][0] == 3
+    assert stats[dbconn.url][1] > 0
+    assert DBConnection.end_monitoring() == {}
+    totals = monitor.stats()
+    assert totals['queries'] == 4
+    assert totals['requests'] == 1
+    assert totals['time'] >= stats[dbconn.url][1]
+    assert totals['slow_queries'] == totals['repeated'] == 0
+
+
+def test_slow_queries(dbconn, caplog):
+    monitor = dbconn.enable_query_monitor(slow=0)
+    DBConnection.begin_monitoring('GET /users')
+    with caplog.at_level(logging.WARNING):
+        select(dbconn, 2)
+    DBConnection.end_monitoring()
+    assert monitor.stats()['slow_queries'] == 2
+    slow = [r.getMessage() for r in caplog.records
+            if r.getMessage().startswith('Slow query')]
+    assert len(slow) == 2
+    assert 'in GET /users:' in slow[0]
+
+
+def test_repeated_queries(dbconn, caplog):
+    monitor = dbconn.enable_query_monitor(repeat=2)
+    for label in ('GET /a', 'GET /b'):
+        DBConnection.begin_monitoring(label)
+        with caplog.at_level(logging.WARNING):
+            select(dbconn, 5)
+        DBConnection.end_monitoring()
+    # once per request, not per statement over the limit
+    assert monitor.stats()['repeated'] == 2
+    warnings = [r.getMessage() for r in caplog.records
+                if 'possible N+1 query' in r.getMessage()]
+    assert len(warnings) == 2
+    assert 'more than 2 times in GET /a' in warnings[0]
+
+
+class Handler(AuthCookieDatabaseHTTPRequestHandler):
+    _pwd_type = None
+    logged = []
+
+    def log_message(self, format, *args):
+        self.logged.append(format % args)
+
+
+@pytest.fixture
+def port(tmpdir):
+    path = os.path.join(str(tmpdir), 'test.db')
+    dbconn = DBConnection(DBBase, 'sqlite:///{}'.format(path))
+    dbconn.enable_query_monitor()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    dbconn.session.remove()
+
+
+def test_logged_per_request(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/logout?x=1',
+                 headers={'Cookie': 'SESSION=unknown'})
+    conn.getresponse().read()
+    conn.close()
+    # logged after the response has been sent
+    deadline = time.time() + 5
+    while True:
+        queries = [m for m in Handler.logged if ' queries in ' in m]
+        if queries or time.time() > deadline:
+            break
+        time.sleep(0.01)
+    assert len(queries) == 1
+    assert queries[0].startswith('"GET /logout?x=1 HTTP/1.1" ')
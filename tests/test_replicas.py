@@ -0,0 +1,128 @@
+import http.client
+import json
+import os
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import \
+    AuthCookieDatabaseHTTPRequestHandler, needs_db_response_handling
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, DBRole
+
+
+class Handler(AuthCookieDatabaseHTTPRequestHandler):
+    _endpoints = endpoints.Endpoint(
+        roles={
+            '$allowed_methods': {'GET', 'POST'},
+        },
+    )
+
+    @needs_db_response_handling(DBBase)
+    def do_roles(self, db):
+        session = self.get_current_session()
+        if self.command == 'POST':
+            db.add(DBRole(name='new'))
+            db.flush()
+        return {
+            'user': None if session is None
+            else session.user.username,
+            'roles': sorted(r.name for r in db.query(DBRole))}
+
+    def log_message(self, *args):
+        pass
+
+
+def role_names(url):
+    engine = create_engine(url)
+    try:
+        return sorted(r[0] for r in engine.execute(
+            'SELECT name FROM roles'))
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture(scope='module')
+def dbs(tmpdir_factory):
+    tmpdir = str(tmpdir_factory.mktemp('db'))
+    primary = 'sqlite:///{}'.format(os.path.join(tmpdir, 'primary.db'))
+    replica = 'sqlite:///{}'.format(os.path.join(tmpdir, 'replica.db'))
+    engine = create_engine(replica)
+    DBBase.metadata.create_all(engine)
+    # another id than the primary's rows, which the session may
+    # already hold after the user lookup
+    engine.execute(
+        "INSERT INTO roles (id, name) VALUES (100, 'replica')")
+    engine.dispose()
+    dbconn = DBConnection(DBBase, primary)
+    Handler.create_user('alice', 'x', ['primary'])
+    # replicas never lag here, so the client's window is not needed
+    dbconn.enable_replicas([replica], window=0)
+    yield dbconn, primary, replica
+    dbconn.session.remove()
+
+
+@pytest.fixture(scope='module')
+def port(dbs):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def request(port, method, token=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    headers = {}
+    if token is not None:
+        headers['Cookie'] = 'SESSION={}'.format(token)
+    conn.request(method, '/roles', headers=headers)
+    resp = conn.getresponse()
+    body = json.loads(resp.read().decode('utf-8'))
+    conn.close()
+    return body
+
+
+def login(username):
+    session = Handler.generate_session(Handler.find_user(username))
+    Handler.add_session(session)
+    return session.token
+
+
+def test_read_only_sessions_read_from_replica(dbs):
+    dbconn, primary, replica = dbs
+    with dbconn.session_context(info={'read_only': True}) as db:
+        assert [r.name for r in db.query(DBRole)] == ['replica']
+    with dbconn.session_context() as db:
+        assert [r.name for r in db.query(DBRole)] == ['primary']
+
+
+def test_writes_go_to_primary(dbs):
+    dbconn, primary, replica = dbs
+    with dbconn.session_context(info={'read_only': True}) as db:
+        db.add(DBRole(name='written'))
+        db.flush()
+        # the rest of the transaction reads from the primary
+        assert 'written' in [r.name for r in db.query(DBRole)]
+    assert 'written' in role_names(primary)
+    assert role_names(replica) == ['replica']
+
+
+def test_get_reads_from_replica_but_auth_from_primary(dbs, port):
+    token = login('alice')  # the session exists on the primary only
+    body = request(port, 'GET', token)
+    assert body == {'user': 'alice', 'roles': ['replica']}
+
+
+def test_post_reads_and_writes_primary(dbs, port):
+    dbconn, primary, replica = dbs
+    token = login('alice')
+    body = request(port, 'POST', token)
+    assert body['user'] == 'alice'
+    assert 'new' in body['roles'] and 'primary' in body['roles']
+    assert 'new' in role_names(primary)
+    assert 'new' not in role_names(replica)
@@ -0,0 +1,94 @@
+import http.client
+import threading
+import time
+
+import pytest
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers import BaseHTTPRequestHandler
+
+
+class Handler(BaseHTTPRequestHandler):
+    _endpoints = endpoints.Endpoint(
+        public={'$cache': {'ttl': 60}},
+        private={'$cache': {'per_user': True}},
+    )
+    calls = 0
+
+    def __count(self):
+        Handler.calls += 1
+        self.save_header('X-Saved', 'yes')
+        self.send_as_json({
+            'calls': Handler.calls,
+            'auth': self.headers.get('Authorization')})
+
+    def do_public(self):
+        self.__count()
+
+    def do_private(self):
+        self.__count()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def port():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def get(port, path, auth=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {}
+    if auth is not None:
+        headers['Authorization'] = auth
+    conn.request('GET', path, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp, body
+
+
+def wait_cached(size=1):
+    # responses are saved after they have been sent
+    for i in range(100):
+        if len(Handler.response_cache) >= size:
+            return
+        time.sleep(0.01)
+
+
+def test_anonymous_hit_keeps_saved_headers(port):
+    Handler.response_cache.clear()
+    resp1, body1 = get(port, '/public')
+    wait_cached()
+    resp2, body2 = get(port, '/public')
+    assert body1 == body2
+    assert resp1.getheader('X-Saved') == 'yes'
+    assert resp2.getheader('X-Saved') == 'yes'
+    assert resp2.getheader('Content-Length') == str(len(body2))
+
+
+def test_authenticated_not_cached(port):
+    Handler.response_cache.clear()
+    get(port, '/public')
+    resp, body = get(port, '/public', auth='Basic YTpi')
+    assert b'YTpi' in body
+    _, again = get(port, '/public', auth='Basic YTpi')
+    assert again != body
+    _, anonymous = get(port, '/public')
+    assert b'YTpi' not in anonymous
+
+
+def test_per_user(port):
+    Handler.response_cache.clear()
+    _, alice1 = get(port, '/private', auth='Basic YWxpY2U6eA==')
+    _, bob = get(port, '/private', auth='Basic Ym9iOng=')
+    wait_cached(2)
+    _, alice2 = get(port, '/private', auth='Basic YWxpY2U6eA==')
+    assert alice1 == alice2
+    assert bob != alice1 and b'Ym9i' in bob
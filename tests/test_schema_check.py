@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.db import utils
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30))
+
+
+class ServerDBConnection(DBConnection):
+    '''Takes the path of _create_db for database servers'''
+
+    @property
+    def url(self):
+        return 'postgresql://localhost/test'
+
+
+@pytest.fixture
+def url(tmpdir):
+    url = 'sqlite:///{}'.format(os.path.join(str(tmpdir), 'test.db'))
+    DBConnection(Base, url).session.remove()
+    return url
+
+
+@pytest.fixture
+def checks(monkeypatch):
+    calls = []
+    is_db_sane = utils.is_db_sane
+
+    def counting(*args):
+        calls.append(args)
+        return is_db_sane(*args)
+
+    monkeypatch.setattr(utils, 'is_db_sane', counting)
+    return calls
+
+
+def execute(dbconn, sql):
+    with dbconn.engine.begin() as conn:
+        conn.execute(sql)
+
+
+def test_fingerprint_match(url, checks):
+    dbconn = DBConnection(Base, url)
+    assert dbconn._schema_is_current()
+    assert checks == []
+
+
+def test_fingerprint_mismatch(url, checks):
+    dbconn = DBConnection(Base, url)
+    execute(dbconn, "UPDATE mixnmatchttp_schema SET fingerprint = 'x'")
+    assert not dbconn._schema_is_current()
+    DBConnection(Base, url)
+    assert len(checks) == 1
+    # saved again after the check
+    assert dbconn._schema_is_current()
+
+
+def test_missing_fingerprint_table(url, checks):
+    dbconn = DBConnection(Base, url)
+    execute(dbconn, 'DROP TABLE mixnmatchttp_schema')
+    assert not dbconn._schema_is_current()
+    DBConnection(Base, url)
+    assert len(checks) == 1
+    assert dbconn._schema_is_current()
+
+
+def test_server_not_inspected_on_match(url, checks, monkeypatch):
+    def inspect(engine):
+        raise AssertionError('Inspected {}'.format(engine.url))
+
+    monkeypatch.setattr(utils.Inspector, 'from_engine', inspect)
+    ServerDBConnection(Base, url)
+    assert checks == []
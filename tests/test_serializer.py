@@ -0,0 +1,54 @@
+'''Compares ObjectSerializer with the recursive object_to_dict it
+replaced, reference_object_to_dict in serializer_helpers
+'''
+
+import pytest
+
+from mixnmatchttp.db import DBConnection, object_to_dict
+from mixnmatchttp.handlers.authenticator.dbapi import DBBase, \
+    DBUser, DBRole, DBSession
+from serializer_helpers import populate, reference_object_to_dict
+
+
+@pytest.fixture
+def db():
+    dbconn = DBConnection(DBBase, 'sqlite://')
+    session = dbconn.session()
+    populate(session)
+    yield session
+    session.rollback()
+    dbconn.session.remove()
+    DBBase.metadata.drop_all(dbconn.engine)
+
+
+OPTIONS = [
+    {},
+    {'max_depth': 0},
+    {'max_depth': 1},
+    {'max_depth': 2},
+    {'skip': None},
+    {'skip': None, 'max_depth': 1},
+    {'no_skip': '^user_id$'},
+    {'convert_timestamp': None},
+    {'short_mappings': {'role': ['{}:{}', 'id', 'name']},
+     'max_depth': 1},
+]
+
+
+@pytest.mark.parametrize('options', OPTIONS)
+@pytest.mark.parametrize('cls', [DBUser, DBRole, DBSession])
+def test_same_as_reference(db, cls, options):
+    for obj in db.query(cls):
+        # mapper objects iterate over their loaded attributes, so
+        # load the relationships first
+        reference_object_to_dict(obj, **options)
+        assert object_to_dict(obj, **options) == \
+            reference_object_to_dict(obj, **options)
+
+
+def test_relationship_lists(db):
+    user = db.query(DBUser).filter_by(username='user0').one()
+    data = object_to_dict(user, max_depth=1)
+    assert isinstance(data['roles'], list)
+    assert data['roles'] == \
+        reference_object_to_dict(user, max_depth=1)['roles']
@@ -0,0 +1,156 @@
+import base64
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from mixnmatchttp import endpoints
+from mixnmatchttp.servers import ThreadingHTTPServer
+from mixnmatchttp.handlers.authenticator import \
+    AuthSignedCookieHTTPRequestHandler
+
+
+class Handler(AuthSignedCookieHTTPRequestHandler):
+    _endpoints = endpoints.Endpoint(
+        whoami={},
+    )
+
+    def do_whoami(self):
+        session = self.get_current_session()
+        self.send_as_json({
+            'user': None if session is None
+            else session.user.username})
+
+    def log_message(self, *args):
+        pass
+
+
+class Encrypted(Handler):
+    _encrypt_cookie = True
+
+
+class Sibling(Handler):
+    pass
+
+
+@pytest.fixture(scope='module', autouse=True)
+def users():
+    Handler.create_user('alice', 'x', ['admin'])
+    Handler.create_user('bob', 'x', [])
+
+
+@pytest.fixture(autouse=True)
+def keys():
+    for cls in (Handler, Encrypted, Sibling):
+        cls.set_cookie_keys('secret')
+
+
+@pytest.fixture(scope='module')
+def port():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+def login(cls, username):
+    return cls.generate_session(cls.find_user(username)).token
+
+
+def whoami(port, token):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/whoami',
+                 headers={'Cookie': 'SESSION={}'.format(token)})
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return json.loads(body.decode('utf-8'))['user']
+
+
+def payload(cls, **fields):
+    now = time.time()
+    values = {'username': 'alice', 'roles': ['admin'],
+              'exp': int(now) + 60, 'iat': round(now, 3),
+              'nonce': 'n{}'.format(now)}
+    values.update(fields)
+    return cls._encode_cookie([values[k] for k in (
+        'username', 'roles', 'exp', 'iat', 'nonce')])
+
+
+def test_valid_cookie(port):
+    assert whoami(port, login(Handler, 'alice')) == 'alice'
+
+
+def test_tampered_signature(port):
+    token = login(Handler, 'bob')
+    kid, data, sig = token.split('.')
+    forged = base64.urlsafe_b64encode(json.dumps(
+        ['alice', ['admin'], int(time.time()) + 60, time.time(),
+         'x']).encode('utf-8')).decode('ascii').rstrip('=')
+    assert whoami(port, '.'.join([kid, forged, sig])) is None
+    sig = ('B' if sig[0] == 'A' else 'A') + sig[1:]
+    assert whoami(port, '.'.join([kid, data, sig])) is None
+    assert whoami(port, token) == 'bob'
+
+
+def test_rotated_key(port):
+    old = login(Handler, 'alice')
+    Handler.set_cookie_keys('new secret', 'secret')
+    new = login(Handler, 'alice')
+    assert new.split('.')[0] != old.split('.')[0]
+    assert whoami(port, old) == 'alice'
+    assert whoami(port, new) == 'alice'
+    Handler.set_cookie_keys('new secret')
+    assert whoami(port, old) is None
+    assert whoami(port, new) == 'alice'
+
+
+def test_encrypted_payload():
+    token = login(Encrypted, 'alice')
+    data = token.split('.')[1]
+    data = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    assert b'alice' not in data
+    assert Encrypted._decode_cookie(token)[0] == 'alice'
+    # signed with the same key, but not encrypted
+    assert Encrypted._decode_cookie(login(Handler, 'alice')) is None
+
+
+def test_expired_cookie(port):
+    assert whoami(port, payload(
+        Handler, exp=int(time.time()) - 1)) is None
+
+
+def test_revoked_cookie(port):
+    token = login(Handler, 'bob')
+    other = login(Handler, 'bob')
+    assert whoami(port, token) == 'bob'
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/logout',
+                 headers={'Cookie': 'SESSION={}'.format(token)})
+    conn.getresponse().read()
+    conn.close()
+    assert whoami(port, token) is None
+    assert whoami(port, other) == 'bob'
+
+
+def test_user_revocation_includes_same_millisecond(port):
+    Handler.rm_user_sessions(Handler.find_user('alice'))
+    revoked_at = Handler._revocations.users['alice']
+    assert whoami(port, payload(Handler, iat=revoked_at)) is None
+    assert whoami(port, payload(
+        Handler, iat=round(revoked_at + 0.001, 3))) == 'alice'
+
+
+def test_revocations_are_per_class(port):
+    token = login(Handler, 'bob')
+    Sibling.rm_user_sessions(Sibling.find_user('bob'))
+    Sibling.revoke_session(Sibling.generate_session(
+        Sibling.find_user('alice')))
+    assert 'bob' in Sibling._revocations.users
+    revocations = Handler.__dict__.get('_revocations')
+    assert revocations is None or 'bob' not in revocations.users
+    assert whoami(port, token) == 'bob'
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from mixnmatchttp.utils import SingleFlight
+
+
+def run_concurrently(flight, key, func, callers):
+    '''Calls flight.do from callers threads once func has started
+
+    Returns the leader's result (or exception) and the followers'
+    results.
+    '''
+
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def leader_func():
+        started.set()
+        release.wait(5)
+        return func()
+
+    def leader():
+        try:
+            results.insert(0, flight.do(key, leader_func))
+        except Exception as e:
+            results.insert(0, e)
+
+    def follower():
+        results.append(flight.do(key, lambda: 'follower ran'))
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait(5)
+    followers = [threading.Thread(target=follower)
+                 for i in range(callers)]
+    for t in followers:
+        t.start()
+    time.sleep(0.2)  # let them wait for the leader
+    release.set()
+    for t in [thread] + followers:
+        t.join()
+    return results[0], results[1:]
+
+
+def test_concurrent_callers_share_result():
+    flight = SingleFlight()
+    calls = []
+
+    def func():
+        calls.append(1)
+        return 'result'
+
+    leader, followers = run_concurrently(flight, 'k', func, 5)
+    assert leader == 'result'
+    assert followers == ['result'] * 5
+    assert len(calls) == 1
+    assert flight.shared == 5
+    # not kept for later callers
+    assert flight.do('k', lambda: 'again') == 'again'
+
+
+def test_leader_exception():
+    flight = SingleFlight(keep=10)
+
+    def func():
+        raise RuntimeError('failed')
+
+    leader, followers = run_concurrently(flight, 'k', func, 3)
+    assert isinstance(leader, RuntimeError)
+    # the followers have to do it themselves
+    assert followers == [None] * 3
+    # the failure is not kept
+    assert flight.do('k', lambda: 'ok') == 'ok'
+
+
+def test_keep():
+    flight = SingleFlight(keep=2)
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+    assert flight.do('a', lambda: 3) == 1
+    assert flight.do('c', lambda: 4) == 4  # drops b
+    assert flight.do('b', lambda: 5) == 5
+    assert flight.do('x', lambda: 6, keep=False) == 6
+    assert flight.do('x', lambda: 7) == 7
+
+
+def test_follower_timeout():
+    flight = SingleFlight(timeout=0.05)
+    leader, followers = run_concurrently(flight, 'k', lambda: 'slow', 2)
+    assert leader == 'slow'
+    assert followers == [None] * 2
+    assert flight.timeouts == 2
+    assert flight.shared == 0
+
+
+def test_different_keys_do_not_wait():
+    flight = SingleFlight()
+    release = threading.Event()
+    thread = threading.Thread(
+        target=flight.do, args=('a', lambda: release.wait(5)))
+    thread.start()
+    try:
+        assert flight.do('b', lambda: 'b') == 'b'
+    finally:
+        release.set()
+        thread.join()
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+
+from mixnmatchttp.db import DBConnection
+
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30), unique=True, nullable=False)
+
+
+@pytest.fixture
+def dbconn(tmpdir):
+    path = os.path.join(str(tmpdir), 'test.db')
+    dbconn = DBConnection(Base, 'sqlite:///{}'.format(path))
+    yield dbconn
+    if dbconn.sqlite_writer is not None:
+        dbconn.sqlite_writer.stop()
+    dbconn.session.remove()
+
+
+def names(dbconn):
+    db = dbconn.session()
+    try:
+        return sorted(i.name for i in db.query(Item))
+    finally:
+        dbconn.session.remove()
+
+
+def add_concurrently(dbconn, items):
+    '''Adds each name in its own thread and session
+
+    Returns a dictionary of name--exception raised by commit.
+    '''
+
+    errors = {}
+    barrier = threading.Barrier(len(items))
+
+    def add(name):
+        db = dbconn.session()
+        db.add(Item(name=name))
+        barrier.wait()
+        try:
+            db.commit()
+        except Exception as e:
+            errors[name] = e
+        finally:
+            dbconn.session.remove()
+
+    threads = [threading.Thread(target=add, args=(n,)) for n in items]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def test_commits_are_batched(dbconn):
+    writer = dbconn.enable_sqlite_writer(batch_wait=0.5)
+    items = ['item{}'.format(i) for i in range(8)]
+    assert add_concurrently(dbconn, items) == {}
+    assert names(dbconn) == sorted(items)
+    assert writer.commits == len(items)
+    assert writer.batches < len(items)
+    assert writer.max_batch > 1
+
+
+def test_batch_size(dbconn):
+    writer = dbconn.enable_sqlite_writer(batch_size=2, batch_wait=0.5)
+    assert add_concurrently(
+        dbconn, ['item{}'.format(i) for i in range(6)]) == {}
+    assert writer.max_batch == 2
+    assert writer.batches == 3
+
+
+def test_failing_commit_in_batch(dbconn):
+    db = dbconn.session()
+    db.add(Item(name='taken'))
+    db.commit()
+    dbconn.session.remove()
+    writer = dbconn.enable_sqlite_writer(batch_wait=0.5)
+    errors = add_concurrently(dbconn, ['a', 'taken', 'b'])
+    assert list(errors.keys()) == ['taken']
+    assert isinstance(errors['taken'], IntegrityError)
+    # the others were committed in the same transaction
+    assert writer.batches == 1
+    assert writer.commits == 3
+    assert names(dbconn) == ['a', 'b', 'taken']
+
+
+def test_savepoints_isolate_sessions(dbconn):
+    dbconn.enable_sqlite_writer(batch_wait=0.5)
+    errors = {}
+    barrier = threading.Barrier(2)
+
+    def add(*items):
+        db = dbconn.session()
+        for name in items:
+            db.add(Item(name=name))
+        barrier.wait()
+        try:
+            db.commit()
+        except Exception as e:
+            errors[items] = e
+        finally:
+            dbconn.session.remove()
+
+    # the second one fails on its second row after inserting the
+    # first, which must be rolled back alone
+    threads = [threading.Thread(target=add, args=('a', 'b')),
+               threading.Thread(target=add, args=('c', 'c'))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert list(errors.keys()) == [('c', 'c')]
+    assert names(dbconn) == ['a', 'b']
+
+
+def test_stop_commits_queued_sessions(dbconn):
+    writer = dbconn.enable_sqlite_writer(batch_wait=5)
+    errors = {}
+    thread = threading.Thread(target=lambda: errors.update(
+        add_concurrently(dbconn, ['a', 'b'])))
+    thread.start()
+    time.sleep(0.5)  # both are waiting for the batch
+    writer.stop()
+    assert writer.commits == 2
+    thread.join()
+    assert errors == {}
+    assert not writer.running
+    assert names(dbconn) == ['a', 'b']
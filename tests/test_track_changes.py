@@ -0,0 +1,163 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import Column, Integer, String, ForeignKey, Table
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+from mixnmatchttp.db import DBConnection
+from mixnmatchttp.poller import VersionPoller
+from mixnmatchttp.handlers.authenticator import \
+    table_validator, row_validator
+
+
+Base = declarative_base()
+
+tags = Table(
+    'item_tag', Base.metadata,
+    Column('item_id', Integer, ForeignKey('item.id')),
+    Column('tag_id', Integer, ForeignKey('tag.id')))
+
+
+class Owner(Base):
+    __tablename__ = 'owner'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30))
+
+
+class Item(Base):
+    __tablename__ = 'item'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(30))
+    owner_id = Column(Integer, ForeignKey('owner.id'))
+    owner = relationship('Owner', backref='items')
+    tags = relationship('Tag', secondary=tags)
+
+
+class Tag(Base):
+    __tablename__ = 'tag'
+    id = Column(Integer, primary_key=True)
+
+
+@pytest.fixture
+def changes():
+    dbconn = DBConnection(Base, 'sqlite://')
+    db = dbconn.session()
+    db.add_all([Owner(id=1, name='a'), Owner(id=2, name='b'),
+                Item(id=1, name='x', owner_id=1), Tag(id=1)])
+    db.commit()
+    recorded = []
+    dbconn.track_changes(recorded.append)
+    yield db, recorded
+    dbconn.session.remove()
+    Base.metadata.drop_all(dbconn.engine)
+
+
+def test_row_operations(changes):
+    db, recorded = changes
+    db.add(Item(id=2, name='y'))
+    db.query(Owner).get(2).name = 'c'
+    db.delete(db.query(Owner).get(1))
+    db.query(Item).get(1).owner_id = None
+    db.commit()
+    assert recorded == [{
+        'item': {'1': 'update', '2': 'insert'},
+        'owner': {'1': 'delete', '2': 'update'}}]
+
+
+def test_relationship_changes_other_side(changes):
+    db, recorded = changes
+    # the old owner is not loaded
+    db.query(Item).get(1).owner = db.query(Owner).get(2)
+    db.commit()
+    db.add(Item(id=2, owner=db.query(Owner).get(1)))
+    db.commit()
+    db.delete(db.query(Item).get(2))
+    db.commit()
+    assert recorded == [
+        {'item': {'1': 'update'},
+         'owner': {'1': 'update', '2': 'update'}},
+        {'item': {'2': 'insert'}, 'owner': {'1': 'update'}},
+        {'item': {'2': 'delete'}, 'owner': {'1': 'update'}}]
+
+
+def test_unrelated_change_leaves_other_side(changes):
+    db, recorded = changes
+    db.query(Item).get(1).name = 'y'
+    db.commit()
+    assert recorded == [{'item': {'1': 'update'}}]
+
+
+def test_unknown_rows(changes):
+    db, recorded = changes
+    db.query(Owner).filter(Owner.id > 1).update({'name': 'z'})
+    item = db.query(Item).get(1)
+    item.tags.append(db.query(Tag).get(1))
+    db.commit()
+    assert recorded == [{
+        'owner': None, 'item': {'1': 'update'}, 'tag': {'1': 'update'},
+        'item_tag': None}]
+
+
+def test_rollback_and_no_changes(changes):
+    db, recorded = changes
+    db.query(Owner).get(1).name = 'c'
+    db.flush()
+    db.rollback()
+    db.query(Owner).get(1).name = 'a'  # same value
+    db.commit()
+    assert recorded == []
+
+
+def test_version_poller_scopes():
+    poller = VersionPoller()
+    latest = poller.latest
+    table, other_table = poller.table_tag('item'), poller.table_tag('tag')
+    row, other_row = poller.row_tag('item', 1), poller.row_tag('item', 2)
+    poller.update({'item': {'1': 'update'}})
+    assert poller.latest != latest
+    assert poller.table_tag('item') != table
+    assert poller.table_tag('tag') == other_table
+    assert poller.table_tag('tag', 'item') != other_table
+    assert poller.row_tag('item', 1) != row
+    assert poller.row_tag('item', 2) == other_row
+    # unknown rows change every row of the table
+    other_row = poller.row_tag('item', 2)
+    poller.update({'item': None})
+    assert poller.row_tag('item', 2) != other_row
+    # and no changes given means everything changed
+    other_table = poller.table_tag('tag')
+    poller.update()
+    assert poller.table_tag('tag') != other_table
+
+
+def test_version_poller_forgets_rows():
+    poller = VersionPoller(max_rows=2)
+    other_table_row = poller.row_tag('tag', 1)
+    for pk in range(1, 4):
+        poller.update({'item': {str(pk): 'insert'}})
+    row = poller.row_tag('item', 1)
+    # rows which were never changed got the version of row 1
+    assert poller.row_tag('item', 9) == row
+    assert poller.row_tag('item', 2) != row
+    poller.update({'item': {'4': 'insert'}})
+    # forgotten, so it has the version of the last forgotten row
+    assert poller.row_tag('item', 1) != row
+    assert poller.row_tag('item', 1) == poller.row_tag('item', 9)
+    assert poller.row_tag('item', 2) == poller.row_tag('item', 1)
+    assert poller.row_tag('tag', 1) == other_table_row
+
+
+def test_validators():
+    poller = VersionPoller()
+    handler = SimpleNamespace(pollers={'db': poller},
+                              ep=SimpleNamespace(args='1'))
+    by_table = table_validator('db', 'item')
+    by_row = row_validator('db', 'item')
+    by_param = row_validator('db', 'item', pk=lambda h: 2)
+    before = [v(handler) for v in (by_table, by_row, by_param)]
+    poller.update({'item': {'2': 'update'}})
+    after = [v(handler) for v in (by_table, by_row, by_param)]
+    assert after[0] != before[0]
+    assert after[1] == before[1]
+    assert after[2] != before[2]